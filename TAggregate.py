@@ -180,6 +180,14 @@ class TAggregate( TableTool) :
 	    i=i+1
 	return alist
 
+    #---------------------------------------------------------
+    # Output rows are built only from the group-by columns and
+    # the aggregated columns.
+    #
+    def inputColumns(self, n, needed):
+        acols = [c for c in self.accumulatorColumns if c is not None]
+        return self.unionColumns(self.gbColumns, acols)
+
     #---------------------------------------------------------
     def flush(self, gbcols, aggs):
         row = list(gbcols)
@@ -194,13 +202,63 @@ class TAggregate( TableTool) :
 
 
     #---------------------------------------------------------
+    # Sort order. If the input is known to be grouped on the
+    # group-by columns (e.g., sorted on them by ts, or read by
+    # tr --sorted), aggregates in stream mode.
+    #
+    def useSortOrder(self):
+        TableTool.useSortOrder(self)
+        if not self.options.streamMode and self.isGroupedOn(self.t1, self.gbColumns):
+            self.options.streamMode = True
+
+    #---------------------------------------------------------
+    # Stream mode. Returns the order the groups are expected
+    # in, as a list of (i, reverse), i indexing the group-by
+    # columns: the input's order on them, as far as it is known
+    # (see isGroupedOn), then ascending on the rest, in the
+    # order given.
+    #
+    def streamOrder(self):
+        order = []
+        for (c, r, k) in self.inputOrder(self.t1):
+            if c not in self.gbColumns or k != "":
+                break
+            i = self.gbColumns.index(c)
+            if i in [j for (j, rr) in order]:
+                break
+            order.append((i, r))
+        for i in range(len(self.gbColumns)):
+            if i not in [j for (j, r) in order]:
+                order.append((i, False))
+        return order
+
+    #---------------------------------------------------------
+    # Sort order. In stream mode, groups are output in input
+    # order, which is checked (see goStream).
+    #
+    def sortOrder(self):
+        if not self.options.streamMode:
+            return []
+        return [(i, r, "") for (i, r) in self.streamOrder()]
+
+    #---------------------------------------------------------
+    # Stream mode. Groups must come in streamOrder; one that
+    # does not (so that it might have come before) is an error.
+    #
     def goStream(self):
+        order = self.streamOrder()
         prevKey = None
         alist = None
-        for row in self.t1:
+        for n,row in enumerate(self.t1):
             gbkey = self.makeKey(row,self.gbColumns)
             if gbkey != prevKey:
                 if prevKey:
+                    for (i, r) in order:
+                        if gbkey[i] != prevKey[i]:
+                            if (gbkey[i] < prevKey[i]) != r:
+                                raise RuntimeError(("Input is not sorted on the group-by " + \
+                                    "columns: key %s in row %d follows %s.") % (gbkey, n+1, prevKey))
+                            break
                     yield self.flush(prevKey, alist)
                 alist = self.newAccumulatorList()
             for a in alist:
@@ -489,6 +547,8 @@ functions listed below, and arg's depend on the function.
 '''
 STREAMHELP='''By default, all input rows are read before any output is generated. If the input is already sorted
 on the group-by column(s), you can specify this option to cause output to be generated in stream-fashion, 
-greatly reducing both memory usage and lag time. WARNING: If you specify this option and the input is *not* sorted properly,
-you will get garbage.
+greatly reducing both memory usage and lag time. The input must then be sorted in ascending (string) order on the
+group-by columns, in the order given, unless its order is known (it is sorted by ts, or read by tr --sorted); input
+found to be out of order is an error. Stream mode is chosen automatically when the input is known to be sorted on
+the group-by columns.
 '''
@@ -74,6 +74,15 @@ class TBucketize( TableTool ):
 	    	"be specified for both IDs.")
 
 	
+    #---------------------------------------------------------
+    # Output rows are the input rows with 3 columns prepended.
+    #
+    def inputColumns(self, n, needed):
+        if needed is None or len([c for c in needed if c < 0]) > 0:
+            return None
+        cols = [c-3 for c in needed if c >= 3]
+        return self.unionColumns(cols, self.kcols1, self.kcols2)
+
     #---------------------------------------------------------
     def makeKey(self, row, cols, prepend):
 	key = [prepend]
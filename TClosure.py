@@ -39,6 +39,10 @@ class TClosure ( TableTool ) :
       if self.options.child is None:
         self.parser.error("No child index specified.")
 
+    #---------------------------------------------------------
+    def inputColumns(self, n, needed):
+        return [self.options.parent, self.options.child]
+
     #---------------------------------------------------------
     def go(self):
         pi = self.options.parent
@@ -5,6 +5,7 @@
 #----------------------------------------------------------------------
 from TableTool import TableTool
 from common import *
+import keyindex
 #----------------------------------------------------------------------
 #
 class TDiffIntUnion( TableTool ):
@@ -12,6 +13,7 @@ class TDiffIntUnion( TableTool ):
 	self.kcols1 = []
 	self.kcols2 = []
 	self.t2Keys = {}
+	self.useMerge = False
 	TableTool.__init__(self,2,argv)
 
     #---------------------------------------------------------
@@ -27,6 +29,19 @@ class TDiffIntUnion( TableTool ):
 	    metavar="COLUMN(S)",
 	    help="Specifies key column(s) for table T2.")
 
+	self.parser.add_option("--index", dest="useIndex",
+	    action="store_true", default = False,
+	    help="Look up keys in T2's key index (FILE.kCOLS.deftkey) instead of loading T2; " + \
+	         "the index is built if missing or out of date. T2 must be a named file " + \
+	         "in tsv format.")
+
+	self.parser.add_option("--sorted", dest="sorted",
+	    action="store_true", default = False,
+	    help="Both inputs are sorted (ascending, as strings, as ts sorts them) on their " + \
+	         "key columns. Merges them, rather than loading T2's keys. Input found to be " + \
+	         "out of order is an error. Chosen automatically when the inputs are known to " + \
+	         "be sorted. (Default: No)")
+
 
     #---------------------------------------------------------
     #
@@ -44,7 +59,93 @@ class TDiffIntUnion( TableTool ):
 	    self.parser.error("Same number of key columns must " + \
 	    	"be specified for both IDs.")
 
+	self.useMerge = self.options.sorted
+	if self.useMerge and nkc1 == 0:
+	    self.parser.error("--sorted requires key columns (--k1/--k2).")
+	if self.useMerge and self.options.useIndex:
+	    self.parser.error("--index cannot be used with --sorted.")
+
 	
+    #---------------------------------------------------------
+    # Rows of T1 are output; T2 is only used for its keys.
+    #
+    def inputColumns(self, n, needed):
+        if n == 1:
+            return self.unionColumns(needed, self.kcols1)
+        return self.kcols2
+
+    #---------------------------------------------------------
+    # Sort order. Rows of T1 are output in T1 order.
+    #
+    def sortOrder(self):
+	return self.inputOrder(self.t1)
+
+    #---------------------------------------------------------
+    # Sort order. If both inputs are known to be sorted on the
+    # key columns, merges them (as --sorted), unless --index
+    # was given.
+    #
+    def useSortOrder(self):
+	TableTool.useSortOrder(self)
+	if self.useMerge or self.options.useIndex:
+	    return
+	if self.isSortedOn(self.t1, self.kcols1) and self.isSortedOn(self.t2, self.kcols2):
+	    self.useMerge = True
+
+    #---------------------------------------------------------
+    # Merge (--sorted). Generates (row, found) for each row of
+    # T1, found being True if T2 has a row with the same key.
+    # T2 is read alongside, up to T1's key; only one key of
+    # each is held at a time.
+    #
+    def mergeMatches(self):
+	rows2 = iter(self.t2)
+	done2 = False
+	key1 = None
+	key2 = None
+	n2 = 0
+	for n1,row in enumerate(self.t1):
+	    k = self.makeKey(row, self.kcols1)
+	    if key1 is not None and k < key1:
+		raise RuntimeError(("T1 is not sorted on its key columns: " + \
+		    "key %s in row %d follows %s.") % (k, n1+1, key1))
+	    key1 = k
+	    while not done2 and (key2 is None or key2 < k):
+		row2 = next(rows2, None)
+		if row2 is None:
+		    done2 = True
+		    break
+		n2 += 1
+		k2 = self.makeKey(row2, self.kcols2)
+		if key2 is not None and k2 < key2:
+		    raise RuntimeError(("T2 is not sorted on its key columns: " + \
+			"key %s in row %d follows %s.") % (k2, n2, key2))
+		key2 = k2
+	    yield (row, key2 == k)
+
+    #---------------------------------------------------------
+    # Returns the set of T2's keys: a dict, or with --index,
+    # T2's key index (which supports has_key).
+    #
+    def loadT2Keys(self):
+	if self.options.useIndex:
+	    reader = self.keyIndexReader()
+	    return keyindex.getKeyIndex(reader.options.filename, self.kcols2,
+			reader.separatorChar, reader.commentChar, self.debug)
+	keys = {}
+        for row in self.t2:
+	    key = self.makeKey(row, self.kcols2)
+	    keys[key] = 1
+	return keys
+
+    #---------------------------------------------------------
+    # Releases what loadT2Keys returned (a key index holds its
+    # file open and mapped).
+    #
+    def closeT2Keys(self, keys):
+	if isinstance(keys, keyindex.KeyIndex):
+	    keys.close()
+
     #---------------------------------------------------------
     def makeKey(self, row, cols):
 	key = []
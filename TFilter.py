@@ -60,6 +60,76 @@ EXAMPLE:
 '''
 from TableTool import TableTool
 from common import *
+import ast
+
+#----------------------------------------------------------------------
+# Returns the list of columns of row name (default: r) an
+# expression reads, if it only uses name in the form name[i] or
+# name[i:j] with non-negative integer literals. Otherwise returns
+# None. A leading '?' (filter) is ignored.
+#
+def exprColumns(expr, name='r'):
+    if expr[0] == '?':
+	expr = expr[1:]
+    try:
+	tree = ast.parse(expr.strip(), mode='eval')
+    except SyntaxError:
+	return None
+    cols = set()
+    subscripted = set()
+    for node in ast.walk(tree):
+	if isinstance(node, ast.Subscript) \
+	and isinstance(node.value, ast.Name) and node.value.id == name:
+	    c = sliceColumns(node.slice)
+	    if c is None:
+		return None
+	    cols.update(c)
+	    subscripted.add(node.value)
+    for node in ast.walk(tree):
+	if isinstance(node, ast.Name) and node.id == name \
+	and node not in subscripted:
+	    return None
+    return sorted(cols)
+
+#----------------------------------------------------------------------
+# Returns the list of columns selected by a subscript
+# node, or None if they can't be determined statically.
+#
+def sliceColumns(s):
+    def literal(n):
+	if isinstance(n, ast.Num) and type(n.n) is types.IntType and n.n >= 0:
+	    return n.n
+	return None
+    if isinstance(s, ast.Index):
+	i = literal(s.value)
+	if i is None:
+	    return None
+	return [i]
+    if isinstance(s, ast.Slice) and s.step is None and s.upper is not None:
+	lo = 0
+	if s.lower is not None:
+	    lo = literal(s.lower)
+	hi = literal(s.upper)
+	if lo is None or hi is None:
+	    return None
+	return range(lo, hi)
+    return None
+
+#----------------------------------------------------------------------
+# Returns the list of input columns a generator copies to the
+# output unchanged, in order, if it has the form r[i] or r[i:j]
+# (with non-negative integer literals). Otherwise returns None.
+#
+def copiedColumns(expr):
+    try:
+	tree = ast.parse(expr.strip(), mode='eval')
+    except SyntaxError:
+	return None
+    node = tree.body
+    if isinstance(node, ast.Subscript) \
+    and isinstance(node.value, ast.Name) and node.value.id == 'r':
+	return sliceColumns(node.slice)
+    return None
 
 class TFilter ( TableTool ) :
     USAGE=__doc__
@@ -67,6 +137,7 @@ class TFilter ( TableTool ) :
 	self.functionContext = {}
 	self.functions = []
 	self.isFilter = []
+	self.exprs = []
 	TableTool.__init__(self,1,argv)
 
     def initArgParser(self):
@@ -131,12 +202,14 @@ class TFilter ( TableTool ) :
 	    isf = (arg[0] == '?')
 	    self.functions.append( self.makeFunction( arg ) )
 	    self.isFilter.append( isf )
+	    self.exprs.append( arg )
 	    noGenerators = noGenerators and isf
 
 	if noGenerators:
             self.functions.append( \
                 self.makeFunction( "r" ) )
             self.isFilter.append( False )
+            self.exprs.append( "r" )
 
     #---------------------------------------------------------
     # Given a string expression, returns a callable object that
@@ -148,6 +221,62 @@ class TFilter ( TableTool ) :
         s = "lambda r: " + expr
 	return eval(s, self.functionContext)
 
+    #---------------------------------------------------------
+    # Returns the list of columns an expression reads, or None
+    # (see exprColumns).
+    #
+    def exprColumns(self, expr):
+	return exprColumns(expr)
+
+    #---------------------------------------------------------
+    # If the only generator is r, output rows are the input rows,
+    # so the columns the consumer needs are needed as well.
+    #
+    def inputColumns(self, n, needed):
+	generators = [e for (e,isf) in zip(self.exprs, self.isFilter) if not isf]
+	lists = map(self.exprColumns, [e for e in self.exprs if e != "r"])
+	if generators == ["r"]:
+	    lists.append(needed)
+	elif "r" in generators:
+	    return None
+	return self.unionColumns(*lists)
+
+    #---------------------------------------------------------
+    # Sort order. Rows are output in input order, so the input's
+    # order holds for the columns the generators copy unchanged:
+    # those of generators r[i] and r[i:j], and all of r, up to
+    # the first other generator (after which the positions of
+    # output columns are not known). The order is kept up to
+    # its first key on a column that is not copied.
+    #
+    def sortOrder(self):
+	order = self.inputOrder(self.t1)
+	generators = [e.strip() for (e,isf) in zip(self.exprs, self.isFilter) if not isf]
+	if generators == ["r"]:
+	    return order
+	positions = {}
+	rowStart = None
+	n = 0
+	for e in generators:
+	    if e == "r":
+		rowStart = n
+		break
+	    cols = copiedColumns(e)
+	    if cols is None:
+		break
+	    for c in cols:
+		positions.setdefault(c, n)
+		n += 1
+	out = []
+	for (c, r, k) in order:
+	    if c in positions:
+		out.append((positions[c], r, k))
+	    elif rowStart is not None and c >= 0:
+		out.append((rowStart + c, r, k))
+	    else:
+		break
+	return out
+
     #---------------------------------------------------------
     # Evaluates the list of functions to generate zero
     # or one output rows. Each function is evaluated
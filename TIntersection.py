@@ -19,13 +19,17 @@ class TIntersection (TDiffIntUnion):
 
     #---------------------------------------------------------
     def go(self):
-	keys = {}
-        for row in self.t2:
-	    key = self.makeKey(row, self.kcols2)
-	    keys[key] = 1
-
-        for row in self.t1:
-	    key = self.makeKey(row, self.kcols1)
-	    if keys.has_key(key):
-                yield row
+	if self.useMerge:
+	    for (row, found) in self.mergeMatches():
+		if found:
+		    yield row
+	    return
+	keys = self.loadT2Keys()
+	try:
+	    for row in self.t1:
+		key = self.makeKey(row, self.kcols1)
+		if keys.has_key(key):
+		    yield row
+	finally:
+	    self.closeT2Keys(keys)
 
@@ -29,30 +29,437 @@ OPTIONS:
         --j1/--j2, and (2) pass any additional command line filters.
 
         If neither --j1 nor --j2 is specified, tj will perform a
-        nested loops join, where the join condition is specified
-        by any command line filters. If no filters are specified,
+        nested loops join (a "theta join"), where the join condition is
+        specified by any command line filters. If no filters are specified,
         tj generates the combinatorial cross-product of tuples
         from the input tables.
 
     expression
-        All positional command line arguments are Python expressions that
-        either generate output column values from a pair of input rows, 
-        or impose additional filtering on the joined pairs.
-        They work just like in tf, except that the defined names are
-        within the expression are:
-            IN1	- the input row from T1
-            IN2	- the input row from T2
-            OUT	- the output row
-        If no expressions are given, the expression "IN1+IN2" is
-        used. Thus, the default is to output all columns from both rows.
-
-        Filters (expressions beginning with a '?' character) can be included.
+        Positional command line arguments not beginning with '?' are
+        the column spec: r1, r2, r1[i] or a slice such as r2[1:4]
+        name the output columns, from the row of T1 (r1) and the row
+        of T2 (r2). If none are given, "r1 r2" is used. Thus, the
+        default is to output all columns from both rows.
+
+        Filters (expressions beginning with a '?' character) are
+        Python expressions over r1 and r2, as in tf, and must all be
+        true of a pair of rows for it to satisfy the join (e.g.,
+        '?int(r1[2]) < int(r2[3])'). string, re and math can be used.
+        They apply in every join mode; a row of an outer join is
+        unmatched if no pair with it passes. The filters are compiled
+        once, into one function that tests an outer row against a list
+        of inner rows in a single call.
+
+    Theta join
+        Without --k1/--k2, T2 is loaded into memory, and each row of T1
+        is tested against T2's rows. If a filter (or a part of one joined
+        by 'and') compares an expression of one row with an expression of
+        the other using <, <=, > or >= (e.g., 'r1[1] <= r2[1]', or
+        'int(r2[3]) > int(r1[2])*2'), the inner rows are sorted on the
+        value of their expression, and each outer row only tests those
+        in the range its value allows (two such comparisons on the same
+        inner expression give a band). Comparisons are as in Python: use
+        int() or float() to compare numbers. Output rows follow the
+        order of the outer input, and each row's matches the order of
+        the inner. A theta join cannot use --memory or --compact.
+
+    --sorted
+        Both inputs are already sorted (ascending, by string comparison,
+        as ts sorts them) on their join columns. tj then merges the two
+        inputs as it reads them, rather than loading T2 into memory; only
+        the rows sharing one key value are held at a time. Rows of T2
+        with no match (--right-outer) are output as they are passed,
+        rather than at the end. Input found to be out of order is an
+        error. A merge join is also used, without --sorted, when both
+        inputs are known to be sorted so: sorted by ts on the join
+        columns, or read by tr --sorted (and not -P, --index or
+        --i1/--i2).
+
+    --memory MB
+        Limits the memory used to hold T2 (as estimated from the sizes
+        of its rows). If T2 turns out to be larger, tj performs a
+        "grace" hash join: both inputs are split by a hash of their join
+        keys into --partitions temporary files each, and each pair of
+        partitions is joined separately. A partition whose T2 part is
+        still too large is split again (up to 3 levels; beyond that, e.g.
+        when one key has too many rows, it is joined in memory
+        regardless). The output is the same as that of the in-memory
+        join, but in a different order. Temporary files are written in
+        TMPDIR (or --tmp-dir) and removed when tj finishes or exits.
+
+    --compact
+        Stores the rows of T2 compactly: as strings in one buffer,
+        rather than lists of strings, splitting a row again each time
+        it matches. This fits a T2 several times larger in the same
+        memory, for some cost in speed when rows match many times.
+        (It also applies to the partitions of --memory and -P.)
+
+    Semi-join reduction
+        When T1 is read directly from a file, once T2 has been loaded
+        tj pushes a test of T1's join key down into the reader, which
+        then drops rows that cannot match (before splitting them in
+        full, in batch mode). The test is exact for the in-memory join.
+        When the join is partitioned (--memory, -P), T2's keys are not
+        all in memory, and a Bloom filter of them is used instead, so
+        that most non-matching T1 rows are never written to the
+        partition files. This is not done for a left-outer join, which
+        outputs every row of T1; --no-semijoin turns it off.
+
+    --inner auto|1|2
+        Which input is loaded into the hash table (the "inner"); the
+        other is scanned. By default (auto), tj estimates the memory
+        each would take and hashes the smaller. For an input read
+        from a file, the estimate uses the file size, the row count
+        from its line-offset index (if there is a current one) and
+        the row length and key repetition seen in the first 64KB.
+        Other inputs are sampled by reading up to 10000 rows; one that
+        ends within that is known exactly. (Undecided cases keep T2 as
+        the inner.) Output rows follow the order of the outer input,
+        so the choice affects output order. -v reports it.
+
+    --index
+        T2 must be a named (uncompressed) file in tsv format. Instead
+        of loading it, tj opens its key index on the --k2 columns (see
+        keyindex.py), building and saving the index first if there is
+        no current one, and reads only the rows of T2 that match. For
+        a table that is joined against repeatedly, this makes start-up
+        nearly instant. T2 is always the inner table; --memory is not
+        needed.
+
+    --i1 START,END
+    --i2 START,END
+        Interval-overlap join. Names the columns holding the start and
+        end coordinates of an interval in each table (e.g., of GFF3
+        features: --k1 0 --i1 3,4). A pair of rows satisfies the join if
+        their intervals overlap (coordinates are integers, and an interval
+        includes both ends, as in GFF3), their --k1/--k2 columns (e.g.,
+        the chromosome), if given, are equal, and they pass any filters.
+        The inner table's intervals are put in a binning index (as used
+        by the UCSC genome browser): each goes in the smallest of a
+        hierarchy of fixed-size bins (128kb, 1Mb, 8Mb, ...) that holds it,
+        and each row of the outer table checks only the bins its interval
+        touches, so the time is about linear in the size of the inputs
+        and the output. Output rows follow the order of the outer input,
+        and each row's matches the order of the inner. The -c spec and
+        the outer joins work as usual. Cannot be used with --sorted,
+        --memory, --index or -P.
+
+    -P N, --parallel N
+        Joins using N worker processes. Both inputs are partitioned
+        as for --memory (into at least 2N partitions), the workers join
+        the pairs of partitions, and their output is merged back, in
+        the order of the outer input's rows, as for a single process;
+        rows of the inner input with no match (--left-outer/--right-outer)
+        come last. (With --inner auto, the outer input may be T2; see
+        --inner.) With --unordered, the output of each partition is
+        passed on as soon as it is ready, which avoids waiting for all
+        the partitions to finish.
+
+    Self-join
+        If T1 and T2 are the same input (the same file, read with the
+        same options, or both stdin), tj reads it only once. With the
+        same key columns in both (--k1 and --k2), the rows are grouped
+        by key in that one scan, and each group is joined with itself
+        in turn: the output is grouped by key (groups in the order of
+        their first rows), rather than in T1 order. With --sorted, the
+        input is streamed a group at a time, so only one group is held
+        in memory. With different key columns, the rows read are joined
+        as T1 and T2 by the usual in-memory hash join. A self-join does
+        not use --memory, --compact, --index, -P or --i1/--i2; with any
+        of these, a file is simply read twice (and stdin is an error).
 
 '''
 #----------------------------------------------------------------------
 #
-from TableTool import TableTool
+import sys
+import os
+import heapq
+import atexit
+import shutil
+import tempfile
+import itertools
+import operator
+import marshal
+import array
+import ast
+import bisect
+
+from TableTool import TableTool, Prefetcher
+from TFilter import exprColumns
 from common import *
+import compression
+import lineindex
+import keyindex
+
+# Estimated memory (bytes) used by each row of the inner table
+# held in the hash table, beyond the lengths of its strings, and
+# by each of its column values.
+ROW_OVERHEAD = 200
+COLUMN_OVERHEAD = 45
+
+# Rows written per marshal record to a partition file.
+SPILL_BATCH_ROWS = 1000
+
+# Maximum depth of repartitioning in a grace hash join.
+MAX_SPILL_DEPTH = 3
+
+# Estimated memory (bytes) used by each row, and by each distinct
+# key, of a compact (--compact) inner table, beyond the lengths of
+# its strings.
+COMPACT_ROW_OVERHEAD = 10
+COMPACT_KEY_OVERHEAD = 120
+
+# Estimated memory (bytes) per distinct key in the hash table
+# (the key tuple, its list of rows and the dict slot).
+KEY_OVERHEAD = 150
+
+# Choosing the inner table. Bytes read from the start of an input
+# file, and rows read from an input that is not a file, to estimate
+# its size. Compressed files are assumed to expand this many times.
+SAMPLE_BYTES = 64*1024
+SAMPLE_ROWS = 10000
+COMPRESSION_RATIO = 4
+
+# kinds of size estimate
+EXACT = "exactly"
+ESTIMATE = "about"
+AT_LEAST = "at least"
+
+# Bloom filter size (bits per key) and number of probes. These
+# give a false positive rate of about 1%.
+BLOOM_BITS_PER_KEY = 10
+BLOOM_PROBES = 7
+
+# separator of the column values of a row, and of a key, in
+# compact storage (a row containing it is rejected)
+NUL = "\0"
+
+# Interval-overlap join. Bin sizes (as shifts): the smallest
+# bins are 128kb; each level's bins are 8 times the size of the
+# last.
+OVERLAP_MIN_SHIFT = 17
+OVERLAP_LEVEL_SHIFT = 3
+
+# Comparison operators of a filter that a theta join can answer
+# from a sorted inner table, and each one's mirror image (for
+# a comparison written with the inner row on the left).
+RANGE_OPS = { ast.Lt : ast.Gt, ast.LtE : ast.GtE, ast.Gt : ast.Lt, ast.GtE : ast.LtE }
+
+# The TJoin being run by a parallel join. Worker processes are
+# forked from the parent, and so inherit it (with its column
+# spec function, which could not be pickled).
+PARALLEL_JOIN = None
+
+#----------------------------------------------------------------------
+# A Bloom filter over hash values. Answers whether a value may
+# have been added (with a small rate of false positives) or
+# certainly was not. The probes are derived from the low and
+# high halves of the value (double hashing).
+#
+class BloomFilter:
+    def __init__(self, nkeys, bitsPerKey=BLOOM_BITS_PER_KEY, nprobes=BLOOM_PROBES):
+	self.nbits = max(64, nkeys * bitsPerKey)
+	self.nprobes = nprobes
+	self.bits = bytearray((self.nbits + 7) // 8)
+
+    def add(self, h):
+	nbits = self.nbits
+	h1 = h & 0xffffffff
+	h2 = ((h >> 32) & 0xffffffff) | 1
+	bits = self.bits
+	for i in range(self.nprobes):
+	    b = (h1 + i*h2) % nbits
+	    bits[b >> 3] |= 1 << (b & 7)
+
+    def __contains__(self, h):
+	nbits = self.nbits
+	h1 = h & 0xffffffff
+	h2 = ((h >> 32) & 0xffffffff) | 1
+	bits = self.bits
+	for i in range(self.nprobes):
+	    b = (h1 + i*h2) % nbits
+	    if not bits[b >> 3] & (1 << (b & 7)):
+		return False
+	return True
+
+#----------------------------------------------------------------------
+# Compact storage for the inner table (--compact). Rows are
+# kept as their column values joined by NUL, one after another
+# in a single buffer, and are split again only when they match.
+# Keys are kept in the same form (interned), mapped to the row
+# number of their one row, or to a list of row numbers. Rows of
+# a right-outer join that have been matched are recorded in a
+# bitset. A row with a NUL in a column value cannot be split
+# back correctly, and is an error. Joining on NUL encodes a
+# key faithfully only if none of its values holds a NUL, so a
+# key looked up that does is not encoded at all: it cannot
+# match, since no stored key has one, and it is simply not
+# found.
+#
+# It stands in for both the hash table (has_key, [key]) and
+# the list of unmatched rows (assigning None to [i] marks row i
+# matched; iterating generates each row, or None if matched)
+# of the usual representation.
+#
+class CompactInner:
+    def __init__(self):
+	self.index = {}
+	self.buffer = bytearray()
+	self.offsets = array.array('L', [0])
+	self.seen = bytearray()
+
+    # Adds a row. Returns the (estimated) memory added.
+    def add(self, key, row):
+	i = len(self.offsets) - 1
+	line = NUL.join(row)
+	if line.count(NUL) != len(row) - 1:
+	    raise RuntimeError("--compact: a row of the hashed input contains a NUL character: %r" % (row,))
+	self.buffer.extend(line)
+	self.offsets.append(len(self.buffer))
+	if i % 8 == 0:
+	    self.seen.append(0)
+	k = self.keyString(key)
+	v = self.index.get(k)
+	if v is None:
+	    self.index[intern(k)] = i
+	    return COMPACT_ROW_OVERHEAD + len(line) + COMPACT_KEY_OVERHEAD + len(k)
+	if type(v) is types.IntType:
+	    self.index[k] = [v, i]
+	else:
+	    v.append(i)
+	return COMPACT_ROW_OVERHEAD + len(line)
+
+    def row(self, i):
+	return str(self.buffer[self.offsets[i]:self.offsets[i+1]]).split(NUL)
+
+    # The stored form of key, or None if it has a NUL in a value.
+    def keyString(self, key):
+	k = NUL.join(key)
+	if k.count(NUL) != len(key) - 1:
+	    return None
+	return k
+
+    def has_key(self, key):
+	k = self.keyString(key)
+	return k is not None and k in self.index
+
+    __contains__ = has_key
+
+    # Returns the list of (row number, row) for key.
+    def __getitem__(self, key):
+	v = self.index[self.keyString(key)]
+	if type(v) is types.IntType:
+	    return [(v, self.row(v))]
+	return [(i, self.row(i)) for i in v]
+
+    def __setitem__(self, i, value):
+	self.seen[i >> 3] |= 1 << (i & 7)
+
+    def __iter__(self):
+	seen = self.seen
+	for i in xrange(len(self.offsets) - 1):
+	    if seen[i >> 3] & (1 << (i & 7)):
+		yield None
+	    else:
+		yield self.row(i)
+
+#----------------------------------------------------------------------
+# Binning index of the intervals of the inner table, for the
+# interval-overlap join (--i1/--i2). An interval goes in the
+# smallest bin that holds it: at level l, bin b holds the
+# coordinates whose value >> (OVERLAP_MIN_SHIFT+l*OVERLAP_LEVEL_SHIFT)
+# is b. Each bin's list of (start, end, row number, row) is
+# sorted by start once all the rows are added, so a lookup can
+# stop at the first interval starting after the end of its own.
+#
+class IntervalIndex:
+    def __init__(self):
+	self.bins = {}
+	self.nlevels = 0
+	self.nrows = 0
+
+    def add(self, key, start, end, row):
+	level = 0
+	shift = OVERLAP_MIN_SHIFT
+	while start >> shift != end >> shift:
+	    level += 1
+	    shift += OVERLAP_LEVEL_SHIFT
+	self.nlevels = max(self.nlevels, level + 1)
+	b = (key, level, start >> shift)
+	item = (start, end, self.nrows, row)
+	if b in self.bins:
+	    self.bins[b].append(item)
+	else:
+	    self.bins[b] = [item]
+	self.nrows += 1
+
+    def sort(self):
+	for items in self.bins.itervalues():
+	    items.sort()
+
+    # Returns the list of (row number, row) of the intervals that
+    # overlap start..end and have the given key, in row order.
+    def lookup(self, key, start, end):
+	found = []
+	bins = self.bins
+	shift = OVERLAP_MIN_SHIFT
+	for level in xrange(self.nlevels):
+	    for b in xrange(start >> shift, (end >> shift) + 1):
+		items = bins.get((key, level, b))
+		if items is None:
+		    continue
+		for (s, e, i, row) in items:
+		    if s > end:
+			break
+		    if e >= start:
+			found.append((i, row))
+	    shift += OVERLAP_LEVEL_SHIFT
+	found.sort()
+	return found
+
+#----------------------------------------------------------------------
+# Writes rows to the file fname, in marshalled batches (as
+# spillRows does), and returns its name.
+#
+def writeSpillFile(fname, rows):
+    fd = open(fname, 'wb')
+    batch = []
+    for row in rows:
+	batch.append(row)
+	if len(batch) == SPILL_BATCH_ROWS:
+	    marshal.dump(batch, fd)
+	    batch = []
+    if batch:
+	marshal.dump(batch, fd)
+    fd.close()
+    return fname
+
+#----------------------------------------------------------------------
+# Parallel join worker. Joins the p'th pair of partition files,
+# writing the output rows to a file. Returns its name.
+#
+# If tagged, the file must be in (seq, part, k) order (see
+# probeInner). A pair that had to be repartitioned gives a run
+# of rows in that order for each of its sub-partitions; each
+# run is written to a file, and the runs are merged.
+#
+def joinPartitionFiles(args):
+    (f1, f2, tagged, p) = args
+    tj = PARALLEL_JOIN
+    fname = f1 + ".out"
+    if not tagged:
+	return writeSpillFile(fname, tj.joinPartitions([f1], [f2], 1))
+    runs = []
+    rows = tj.joinPartitions([f1], [f2], 1, True, (p,))
+    for (part, run) in itertools.groupby(rows, operator.itemgetter(1)):
+	runs.append(writeSpillFile("%s.%d" % (fname, len(runs)), run))
+    if len(runs) == 1:
+	os.rename(runs[0], fname)
+	return fname
+    writeSpillFile(fname, heapq.merge(*map(tj.spilledRows, runs)))
+    for r in runs:
+	os.remove(r)
+    return fname
 
 class TJoin( TableTool ):
     USAGE=__doc__
@@ -60,6 +467,8 @@ class TJoin( TableTool ):
 
 	self.jcols1 = []
 	self.jcols2 = []
+	self.icols1 = []
+	self.icols2 = []
 
         self.ncols1 = 0
         self.ncols2 = 0
@@ -68,8 +477,17 @@ class TJoin( TableTool ):
 	self.doRightOuter = False
 
 	self.swappedInputs = False
-	self.selfJoin = False
 	self.inner = None
+	self.outputParts = []
+	self.filters = []
+	self.filterConds = []
+	self.filterContext = {}
+	self.matcher = None
+	self.useMerge = False
+	self.memoryLimit = 0
+	self.spillDir = None
+	self.spillCount = 0
+	self.spillWidth = 0
 
 	TableTool.__init__(self,2,argv)
 
@@ -92,6 +510,17 @@ class TJoin( TableTool ):
             separated list of column numbers or simply repeat the --k2 option.
             (Remember, column numbers start at 0!)''')
 
+	self.parser.add_option("--i1", dest="i1",
+	    action="append", default = [],
+	    metavar="START,END",
+	    help='''Specifies the T1 columns holding the start and end of an interval.
+            Joins rows whose intervals overlap (and whose --k1/--k2 columns are equal).''')
+
+	self.parser.add_option("--i2", dest="i2",
+	    action="append", default = [],
+	    metavar="START,END",
+	    help='''Specifies the T2 columns holding the start and end of an interval.''')
+
 	self.parser.add_option("-c", "--columns", dest="ocols",
 	    action="append", default = [],
 	    metavar="COLUMN(S)",
@@ -118,6 +547,54 @@ class TJoin( TableTool ):
 	    action="store", default = "", metavar="NULLSTR",
 	    help="Specifies string to use for NULL values output but left/right outer joins. (Default: empty string)")
 
+	self.parser.add_option("--sorted", dest="sorted",
+	    action="store_true", default = False,
+	    help='''Both inputs are sorted on their join columns. Performs a merge join,
+            which streams both inputs instead of loading T2 into memory. (Default: No)''')
+
+	self.parser.add_option("--memory", dest="memory",
+	    type="float", default = 0, metavar="MB",
+	    help='''Memory budget for the in-memory copy of T2. If T2 is larger, both inputs
+            are partitioned into temporary files and joined a partition at a time.
+            (Default: 0, no limit)''')
+
+	self.parser.add_option("--partitions", dest="partitions",
+	    type="int", default = 16, metavar="N",
+	    help="Number of partitions per level when the memory budget is exceeded. (Default: 16)")
+
+	self.parser.add_option("-P", "--parallel", dest="nprocs",
+	    type="int", default = 1, metavar="N",
+	    help="Join partitions of the inputs in N worker processes. (Default: 1)")
+
+	self.parser.add_option("--unordered", dest="unordered",
+	    action="store_true", default = False,
+	    help="With -P, output rows as partitions finish, rather than in outer input order. (Default: No)")
+
+	self.parser.add_option("--no-semijoin", dest="semijoin",
+	    action="store_false", default = True,
+	    help="Do not push a test of the join key (or Bloom filter) down into T1's reader.")
+
+	self.parser.add_option("--index", dest="useIndex",
+	    action="store_true", default = False,
+	    help="Look up T2's rows in its key index (FILE.kCOLS.deftkey) instead of loading T2; " + \
+	         "the index is built if missing or out of date. (Default: No)")
+
+	self.parser.add_option("--compact", dest="compact",
+	    action="store_true", default = False,
+	    help="Store T2's rows compactly in memory, and split them only when they match. (Default: No)")
+
+	self.parser.add_option("--inner", dest="inner",
+	    default = "auto", metavar="auto|1|2",
+	    help="Input to load into the hash table. auto picks the smaller (estimated). (Default: auto)")
+
+	self.parser.add_option("-v", "--verbose", dest="verbose",
+	    action="store_true", default = False,
+	    help="Report which input is hashed, and why.")
+
+	self.parser.add_option("--tmp-dir", dest="tmpDir",
+	    default = None, metavar="DIR",
+	    help="Directory for temporary partition files. (Default: system temporary directory)")
+
     #---------------------------------------------------------
     #
     def processOptions(self):
@@ -137,6 +614,29 @@ class TJoin( TableTool ):
 	self.doLeftOuter = self.options.dlo
 	self.doRightOuter = self.options.dro
 
+	self.useMerge = self.options.sorted
+	if self.useMerge and njc1 == 0:
+	    self.parser.error("--sorted requires join columns (--k1/--k2).")
+
+	self.memoryLimit = int(self.options.memory * 1024 * 1024)
+	if self.options.inner not in ["auto", "1", "2"]:
+	    self.parser.error("--inner must be auto, 1 or 2.")
+	if self.options.partitions < 2:
+	    self.parser.error("--partitions must be at least 2.")
+	if self.options.nprocs > 1 and (self.useMerge or njc1 == 0):
+	    self.parser.error("-P requires join columns, and cannot be used with --sorted.")
+	if self.options.useIndex and (self.useMerge or njc1 == 0 or self.options.nprocs > 1):
+	    self.parser.error("--index requires join columns, and cannot be used with --sorted or -P.")
+
+	if len(self.options.i1) > 0 or len(self.options.i2) > 0:
+	    self.icols1 = self.parseIntList(self.options.i1)
+	    self.icols2 = self.parseIntList(self.options.i2)
+	    if len(self.icols1) != 2 or len(self.icols2) != 2:
+		self.parser.error("--i1 and --i2 must each specify two columns (START,END).")
+	    if self.useMerge or self.memoryLimit or self.options.useIndex \
+	    or self.options.nprocs > 1:
+		self.parser.error("--i1/--i2 cannot be used with --sorted, --memory, --index or -P.")
+
         # matches array access syntax for r1 and r2, e.g., 
         #  r1[0]
         #  r2[1:4]
@@ -145,19 +645,206 @@ class TJoin( TableTool ):
         rex= re.compile(r'^r[12](\[(-?\d+)?:?(-?\d+)?\])?$')
         parts = []
         for oc in self.args:
+            if oc.startswith("?"):
+                self.filters.append(oc)
+                continue
             tokens = oc.strip().split()
             for t in tokens:
                 m = rex.match(t)
                 if not m:
                     self.parser.error("Syntax error in column spec.")
+                self.outputParts.append((int(t[1]), m.group(1), m.group(2), m.group(3)))
                 if "[" in t and ":" not in t:
                     parts.append("[%s]"%t)
                 else:
                     parts.append(t)
         if len(parts) == 0:
             parts = ['r1','r2']
+            self.outputParts = [(1,None,None,None), (2,None,None,None)]
         expr = "lambda r1, r2: " + "+".join(parts)
         self.fun = eval(expr)
+        self.compileFilters()
+	if self.filters and njc1 == 0 and not self.icols1 \
+	and (self.memoryLimit or self.options.compact):
+	    self.parser.error("A join without --k1/--k2 on filters cannot use --memory or --compact.")
+
+    #---------------------------------------------------------
+    # Parses the filters, and splits them into the list of
+    # conditions (parts joined by 'and') that a pair of rows
+    # must all pass.
+    #
+    def compileFilters(self):
+	exec("import sys\nimport string\nimport re\nimport math\n", self.filterContext)
+	for f in self.filters:
+	    try:
+		tree = ast.parse(f[1:].strip(), mode='eval')
+	    except SyntaxError:
+		self.parser.error("Syntax error in filter: " + f)
+	    if isinstance(tree.body, ast.BoolOp) and isinstance(tree.body.op, ast.And):
+		self.filterConds += tree.body.values
+	    else:
+		self.filterConds.append(tree.body)
+
+    #---------------------------------------------------------
+    # Returns the names of the outer and inner rows in the
+    # filters: r1 and r2, unless the inputs were swapped.
+    #
+    def rowNames(self):
+	if self.swappedInputs:
+	    return ("r2", "r1")
+	return ("r1", "r2")
+
+    #---------------------------------------------------------
+    # Compiles conditions (default: all the filters') into a
+    # function of an outer row and a list of (i, inner row)
+    # pairs, that returns the list of the pairs whose rows pass
+    # them all. The loop over the pairs is a list comprehension
+    # inside the function, so testing a whole key group (or the
+    # inner table of a theta join) is one call. Returns None if
+    # there are no conditions.
+    #
+    def compileMatcher(self, conds=None):
+	if conds is None:
+	    conds = self.filterConds
+	if len(conds) == 0:
+	    return None
+	(outer, inner) = self.rowNames()
+	tree = ast.parse("lambda %s, _pairs: [(_i, %s) for (_i, %s) in _pairs if _test]" % \
+	    (outer, inner, inner), mode='eval')
+	if len(conds) == 1:
+	    test = conds[0]
+	else:
+	    test = ast.BoolOp(op=ast.And(), values=conds)
+	tree.body.body.generators[0].ifs = [test]
+	ast.fix_missing_locations(tree)
+	return eval(compile(tree, "<filter>", "eval"), self.filterContext)
+
+    #---------------------------------------------------------
+    # Returns the function of a row (named name) computed by
+    # expression node expr.
+    #
+    def compileRowFunction(self, name, expr):
+	tree = ast.parse("lambda %s: _expr" % name, mode='eval')
+	tree.body.body = expr
+	ast.fix_missing_locations(tree)
+	return eval(compile(tree, "<filter>", "eval"), self.filterContext)
+
+    #---------------------------------------------------------
+    # Theta join. Finds the filter conditions that compare an
+    # expression of the outer row with an expression of the
+    # inner row (<, <=, >, >=), each rewritten as "outer op
+    # inner". An integer added to or subtracted from the inner
+    # expression is moved to the outer side (so that, e.g.,
+    # int(r2[1]) < int(r1[1])+100 gives the same inner expression
+    # as r1 <= ... does). Returns (inner expression, conditions),
+    # for the inner expression with the most conditions, where
+    # each condition is (outer expression, op, cond); or None if
+    # there are none.
+    #
+    def rangeConditions(self):
+	(outer, inner) = self.rowNames()
+	def rowsUsed(node):
+	    return set([n.id for n in ast.walk(node) \
+		if isinstance(n, ast.Name) and n.id in ["r1", "r2"]])
+	def isInt(node):
+	    return (isinstance(node, ast.Num) and type(node.n) in [types.IntType, types.LongType]) \
+		or (isinstance(node, ast.Call) and isinstance(node.func, ast.Name) \
+		and node.func.id in ["int", "long"])
+	found = {}
+	for c in self.filterConds:
+	    if not isinstance(c, ast.Compare) or len(c.ops) != 1 \
+	    or type(c.ops[0]) not in RANGE_OPS:
+		continue
+	    (left, op, right) = (c.left, type(c.ops[0]), c.comparators[0])
+	    if rowsUsed(left) == set([inner]) and rowsUsed(right) <= set([outer]):
+		(left, op, right) = (right, RANGE_OPS[op], left)
+	    elif not rowsUsed(left) <= set([outer]) or rowsUsed(right) != set([inner]):
+		continue
+	    while isinstance(right, ast.BinOp) and type(right.op) in [ast.Add, ast.Sub]:
+		(a, b) = (right.left, right.right)
+		if rowsUsed(b) == set([inner]) and isinstance(right.op, ast.Add):
+		    (a, b) = (b, a)
+		if rowsUsed(a) != set([inner]) or not rowsUsed(b) <= set([outer]) \
+		or not (isInt(a) and isInt(b)):
+		    break
+		inverse = isinstance(right.op, ast.Add) and ast.Sub() or ast.Add()
+		(left, right) = (ast.BinOp(left=left, op=inverse, right=b), a)
+	    k = ast.dump(right)
+	    if k not in found:
+		found[k] = (right, [])
+	    found[k][1].append((left, op, c))
+	if len(found) == 0:
+	    return None
+	return max(found.values(), key=lambda f: len(f[1]))
+
+    #---------------------------------------------------------
+    # Input n is needed for its join columns plus any columns
+    # named explicitly in the column spec. A spec that outputs
+    # a whole row, or uses an open or negative slice, needs all
+    # the columns.
+    #
+    def inputColumns(self, n, needed):
+	cols = [[self.jcols1, self.jcols2][n-1], [self.icols1, self.icols2][n-1]]
+	for f in self.filters:
+	    cols.append(exprColumns(f, "r%d" % n))
+	for (rn, brackets, lo, hi) in self.outputParts:
+	    if rn != n:
+		continue
+	    if brackets is None:
+		return None
+	    if ":" not in brackets:
+		if lo is None or int(lo) < 0:
+		    return None
+		cols.append([int(lo)])
+	    else:
+		if lo is None:
+		    lo = "0"
+		if hi is None or int(lo) < 0 or int(hi) < 0:
+		    return None
+		cols.append(range(int(lo), int(hi)))
+	return self.unionColumns(*cols)
+
+    #---------------------------------------------------------
+    # A self-join reads its input once, as both T1 and T2, so
+    # the columns either side needs are pushed down to both.
+    #
+    def pushProjection(self, needed):
+	if self.sameInputs():
+	    cols = self.unionColumns(self.inputColumns(1, needed), self.inputColumns(2, needed))
+	    self.t1.pushProjection(cols)
+	    if self.t2 is not self.t1:
+		self.t2.pushProjection(cols)
+	    return
+	TableTool.pushProjection(self, needed)
+
+    #---------------------------------------------------------
+    # Sort order. If both inputs are known to be sorted on the
+    # join columns, uses a merge join (as --sorted), unless
+    # given options it cannot be used with.
+    #
+    def useSortOrder(self):
+	TableTool.useSortOrder(self)
+	if self.useMerge or self.options.nprocs > 1 or self.options.useIndex or self.icols1:
+	    return
+	if self.isSortedOn(self.t1, self.jcols1) and self.isSortedOn(self.t2, self.jcols2):
+	    self.useMerge = True
+
+    #---------------------------------------------------------
+    # Self-join. Returns True if T1 and T2 are the same input:
+    # the same table, or TReads of the same file (or both of
+    # stdin) with the same options.
+    #
+    def sameInputs(self):
+	from TRead import TRead
+	(t1, t2) = (self.t1, self.t2)
+	if isinstance(t1, Prefetcher):
+	    t1 = t1.table
+	if isinstance(t2, Prefetcher):
+	    t2 = t2.table
+	if t1 is t2:
+	    return True
+	return isinstance(t1, TRead) and isinstance(t2, TRead) \
+	    and vars(t1.options) == vars(t2.options)
 
     #---------------------------------------------------------
     # Decide who's inner and who's outer. The inner
@@ -170,30 +857,151 @@ class TJoin( TableTool ):
     #
     def pickInnerOuter(self):
 	self.swappedInputs = False
-	self.selfJoin = (self.t1.fileDesc == self.t2.fileDesc)
-	if self.selfJoin:
-	    return 
-
-	t1sz = self.t1.fileSize()
-	t2sz = self.t2.fileSize()
-	if t1sz != -1 and (t2sz == -1 or t1sz < t2sz):
-	    #self.debug("Swapping input tables.")
+	choice = self.options.inner
+	if choice == "auto":
+	    f1 = self.inputFile(self.t1)
+	    if f1 is not None and f1 == self.inputFile(self.t2):
+		if self.options.verbose:
+		    self.debug("tj: T1 and T2 are the same file; hashing T2.")
+		return
+	    est1 = self.estimateInput(1)
+	    est2 = self.estimateInput(2)
+	    # T1 is hashed only if it is known to be smaller; an
+	    # estimate that is only a lower bound cannot show that
+	    choice = "2"
+	    if est1 is not None and est2 is not None and est1[1] != AT_LEAST \
+	    and est1[0] < est2[0]:
+		choice = "1"
+	    if self.options.verbose:
+		self.debug("tj: estimated memory to hash T1: %s, T2: %s; hashing T%s." % \
+		    (self.describeEstimate(est1), self.describeEstimate(est2), choice))
+	if choice == "1":
 	    self.swappedInputs = True
 	    self.t1,self.t2 = self.t2,self.t1
 	    self.jcols1,self.jcols2 = self.jcols2,self.jcols1
+	    self.icols1,self.icols2 = self.icols2,self.icols1
 	    self.doLeftOuter,self.doRightOuter = self.doRightOuter,self.doLeftOuter
 
     #---------------------------------------------------------
-    def loadInner(self):
-	#self.pickInnerOuter()
+    def describeEstimate(self, est):
+	if est is None:
+	    return "unknown"
+	return "%s %d bytes" % (est[1], est[0])
+
+    #---------------------------------------------------------
+    # Returns the name of the file an input reads directly,
+    # or None.
+    #
+    def inputFile(self, t):
+	reader = self.fileReader(t)
+	if reader is None:
+	    return None
+	return reader.options.filename
+
+    #---------------------------------------------------------
+    # Estimates the memory needed to hash nrows rows, like
+    # the given sample rows, having the given join columns.
+    #
+    def estimateMemory(self, rows, nrows, jcols):
+	if len(rows) == 0:
+	    return 0
+	nbytes = 0
+	ncols = 0
+	keys = set()
+	for r in rows:
+	    nbytes += sum(map(len, r))
+	    ncols += len(r)
+	    keys.add(self.makeKey(r, jcols))
+	n = float(len(rows))
+	perRow = ROW_OVERHEAD + COLUMN_OVERHEAD*ncols/n + nbytes/n + \
+	    KEY_OVERHEAD*len(keys)/n
+	return int(nrows * perRow)
+
+    #---------------------------------------------------------
+    # Returns (estimated memory to hash input n, kind), where
+    # kind is EXACT, ESTIMATE or AT_LEAST, or None if nothing
+    # can be said. An input file is sampled
+    # at the start; any other input is read ahead up to
+    # SAMPLE_ROWS rows (which are put back in front of it).
+    #
+    def estimateInput(self, n):
+	t = [self.t1, self.t2][n-1]
+	jcols = [self.jcols1, self.jcols2][n-1]
+	fname = self.inputFile(t)
+	if fname is not None:
+	    return self.estimateFile(t, fname, jcols)
+	it = iter(t)
+	rows = list(itertools.islice(it, SAMPLE_ROWS))
+	t = itertools.chain(rows, it)
+	if n == 1:
+	    self.t1 = t
+	else:
+	    self.t2 = t
+	if len(rows) < SAMPLE_ROWS:
+	    return (self.estimateMemory(rows, len(rows), jcols), EXACT)
+	return (self.estimateMemory(rows, len(rows), jcols), AT_LEAST)
+
+    #---------------------------------------------------------
+    def estimateFile(self, t, fname, jcols):
+	try:
+	    size = os.stat(fname).st_size
+	    fd = open(fname, 'rb')
+	    fmt = compression.detectFormat(fd.read(compression.MAGIC_LEN))
+	    fd.seek(0)
+	    if fmt is not None:
+		size *= COMPRESSION_RATIO
+		fd = compression.DecompressingReader(fd, fmt)
+	    sample = fd.read(SAMPLE_BYTES)
+	    fd.close()
+	except (IOError, OSError, ImportError):
+	    return None
+	lines = sample.split(NL)
+	if len(sample) == SAMPLE_BYTES:
+	    lines.pop()		# probably incomplete
+	com = t.commentChar
+	rows = [l.split(t.separatorChar) for l in lines if l and not l.startswith(com)]
+	rows = [r for r in rows if len(r) > max(jcols + [-1])]
+	if len(sample) < SAMPLE_BYTES:
+	    return (self.estimateMemory(rows, len(rows), jcols), EXACT)
+	if len(rows) == 0:
+	    return None
+	index = lineindex.LineIndex(fname, commentChar=com)
+	if fmt is None and index.load():
+	    nrows = index.nrows
+	else:
+	    nrows = size * len(rows) / max(1, len(sample))
+	return (self.estimateMemory(rows, nrows, jcols), ESTIMATE)
+
+    #---------------------------------------------------------
+    # Loads rows (default: self.t2) into the hash table. If a
+    # budget (in bytes) is given and the rows outgrow it, stops
+    # and returns an iterator over the rows not yet loaded.
+    # Otherwise, returns None.
+    #
+    def loadInner(self, rows=None, budget=0):
 	# at this point, self.t2 is the inner, self.t1 is the outer
-	self.inner = { }
-	if self.doRightOuter:
-	    self.innerList=[]
+	if rows is None:
+	    rows = self.t2
+	compact = self.options.compact
+	if compact:
+	    self.inner = CompactInner()
+	    if self.doRightOuter:
+		self.innerList = self.inner
+	else:
+	    self.inner = { }
+	    if self.doRightOuter:
+		self.innerList=[]
 
-        for i,row in enumerate(self.t2):
+	size = 0
+	rows = iter(rows)
+        for i,row in enumerate(rows):
             self.ncols2 = len(row)
 	    key = self.makeKey(row, self.jcols2)
+	    if compact:
+		size += self.inner.add(key, row)
+		if budget and size > budget:
+		    return rows
+		continue
 	    if not self.inner.has_key(key):
 		self.inner[key] = [(i,row)]
 	    else:
@@ -202,6 +1010,549 @@ class TJoin( TableTool ):
 	    if self.doRightOuter:
 		self.innerList.append(row)
 
+	    if budget:
+		size += ROW_OVERHEAD + COLUMN_OVERHEAD*len(row) + sum(map(len, row))
+		if size > budget:
+		    return rows
+	return None
+
+    #---------------------------------------------------------
+    # Joins the rows of outer against the hash table. Rows
+    # of the inner table that were never matched are output
+    # at the end, for a right-outer join.
+    #
+    # If tagged, outer generates (seq, row) pairs, and each
+    # output row is generated as (seq, part, k, row), where part
+    # identifies the partition being joined and k counts its
+    # output rows; unmatched inner rows get seq=sys.maxint.
+    # (Used to restore the outer order in a parallel join: in
+    # (seq, part, k) order, the rows come in outer order, then
+    # the unmatched inner rows, a partition at a time.)
+    #
+    def probeInner(self, outer, tagged=False, part=None):
+	k = 0
+	seq = None
+	for outerrow in outer:
+	    if tagged:
+		(seq, outerrow) = outerrow
+	    self.ncols1 = len(outerrow)
+	    key = self.makeKey(outerrow, self.jcols1)
+	    innerRows = None
+	    if self.inner.has_key(key):
+		innerRows = self.inner[key]
+		if self.matcher is not None:
+		    innerRows = self.matcher(outerrow, innerRows)
+	    if innerRows:
+		for i,innerrow in innerRows:
+		    if tagged:
+			yield (seq, part, k, self.processPair(outerrow,innerrow))
+			k += 1
+		    else:
+			yield self.processPair(outerrow,innerrow)
+		    if self.doRightOuter:
+			self.innerList[ i ] = None
+	    elif self.doLeftOuter:
+		if tagged:
+		    yield (seq, part, k, self.processPair(outerrow, None))
+		    k += 1
+		else:
+		    yield self.processPair(outerrow, None)
+	if self.doRightOuter:
+	    for r in self.innerList:
+		if r is None:
+		    continue
+		if tagged:
+		    yield (sys.maxint, part, k, self.processPair(None, r))
+		    k += 1
+		else:
+		    yield self.processPair(None, r)
+
+    #---------------------------------------------------------
+    # Semi-join reduction. Pushes test, a function of a join
+    # key that is false for keys with no match in T2, down
+    # into T1, if T1 is a TRead (possibly behind a Prefetcher
+    # that has not started reading) and all of its rows are
+    # not needed anyway.
+    #
+    def pushSemiJoin(self, test):
+	from TRead import TRead
+	t1 = self.t1
+	if isinstance(t1, Prefetcher) and not t1.started():
+	    t1 = t1.table
+	if self.options.semijoin and not self.doLeftOuter \
+	and isinstance(t1, TRead):
+	    t1.pushFilter(self.jcols1, test)
+
+    #---------------------------------------------------------
+    # Semi-join reduction for a partitioned join. Builds a
+    # Bloom filter of the hashes of T2's keys (as computed by
+    # spillRows), and pushes it down into T1.
+    #
+    def pushBloomFilter(self, hashes):
+	bloom = BloomFilter(len(hashes))
+	for h in hashes:
+	    bloom.add(h)
+	self.pushSemiJoin(lambda key: hash(key) in bloom)
+
+    #---------------------------------------------------------
+    # Grace hash join. Removes the rows loaded so far from the
+    # hash table, and returns them in their original order.
+    # (Compact rows are generated, and split one at a time.)
+    #
+    def unloadInner(self):
+	if isinstance(self.inner, CompactInner):
+	    rows = iter(self.inner)
+	else:
+	    loaded = sorted(itertools.chain.from_iterable(self.inner.itervalues()))
+	    rows = [row for (i,row) in loaded]
+	self.inner = None
+	self.innerList = None
+	return rows
+
+    #---------------------------------------------------------
+    # Grace hash join. Writes rows to n partition files (in
+    # the temporary directory) according to the hash of their
+    # key columns. Each level of repartitioning uses different
+    # bits of the hash, so that it splits the keys differently
+    # from the level above. (Salting the hash does not work:
+    # tuple hashing leaves the low bits of hash((level,)+key)
+    # determined by those of hash(key).) Returns the
+    # list of file names, and sets spillWidth to the width of
+    # the last row (0 if there are none). If tagged, rows are
+    # (seq, row) pairs. If hashes (an array) is given, each
+    # row's hash is appended.
+    #
+    def spillRows(self, rows, jcols, n, level, tag, tagged=False, hashes=None):
+	if self.spillDir is None:
+	    self.spillDir = tempfile.mkdtemp(prefix="tj", dir=self.options.tmpDir)
+	    atexit.register(shutil.rmtree, self.spillDir, True)
+	# (the pid keeps names unique among parallel join workers)
+	base = os.path.join(self.spillDir, "%s%d_%d" % (tag, os.getpid(), self.spillCount))
+	self.spillCount += 1
+	fnames = ["%s.%d" % (base, p) for p in range(n)]
+	fds = [open(f, 'wb') for f in fnames]
+	buffers = [[] for p in range(n)]
+	self.spillWidth = 0
+	for row in rows:
+	    r = tagged and row[1] or row
+	    self.spillWidth = len(r)
+	    h = hash(self.makeKey(r, jcols))
+	    if hashes is not None:
+		hashes.append(h)
+	    p = (h >> (10*level)) % n
+	    b = buffers[p]
+	    b.append(row)
+	    if len(b) == SPILL_BATCH_ROWS:
+		marshal.dump(b, fds[p])
+		buffers[p] = []
+	for p in range(n):
+	    if buffers[p]:
+		marshal.dump(buffers[p], fds[p])
+	    fds[p].close()
+	return fnames
+
+    #---------------------------------------------------------
+    # Grace hash join. Generates the rows of a partition file.
+    #
+    def spilledRows(self, fname):
+	fd = open(fname, 'rb')
+	try:
+	    while True:
+		try:
+		    rows = marshal.load(fd)
+		except EOFError:
+		    break
+		for row in rows:
+		    yield row
+	finally:
+	    fd.close()
+
+    #---------------------------------------------------------
+    # Grace hash join. Called with part of T2 in the hash
+    # table, and rest the remaining rows of T2. Partitions
+    # both inputs, and joins each pair of partitions.
+    #
+    def graceJoin(self, rest):
+	n = self.options.partitions
+	self.debug("tj: T2 exceeds the memory budget; joining in %d partitions." % n)
+	try:
+	    inner = itertools.chain(self.unloadInner(), rest)
+	    hashes = array.array('l')
+	    files2 = self.spillRows(inner, self.jcols2, n, 0, "t2_", False, hashes)
+	    self.ncols2 = self.spillWidth
+	    self.pushBloomFilter(hashes)
+	    hashes = None
+	    files1 = self.spillRows(self.t1, self.jcols1, n, 0, "t1_")
+	    self.ncols1 = self.spillWidth
+	    for row in self.joinPartitions(files1, files2, 1):
+		yield row
+	finally:
+	    self.removeSpillDir()
+
+    #---------------------------------------------------------
+    def removeSpillDir(self):
+	if self.spillDir is not None:
+	    shutil.rmtree(self.spillDir, True)
+	    self.spillDir = None
+
+    #---------------------------------------------------------
+    # Grace hash join. Joins corresponding partition files
+    # of T1 and T2, repartitioning (at the given level) any
+    # pair whose T2 part is over budget. Each file is removed
+    # once it has been read. (For tagged, see probeInner; part
+    # identifies the partition the files are the parts of, and
+    # each pair's is part plus its index.)
+    #
+    def joinPartitions(self, files1, files2, level, tagged=False, part=()):
+	n = self.options.partitions
+	for (i, (f1, f2)) in enumerate(zip(files1, files2)):
+	    rest = self.loadInner(self.spilledRows(f2), self.memoryLimit)
+	    if rest is not None:
+		if level < MAX_SPILL_DEPTH:
+		    inner = itertools.chain(self.unloadInner(), rest)
+		    sub2 = self.spillRows(inner, self.jcols2, n, level, "t2_")
+		    os.remove(f2)
+		    sub1 = self.spillRows(self.spilledRows(f1), self.jcols1, n, level, "t1_", tagged)
+		    os.remove(f1)
+		    for row in self.joinPartitions(sub1, sub2, level+1, tagged, part + (i,)):
+			yield row
+		    continue
+		self.debug("tj: WARNING: partition still exceeds the memory budget " + \
+		    "after %d levels; joining it in memory." % level)
+		inner = itertools.chain(self.unloadInner(), rest)
+		self.loadInner(inner)
+	    os.remove(f2)
+	    for row in self.probeInner(self.spilledRows(f1), tagged, part + (i,)):
+		yield row
+	    os.remove(f1)
+	    self.inner = None
+	    self.innerList = None
+
+    #---------------------------------------------------------
+    # Parallel join. Partitions both inputs (T1's rows tagged
+    # with their sequence numbers unless --unordered), and has
+    # a pool of worker processes join the pairs of partitions.
+    # Each worker writes its output to a file; the files are
+    # read back as they are finished (--unordered), or merged
+    # on sequence number once all are done.
+    #
+    def parallelJoin(self):
+	global PARALLEL_JOIN
+	import multiprocessing
+	nprocs = self.options.nprocs
+	n = max(self.options.partitions, 2*nprocs)
+	tagged = not self.options.unordered
+	pool = None
+	try:
+	    hashes = array.array('l')
+	    files2 = self.spillRows(self.t2, self.jcols2, n, 0, "t2_", False, hashes)
+	    self.ncols2 = self.spillWidth
+	    self.pushBloomFilter(hashes)
+	    hashes = None
+	    outer = self.t1
+	    if tagged:
+		outer = enumerate(outer)
+	    files1 = self.spillRows(outer, self.jcols1, n, 0, "t1_", tagged)
+	    self.ncols1 = self.spillWidth
+	    PARALLEL_JOIN = self
+	    pool = multiprocessing.Pool(nprocs)
+	    args = [(f1, f2, tagged, p) for (p, (f1, f2)) in enumerate(zip(files1, files2))]
+	    if tagged:
+		outputs = pool.map(joinPartitionFiles, args, 1)
+		for (seq, part, k, row) in heapq.merge(*map(self.spilledRows, outputs)):
+		    yield row
+	    else:
+		for fname in pool.imap_unordered(joinPartitionFiles, args):
+		    for row in self.spilledRows(fname):
+			yield row
+		    os.remove(fname)
+	finally:
+	    PARALLEL_JOIN = None
+	    if pool is not None:
+		pool.terminate()
+		pool.join()
+	    self.removeSpillDir()
+
+    #---------------------------------------------------------
+    # Indexed join. Probes T2's key index with the rows of T1.
+    # For a right-outer join, the offsets of the matched T2
+    # rows are kept, and the rest are output at the end.
+    #
+    def indexJoin(self):
+	reader = self.keyIndexReader()
+	index = keyindex.getKeyIndex(reader.options.filename, self.jcols2,
+		    reader.separatorChar, reader.commentChar, self.debug)
+	try:
+	    self.ncols2 = index.ncols
+	    self.pushSemiJoin(index.mayContain)
+	    seen = set()
+	    for outerrow in self.t1:
+		self.ncols1 = len(outerrow)
+		innerRows = index.lookup(self.makeKey(outerrow, self.jcols1))
+		if innerRows and self.matcher is not None:
+		    innerRows = self.matcher(outerrow, innerRows)
+		if innerRows:
+		    for pos,innerrow in innerRows:
+			yield self.processPair(outerrow,innerrow)
+			if self.doRightOuter:
+			    seen.add(pos)
+		elif self.doLeftOuter:
+		    yield self.processPair(outerrow, None)
+	    if self.doRightOuter:
+		for pos,r in index.scanRows():
+		    if pos not in seen:
+			yield self.processPair(None, r)
+	finally:
+	    index.close()
+
+    #---------------------------------------------------------
+    # Returns the (start, end) of row's interval, given the
+    # columns holding them. n (1 or 2) names the table in
+    # the error raised if they are not integers.
+    #
+    def interval(self, row, icols, n):
+	try:
+	    return (int(row[icols[0]]), int(row[icols[1]]))
+	except ValueError:
+	    if self.swappedInputs:
+		n = 3 - n
+	    raise RuntimeError("T%d: interval coordinates are not integers: %s" % \
+		(n, TAB.join(row)))
+
+    #---------------------------------------------------------
+    # Interval-overlap join. Loads the inner table into an
+    # IntervalIndex, then looks up the interval of each row
+    # of the outer. For a right-outer join, matched inner rows
+    # are marked, and the rest are output at the end.
+    #
+    def overlapJoin(self):
+	index = IntervalIndex()
+	inner = []
+	for row in self.t2:
+	    self.ncols2 = len(row)
+	    (start, end) = self.interval(row, self.icols2, 2)
+	    index.add(self.makeKey(row, self.jcols2), start, end, row)
+	    if self.doRightOuter:
+		inner.append(row)
+	index.sort()
+	if len(self.jcols1) > 0:
+	    keys = set([b[0] for b in index.bins])
+	    self.pushSemiJoin(keys.__contains__)
+	for outerrow in self.t1:
+	    self.ncols1 = len(outerrow)
+	    (start, end) = self.interval(outerrow, self.icols1, 1)
+	    innerRows = index.lookup(self.makeKey(outerrow, self.jcols1), start, end)
+	    if innerRows and self.matcher is not None:
+		innerRows = self.matcher(outerrow, innerRows)
+	    if innerRows:
+		for i,innerrow in innerRows:
+		    yield self.processPair(outerrow, innerrow)
+		    if self.doRightOuter:
+			inner[i] = None
+	    elif self.doLeftOuter:
+		yield self.processPair(outerrow, None)
+	if self.doRightOuter:
+	    for r in inner:
+		if r is not None:
+		    yield self.processPair(None, r)
+
+    #---------------------------------------------------------
+    # Theta join (no key columns, with filters). Loads the inner
+    # rows, and tests each outer row against them with the
+    # compiled filters. If there are range conditions (see
+    # rangeConditions), the inner rows are sorted on the value of
+    # their expression, and only those in the range allowed by
+    # the outer row's values are tested (against the remaining
+    # conditions), and put back in inner order. For a right-outer
+    # join, matched inner rows are recorded, and the rest are
+    # output at the end.
+    #
+    def thetaJoin(self, outer, inner):
+	rows = []
+	for row in inner:
+	    self.ncols2 = len(row)
+	    rows.append(row)
+	pairs = list(enumerate(rows))
+	conds = self.filterConds
+	ranges = self.rangeConditions()
+	if ranges is not None:
+	    (innerExpr, rconds) = ranges
+	    value = self.compileRowFunction(self.rowNames()[1], innerExpr)
+	    pairs = sorted([(value(r), i, r) for (i, r) in pairs])
+	    values = [v for (v, i, r) in pairs]
+	    pairs = [(i, r) for (v, i, r) in pairs]
+	    bounds = [(self.compileRowFunction(self.rowNames()[0], e), op) for (e, op, c) in rconds]
+	    used = [c for (e, op, c) in rconds]
+	    conds = [c for c in conds if c not in used]
+	match = self.compileMatcher(conds)
+	seen = set()
+	for outerrow in outer:
+	    self.ncols1 = len(outerrow)
+	    innerRows = pairs
+	    if ranges is not None:
+		(lo, hi) = (0, len(values))
+		for (f, op) in bounds:
+		    x = f(outerrow)
+		    if op is ast.Lt:
+			lo = max(lo, bisect.bisect_right(values, x))
+		    elif op is ast.LtE:
+			lo = max(lo, bisect.bisect_left(values, x))
+		    elif op is ast.Gt:
+			hi = min(hi, bisect.bisect_left(values, x))
+		    else:
+			hi = min(hi, bisect.bisect_right(values, x))
+		innerRows = pairs[lo:hi]
+	    if match is not None:
+		innerRows = match(outerrow, innerRows)
+	    if ranges is not None:
+		innerRows.sort()
+	    if innerRows:
+		for i,innerrow in innerRows:
+		    yield self.processPair(outerrow, innerrow)
+		if self.doRightOuter:
+		    seen.update([i for (i, innerrow) in innerRows])
+	    elif self.doLeftOuter:
+		yield self.processPair(outerrow, None)
+	if self.doRightOuter:
+	    for i,r in enumerate(rows):
+		if i not in seen:
+		    yield self.processPair(None, r)
+
+    #---------------------------------------------------------
+    # Merge join. Generates (key, rows) for each run of rows
+    # of table having the same join key. n (1 or 2) names the
+    # table in the error raised if a key is out of order.
+    #
+    def keyGroups(self, table, jcols, n):
+	key = None
+	group = []
+	for i,row in enumerate(table):
+	    k = self.makeKey(row, jcols)
+	    if k == key:
+		group.append(row)
+		continue
+	    if group:
+		if k < key:
+		    raise RuntimeError(("T%d is not sorted on its join columns: " + \
+			"key %s in row %d follows %s.") % (n, k, i+1, key))
+		yield (key, group)
+	    key = k
+	    group = [row]
+	if group:
+	    yield (key, group)
+
+    #---------------------------------------------------------
+    # Merge join. Joins two groups of rows with equal keys, on
+    # the filters. Rows with no match in the other group are
+    # output for an outer join.
+    #
+    def filterGroups(self, g1, g2):
+	pairs = list(enumerate(g2))
+	seen = set()
+	for outerrow in g1:
+	    innerRows = self.matcher(outerrow, pairs)
+	    for i,innerrow in innerRows:
+		yield self.processPair(outerrow, innerrow)
+		seen.add(i)
+	    if not innerRows and self.doLeftOuter:
+		yield self.processPair(outerrow, None)
+	if self.doRightOuter:
+	    for i,innerrow in pairs:
+		if i not in seen:
+		    yield self.processPair(None, innerrow)
+
+    #---------------------------------------------------------
+    # Merge join. Steps through the key groups of both inputs
+    # in step, joining groups with equal keys. Memory is
+    # bounded by the largest group.
+    #
+    def mergeJoin(self):
+	groups1 = self.keyGroups(self.t1, self.jcols1, 1)
+	groups2 = self.keyGroups(self.t2, self.jcols2, 2)
+	(k1, g1) = next(groups1, (None, None))
+	(k2, g2) = next(groups2, (None, None))
+	if g1 is not None:
+	    self.ncols1 = len(g1[0])
+	if g2 is not None:
+	    self.ncols2 = len(g2[0])
+	while g1 is not None and g2 is not None:
+	    if k1 == k2:
+		if self.matcher is None:
+		    for outerrow in g1:
+			for innerrow in g2:
+			    yield self.processPair(outerrow, innerrow)
+		else:
+		    for row in self.filterGroups(g1, g2):
+			yield row
+		(k1, g1) = next(groups1, (None, None))
+		(k2, g2) = next(groups2, (None, None))
+	    elif k1 < k2:
+		if self.doLeftOuter:
+		    for outerrow in g1:
+			yield self.processPair(outerrow, None)
+		(k1, g1) = next(groups1, (None, None))
+	    else:
+		if self.doRightOuter:
+		    for innerrow in g2:
+			yield self.processPair(None, innerrow)
+		(k2, g2) = next(groups2, (None, None))
+	# drain whichever input remains (checking its order)
+	while g1 is not None:
+	    if self.doLeftOuter:
+		for outerrow in g1:
+		    yield self.processPair(outerrow, None)
+	    (k1, g1) = next(groups1, (None, None))
+	while g2 is not None:
+	    if self.doRightOuter:
+		for innerrow in g2:
+		    yield self.processPair(None, innerrow)
+	    (k2, g2) = next(groups2, (None, None))
+
+    #---------------------------------------------------------
+    # Self-join. Reads T1 once, as both inputs. With the same
+    # key columns on both sides, each key group is joined with
+    # itself: groups are streamed from sorted input (--sorted),
+    # or else collected in one scan and output (and freed) in
+    # the order of their first rows. Since every row matches
+    # itself, there are no unmatched rows for an outer join
+    # (unless there are filters). Otherwise, the rows are
+    # hash-joined (or theta-joined) with themselves.
+    #
+    def selfJoin(self):
+	if self.filters and not self.jcols1:
+	    rows = list(self.t1)
+	    for row in self.thetaJoin(rows, rows):
+		yield row
+	    return
+	if self.jcols1 != self.jcols2:
+	    rows = list(self.t1)
+	    self.loadInner(rows)
+	    for row in self.probeInner(rows):
+		yield row
+	    return
+	if self.useMerge:
+	    groups = self.keyGroups(self.t1, self.jcols1, 1)
+	else:
+	    index = {}
+	    keys = []
+	    for row in self.t1:
+		key = self.makeKey(row, self.jcols1)
+		group = index.get(key)
+		if group is None:
+		    index[key] = [row]
+		    keys.append(key)
+		else:
+		    group.append(row)
+	    groups = ((key, index.pop(key)) for key in keys)
+	for (key, group) in groups:
+	    self.ncols1 = self.ncols2 = len(group[0])
+	    if self.matcher is not None:
+		for row in self.filterGroups(group, group):
+		    yield row
+		continue
+	    for outerrow in group:
+		for innerrow in group:
+		    yield self.processPair(outerrow, innerrow)
 
     #---------------------------------------------------------
     def processPair(self, r1, r2):
@@ -218,27 +1569,43 @@ class TJoin( TableTool ):
 
     #---------------------------------------------------------
     def go(self):
-	self.loadInner()
-	if self.selfJoin:
-            self.ncols1 = self.ncols2
-	    for i,rowlist in self.inner.itervalues():
-		for outerrow in rowlist:
-		    for innerrow in rowlist:
-			yield self.processPair(outerrow,innerrow)
+	self.matcher = self.compileMatcher()
+	if self.sameInputs():
+	    if not (self.memoryLimit or self.options.compact or self.options.useIndex \
+	    or self.options.nprocs > 1 or self.icols1):
+		for row in self.selfJoin():
+		    yield row
+		return
+	    if self.fileReader(self.t1) is None:
+		raise RuntimeError("T1 and T2 are the same input, which can only be read once; " + \
+		    "--memory, --compact, --index, -P and --i1/--i2 cannot be used.")
+	if self.useMerge:
+	    for row in self.mergeJoin():
+		yield row
+	    return
+	if self.options.useIndex:
+	    for row in self.indexJoin():
+		yield row
+	    return
+	self.pickInnerOuter()
+	self.matcher = self.compileMatcher()
+	if self.icols1:
+	    for row in self.overlapJoin():
+		yield row
+	    return
+	if self.filters and not self.jcols1:
+	    for row in self.thetaJoin(self.t1, self.t2):
+		yield row
+	    return
+	if self.options.nprocs > 1:
+	    for row in self.parallelJoin():
+		yield row
+	    return
+	rest = self.loadInner(self.t2, self.memoryLimit)
+	if rest is not None:
+	    for row in self.graceJoin(rest):
+		yield row
 	else:
-            for outerrow in self.t1:
-                self.ncols1 = len(outerrow)
-		key = self.makeKey(outerrow, self.jcols1)
-		if self.inner.has_key(key):
-		    innerRows = self.inner[key]
-		    for i,innerrow in innerRows:
-			yield self.processPair(outerrow,innerrow)
-			if self.doRightOuter:
-			    self.innerList[ i ] = None
-		elif self.doLeftOuter:
-		    yield self.processPair(outerrow, None)
-	    if self.doRightOuter:
-		unseen = filter(lambda x: x is not None, self.innerList)
-		for r in unseen:
-		    yield self.processPair(None, r)
-
+	    self.pushSemiJoin(self.inner.__contains__)
+	    for row in self.probeInner(self.t1):
+		yield row
@@ -12,6 +12,7 @@ on substituting a column value into a name template.
 #
 from TableTool import TableTool
 from common import *
+import compression
 
 class TPartition( TableTool ):
     USAGE=__doc__
@@ -53,6 +54,14 @@ like "./mygffdata.chr%s.gff3".
 '''
 If true, the partition operator passes all input rows to its output. This allows a pipeline to
 continue after a partitioning operator.
+''')
+	self.parser.add_option("-z", "--compression", dest="compression",
+	    action="store", default = None,
+	    metavar="FMT",
+	    help= 
+'''
+Output file compression: gz, bz2, xz or none. By default, chosen from the output
+file name's extension (.gz, .bz2, .xz). Compression runs on background threads.
 ''')
 
     #---------------------------------------------------------
@@ -83,10 +92,15 @@ continue after a partitioning operator.
 	else:
             if self.options.limit != -1 and 1+len(self.fname2ofd) > self.options.limit:
                 raise RuntimeError("Too many files created. Limit=%d"%self.options.limit)
-	    fd = open(fname, 'w')
+	    fd = compression.openOutput(fname, 'w', self.options.compression)
 	    self.fname2ofd[fname] = fd
 	return fd
 
+    #---------------------------------------------------------
+    def writeOutput(self, row, fd):
+	fd.write(TAB.join(map(str,row)))
+	fd.write(NL)
+
     #---------------------------------------------------------
     def processRow(self, r):
 	pval = None
@@ -2,13 +2,132 @@
 TRead
 '''
 from common import *
-from TableTool import TableTool
+from TableTool import TableTool, Prefetcher
+import mmap
+import marshal
+import collections
+import array
+import operator
+import itertools
+import csv
+import random
+import stat
+import compression
+import lineindex
+
+# block size used by modes that need one when -b is not given
+DEFAULT_BLOCK_SIZE = 64*1024
+
+# size of the byte ranges handed to worker processes by -P
+DEFAULT_CHUNK_SIZE = 8*1024*1024
+
+# column cache (--cache) file suffix, format id and version
+CACHE_SUFFIX = ".deftcache"
+CACHE_MAGIC = "deft-column-cache"
+CACHE_VERSION = 1
+
+# number of rows decoded at a time from a column cache
+CACHE_BATCH_ROWS = 16*1024
+
+# input formats, and number of rows parsed at a time in CSV format
+TSV = "tsv"
+CSV = "csv"
+CSV_BATCH_ROWS = 4*1024
+
+#----------------------------------------------------------------------
+# Splits a list of lines (newlines already removed) into rows,
+# skipping blank and comment lines. lastLine is an unterminated
+# final line, or None; if given, it is appended to lines and,
+# like in readline mode, loses its last character. maxsplit
+# is as for str.split (-1 splits every column).
+# Returns the list of rows.
+#
+def splitLines(lines, lastLine, sep, com, maxsplit=-1):
+    rows = [ l.split(sep, maxsplit) for l in lines if l and not l.startswith(com) ]
+    if lastLine:
+        lines.append(lastLine)
+        if not lastLine.startswith(com):
+            r = lastLine.split(sep, maxsplit)
+            r[-1] = r[-1][:-1]
+            rows.append(r)
+    return rows
+
+#----------------------------------------------------------------------
+# Returns a function of one line that returns False if the
+# line's key (the tuple of its values in cols) fails test.
+# Lines too short to have a key are kept; so are comment
+# lines whose "key" passes, since later steps skip them.
+#
+def lineFilter(sep, cols, test):
+    m = max(cols) + 1
+    if len(cols) == 1:
+        c = cols[0]
+        def keep(l):
+            r = l.split(sep, m)
+            return len(r) < m or test((r[c],))
+    else:
+        def keep(l):
+            r = l.split(sep, m)
+            return len(r) < m or test(tuple([r[c] for c in cols]))
+    return keep
+
+#----------------------------------------------------------------------
+# Returns the number of columns in the line that produced row.
+# When the row was split with a maxsplit, its last item holds
+# the rest of the line, unsplit.
+#
+def rowWidth(row, sep, maxsplit=-1):
+    if maxsplit < 0:
+        return len(row)
+    return len(row) + row[-1].count(sep)
+
+#----------------------------------------------------------------------
+# Returns the set of distinct row widths in a list of rows.
+#
+def rowWidths(rows, sep, maxsplit=-1):
+    if maxsplit < 0:
+        return set(map(len, rows))
+    return set([ len(r) + r[-1].count(sep) for r in rows ])
+
+#----------------------------------------------------------------------
+# Column cache. Returns the sequence of strings for a
+# sequence of string codes.
+#
+def decodeColumn(strings, codes):
+    if len(codes) == 1:
+        return [strings[codes[0]]]
+    return operator.itemgetter(*codes)(strings)
+
+#----------------------------------------------------------------------
+# Worker process function for parallel mode. Parses bytes
+# [start,end) of the file. The range starts at the beginning
+# of a line and ends just after a newline (or at end of file).
+# Returns a tuple: (marshalled list of rows, number of lines,
+# number of columns if all rows have the same length, else -1).
+#
+def parseRange(args):
+    (fname, start, end, sep, com, maxsplit) = args
+    fd = open(fname, 'r')
+    fd.seek(start)
+    data = fd.read(end - start)
+    fd.close()
+    lines = data.split(NL)
+    lastLine = lines.pop()
+    rows = splitLines(lines, lastLine, sep, com, maxsplit)
+    lens = rowWidths(rows, sep, maxsplit)
+    if len(lens) == 1:
+        ncols = lens.pop()
+    else:
+        ncols = -1
+    return (marshal.dumps(rows), len(lines), ncols)
+
 class TRead(TableTool):
     USAGE=__doc__
     def __init__(self, argv):
 	#
 	# 
 	self.ncols = 0
+	self.maxSplit = -1
 
 	#
 	self.separatorChar	 = TAB
@@ -23,6 +142,20 @@ class TRead(TableTool):
 	#
 	self.currentRow = None
 	self.currentRowNum = 0
+	#
+	self.blockSize = 0
+	self.pending = None
+	self.batch = []
+	self.batchIndex = 0
+	#
+	self.mmap = None
+	self.mmapPos = None
+	self.compression = None
+	self.csvReader = None
+	self.index = None
+	self.rowRange = None
+	self.rowFilter = None
+	self.lineFilter = None
         #
         TableTool.__init__(self, 0,argv)
         #
@@ -35,25 +168,144 @@ class TRead(TableTool):
 	    metavar="FILE",
 	    help="Specifies file for input table. Default='-' (read from stdin).")
 
-	self.parser.add_option("-s", "--separator", dest="sep", default=TAB,
+	self.parser.add_option("-s", "--separator", dest="sep", default=None,
 	    metavar="CHAR",
-	    help="Separator character (default=TAB).")
+	    help="Separator character (default=TAB, or COMMA with --format csv).")
+
+	self.parser.add_option("--format", dest="format", default=TSV,
+	    metavar="FMT",
+	    help="Input format. tsv (the default) splits each line on the separator. " + \
+	         "csv parses RFC 4180 CSV (quoted fields, embedded separators and " + \
+	         "newlines) with the csv module. In csv format, rows whose first " + \
+	         "field begins with the comment character are skipped.")
 
 	self.parser.add_option("-c", "--comment", dest="com1", default=HASH,
 	    metavar="CHAR",
 	    help="Comment character (default=HASH). Lines beginning with CHAR are skipped.")
 
+	self.parser.add_option("-b", "--block-size", dest="blockSize", default=0,
+	    type="int", metavar="BYTES",
+	    help="Batch mode. Reads the input in blocks of BYTES bytes and splits " + \
+	         "lines and rows a block at a time. (Default=0: read line by line.)")
+
+	self.parser.add_option("-z", "--compression", dest="compression", default="auto",
+	    metavar="FMT",
+	    help="Input compression: gz, bz2, xz, none or auto. With auto (the " + \
+	         "default), compressed files are recognized by their first bytes. " + \
+	         "Stdin and pipes are only decompressed if FMT is given explicitly. " + \
+	         "Decompression runs on a background thread.")
+
+	self.parser.add_option("-M", "--mmap", dest="useMmap", default=False,
+	    action="store_true",
+	    help="Memory-map the input file and scan it in place, rather than " + \
+	         "reading it through a file buffer. Implies batch mode. " + \
+	         "Ignored (the file is read normally) when reading from stdin, " + \
+	         "a pipe, an open file or a compressed file, or in csv format.")
+
+	self.parser.add_option("-P", "--parallel", dest="nprocs", default=0,
+	    type="int", metavar="N",
+	    help="Parse the input file in N worker processes. The file is cut " + \
+	         "into byte ranges on line boundaries; rows are still returned " + \
+	         "in file order. Ignored when reading from stdin or an open file.")
+
+	self.parser.add_option("--cache", dest="useCache", default=False,
+	    action="store_true",
+	    help="Keep a binary, column-wise copy of the parsed table next to " + \
+	         "the input file (FILE%s), and read that instead of the " % CACHE_SUFFIX + \
+	         "text when it is current and the consumer needs only some of the " + \
+	         "columns (whole rows are parsed from the text, which is as fast). " + \
+	         "The cache is rebuilt whenever the " + \
+	         "file's size or modification time changes. Ignored when reading " + \
+	         "from stdin or an open file.")
+
+	self.parser.add_option("--index", dest="useIndex", default=False,
+	    action="store_true",
+	    help="Use the line-offset index of the input file (FILE%s), " % lineindex.INDEX_SUFFIX + \
+	         "building it if it is missing or out of date. With -P, the file " + \
+	         "is then split between workers by rows rather than bytes. " + \
+	         "Requires an uncompressed, named file in tsv format.")
+
+	self.parser.add_option("--index-every", dest="indexEvery",
+	    default=lineindex.DEFAULT_EVERY, type="int", metavar="N",
+	    help="Row interval for a newly built index (default=%d)." % lineindex.DEFAULT_EVERY)
+
+	self.parser.add_option("--rows", dest="rows", default=None,
+	    metavar="START:END",
+	    help="Read only rows START up to (not including) END. Rows are " + \
+	         "numbered from 0; either number may be omitted. Seeks using " + \
+	         "the index (implies --index).")
+
+	self.parser.add_option("--sample", dest="sample", default=None,
+	    type="int", metavar="N",
+	    help="Read N rows chosen at random (in file order), seeking to " + \
+	         "each using the index (implies --index).")
+
+	self.parser.add_option("--seed", dest="seed", default=None,
+	    type="int", metavar="SEED",
+	    help="Random seed for --sample.")
+
+	self.parser.add_option("--prefetch", dest="prefetch", default=0,
+	    type="int", metavar="DEPTH",
+	    help="Read ahead on a background thread, keeping up to DEPTH " + \
+	         "batches of rows queued. Implies batch mode. (Default=0: no read-ahead.)")
+
+	self.parser.add_option("--sorted", dest="sortedOn", default=[],
+	    action="append", metavar="COL[:MODS]",
+	    help="Declares that the file is sorted on column COL, with modifiers " + \
+	         "as for ts -k (e.g., 2r). Repeatable, for a multilevel sort. Tools " + \
+	         "reading the table then stream or merge it rather than hash it " + \
+	         "where the order allows (and check the order as they do).")
+
+	self.parser.add_option("--chunk-size", dest="chunkSize", default=DEFAULT_CHUNK_SIZE,
+	    type="int", metavar="BYTES",
+	    help="Size of the byte ranges parsed by each worker in parallel mode. " + \
+	         "(Default=%d)" % DEFAULT_CHUNK_SIZE)
+
+    #--------------------------------------------------
+    def processOptions(self):
+        TableTool.processOptions(self)
+        if self.options.format not in [TSV, CSV]:
+            self.parser.error("Unknown input format: %s" % self.options.format)
+        self.separatorChar = self.options.sep
+        if self.separatorChar is None:
+            self.separatorChar = {TSV:TAB, CSV:COMMA}[self.options.format]
+        self.commentChar = self.options.com1
+        if self.options.rows is not None:
+            try:
+                (start, end) = self.options.rows.split(":")
+                self.rowRange = (int(start or 0), int(end) if end else None)
+            except ValueError:
+                self.parser.error("Bad row range: %s" % self.options.rows)
+        if self.options.rows is not None or self.options.sample is not None:
+            self.options.useIndex = True
+        self.options.sortedOn = self.parseSortKeys(self.options.sortedOn)
+        self.blockSize = self.options.blockSize
+        if (self.options.useMmap or self.options.useCache or self.options.prefetch > 0 \
+        or self.options.format == CSV or self.options.useIndex) and self.blockSize <= 0:
+            self.blockSize = DEFAULT_BLOCK_SIZE
+
     #--------------------------------------------------
     def open(self):
 
         fname = self.options.filename
+        self.compression = None
 	if type(fname) is types.StringType:
 	    if fname == "-":
 		self.fileName = "<stdin>"
 		self.fileDesc = sys.stdin
+		if self.options.compression in compression.FORMATS:
+		    self.openCompressed(self.options.compression)
 	    else:
 		self.fileName = fname
 		self.fileDesc = open(fname,'r')
+		fmt = self.options.compression
+		if fmt == "auto" and self.statFile() is not None:
+		    fmt = compression.detectFormat(self.fileDesc.read(compression.MAGIC_LEN))
+		    self.fileDesc.seek(0)
+		if fmt in compression.FORMATS:
+		    self.openCompressed(fmt)
+		elif self.options.useMmap and self.options.format == TSV:
+		    self.openMmap()
 	else:
 	    self.fileName = "<???>"
 	    self.fileDesc = fname
@@ -64,9 +316,78 @@ class TRead(TableTool):
 	#
 	self.currentRowNum  = 0
 	self.currentRow  = None
+	#
+	self.pending = ""
+	self.batch = []
+	self.batchIndex = 0
+	#
+	self.csvReader = None
+	if self.options.format == CSV:
+	    self.openCsv()
+	self.index = None
+	if self.options.useIndex:
+	    self.openIndex()
+
+    #--------------------------------------------------
+    # Replaces the open file with a reader that decompresses
+    # it. Compressed input is always read in batch mode.
+    #
+    def openCompressed(self, fmt):
+        self.compression = fmt
+        self.fileDesc = compression.DecompressingReader(self.fileDesc, fmt)
+        if self.blockSize <= 0:
+            self.blockSize = DEFAULT_BLOCK_SIZE
+
+    #--------------------------------------------------
+    # CSV format. The whole stream is parsed by the csv
+    # module's reader.
+    #
+    def openCsv(self):
+        lines = self.fileDesc
+        if not isinstance(lines, types.FileType):
+            lines = iter(lines.readline, "")
+        self.csvReader = csv.reader(lines, delimiter=self.separatorChar)
+
+    #--------------------------------------------------
+    # Loads (or builds) the line-offset index of the file.
+    #
+    def openIndex(self):
+        if self.statFile() is None or self.compression is not None \
+        or self.options.format != TSV:
+            raise RuntimeError(("%s: line-offset index requires an uncompressed, " + \
+                "named file in tsv format.") % self.fileName)
+        self.index = lineindex.getIndex(self.fileName, self.options.indexEvery,
+                                        self.commentChar, self.debug)
+
+    #--------------------------------------------------
+    # True if the input is to be parsed in parallel (-P).
+    # Only possible for uncompressed, named files in
+    # tsv format.
+    #
+    def isParallel(self):
+        return self.options.nprocs > 1 and self.statFile() is not None \
+            and self.compression is None and self.options.format == TSV
+
+    #--------------------------------------------------
+    # Maps the open file into memory. Only regular files are
+    # mapped; pipes and other special files, and empty files
+    # (which cannot be mapped), are simply read the normal way.
+    #
+    def openMmap(self):
+        if not stat.S_ISREG(os.fstat(self.fileDesc.fileno()).st_mode):
+            return
+        try:
+            self.mmap = mmap.mmap(self.fileDesc.fileno(), 0, access=mmap.ACCESS_READ)
+            self.mmapPos = 0
+        except (ValueError, EnvironmentError):
+            self.mmap = None
+            self.mmapPos = None
 
     #--------------------------------------------------
     def close(self):
+	if self.mmap is not None:
+	    self.mmap.close()
+	    self.mmap = None
 	if self.fileDesc is not None \
 	and self.fileDesc is not sys.stdin:
 	    self.fileDesc.close()
@@ -80,6 +401,8 @@ class TRead(TableTool):
     # Advances line and row counters.
     #
     def nextRow(self):
+	if self.blockSize > 0:
+	    return self.nextBatchRow()
 	self.currentLine = self.fileDesc.readline()
 	while self.currentLine:
 	    self.currentLineNum += 1
@@ -89,15 +412,16 @@ class TRead(TableTool):
 		continue
 
 	    self.currentRowNum += 1
-	    self.currentRow = string.split(self.currentLine, self.separatorChar)
+	    self.currentRow = string.split(self.currentLine, self.separatorChar, self.maxSplit)
 	    self.currentRow[-1] = self.currentRow[-1][:-1] # remove newline from last col
 
+	    n = rowWidth(self.currentRow, self.separatorChar, self.maxSplit)
 	    if self.ncols == 0:
-		self.ncols = len(self.currentRow)
-	    elif self.ncols != len(self.currentRow):
+		self.ncols = n
+	    elif self.ncols != n:
 		self.debug(\
 		  "WARNING: wrong number of columns (%d) in line %d. Expected %d. \n" % \
-		  (len(self.currentRow), self.currentLineNum, self.ncols))
+		  (n, self.currentLineNum, self.ncols))
 		self.debug(self.currentLine)
 		#self.currentLine = self.fileDesc.readline()
 		#continue
@@ -106,14 +430,591 @@ class TRead(TableTool):
 	# end while-loop
 	return None
 
+    #--------------------------------------------------
+    # Batch mode. Reads the next block from the file and
+    # returns the list of rows it completes, or None at
+    # end of input. A partial line at the end of the block
+    # is held over for the next call. Empty lists are
+    # possible (e.g., a block of comments).
+    #
+    def nextBatch(self):
+        if self.csvReader is not None:
+            return self.nextCsvBatch()
+        if self.mmap is not None:
+            lines = self.readMappedLines()
+        else:
+            lines = self.readBlockLines()
+        if lines is None:
+            return None
+        (lines, lastLine) = lines
+        dropped = 0
+        if self.lineFilter is not None:
+            n = len(lines)
+            lines = filter(self.lineFilter, lines)
+            dropped = n - len(lines)
+        sep = self.separatorChar
+        rows = splitLines(lines, lastLine, sep, self.commentChar, self.maxSplit)
+        if len(rows) == 0:
+            self.currentLineNum += len(lines) + dropped
+            return rows
+        if self.ncols == 0:
+            self.ncols = rowWidth(rows[0], sep, self.maxSplit)
+        if rowWidths(rows, sep, self.maxSplit) != set([self.ncols]):
+            self.checkBatch(lines)
+        self.currentLineNum += len(lines) + dropped
+        self.currentRowNum += len(rows)
+        self.currentRow = rows[-1]
+        return rows
+
+    #--------------------------------------------------
+    # CSV format version of nextBatch. Blank lines and
+    # rows whose first field starts with the comment character
+    # are skipped. Since a CSV record may span several lines,
+    # warnings about the number of columns give row numbers.
+    #
+    def nextCsvBatch(self):
+        rows = list(itertools.islice(self.csvReader, CSV_BATCH_ROWS))
+        if len(rows) == 0:
+            return None
+        com = self.commentChar
+        rows = [ r for r in rows if r and not r[0].startswith(com) ]
+        self.currentLineNum = self.csvReader.line_num
+        if len(rows) == 0:
+            return rows
+        if self.ncols == 0:
+            self.ncols = len(rows[0])
+        if set(map(len, rows)) != set([self.ncols]):
+            for i in range(len(rows)):
+                if len(rows[i]) != self.ncols:
+                    self.debug(\
+                      "WARNING: wrong number of columns (%d) in row %d. Expected %d. \n" % \
+                      (len(rows[i]), self.currentRowNum + i + 1, self.ncols))
+                    self.debug(self.separatorChar.join(rows[i]) + NL)
+        self.currentRowNum += len(rows)
+        self.currentRow = rows[-1]
+        return rows
+
+    #--------------------------------------------------
+    # Reads the next block from the file. Returns a tuple
+    # (lines, lastLine), where lines is the list of complete
+    # lines (without newlines) and lastLine is an unterminated
+    # final line, if any. Returns None at end of input.
+    #
+    def readBlockLines(self):
+        if self.pending is None:
+            return None
+        block = self.fileDesc.read(self.blockSize)
+        if block:
+            lines = (self.pending + block).split(NL)
+            self.pending = lines.pop()
+            return (lines, None)
+        # end of input. An unterminated last line is
+        # treated exactly as readline() mode treats it.
+        lastLine = self.pending
+        self.pending = None
+        return ([], lastLine)
+
+    #--------------------------------------------------
+    # Like readBlockLines, but scans the mapped file. Each
+    # block ends on a newline found in the mapping, so there
+    # is no partial line to carry over and join to the next
+    # block.
+    #
+    def readMappedLines(self):
+        mm = self.mmap
+        pos = self.mmapPos
+        if pos is None:
+            return None
+        if pos >= len(mm):
+            self.mmapPos = None
+            return ([], None)
+        end = mm.rfind(NL, pos, pos + self.blockSize)
+        if end == -1:
+            # line is longer than a block
+            end = mm.find(NL, pos + self.blockSize)
+        if end == -1:
+            self.mmapPos = None
+            return ([], mm[pos:])
+        self.mmapPos = end + 1
+        return (mm[pos:end].split(NL), None)
+
+    #--------------------------------------------------
+    # Slow path for a batch containing rows of the wrong
+    # length. Rescans the lines to issue the same warnings
+    # (with line numbers) as readline() mode.
+    #
+    def checkBatch(self, lines):
+        com = self.commentChar
+        lnum = self.currentLineNum
+        for l in lines:
+            lnum += 1
+            if not l or l.startswith(com):
+                continue
+            n = l.count(self.separatorChar) + 1
+            if n != self.ncols:
+                self.debug(\
+                  "WARNING: wrong number of columns (%d) in line %d. Expected %d. \n" % \
+                  (n, lnum, self.ncols))
+                self.debug(l + NL)
+
+    #--------------------------------------------------
+    # Batch mode version of nextRow().
+    #
+    def nextBatchRow(self):
+        while self.batchIndex >= len(self.batch):
+            self.batch = self.nextBatch()
+            self.batchIndex = 0
+            if self.batch is None:
+                self.batch = []
+                return None
+        r = self.batch[self.batchIndex]
+        self.batchIndex += 1
+        self.currentRow = r
+        return r
+
+    #--------------------------------------------------
+    # Parallel mode. Generates (start,end) byte ranges of
+    # about chunkSize bytes, each ending just after a newline.
+    #
+    def chunkRanges(self):
+        size = self.fileSize()
+        if self.index is not None:
+            for r in self.indexedChunkRanges(size):
+                yield r
+            return
+        fd = self.fileDesc
+        start = 0
+        while start < size:
+            end = start + self.options.chunkSize
+            if end >= size:
+                end = size
+            else:
+                fd.seek(end)
+                fd.readline()
+                end = fd.tell()
+            yield (start, end)
+            start = end
+
+    #--------------------------------------------------
+    # Parallel mode with an index. Generates byte ranges
+    # holding equal numbers of rows (a multiple of the index
+    # interval chosen so that ranges average about chunkSize
+    # bytes).
+    #
+    def indexedChunkRanges(self, size):
+        offsets = self.index.offsets
+        if len(offsets) == 0:
+            return
+        step = int(round(self.options.chunkSize * len(offsets) / float(size)))
+        step = max(1, step)
+        for b in xrange(0, len(offsets), step):
+            if b + step < len(offsets):
+                yield (offsets[b], offsets[b+step])
+            else:
+                yield (offsets[b], size)
+
+    #--------------------------------------------------
+    # Parallel mode. Hands byte ranges to a pool of worker
+    # processes and generates their lists of rows in file order.
+    # At most 2N ranges are outstanding at any time, so
+    # memory use does not depend on the file size.
+    #
+    def parallelBatches(self):
+        import multiprocessing
+        nprocs = self.options.nprocs
+        sep = self.separatorChar
+        com = self.commentChar
+        pool = multiprocessing.Pool(nprocs)
+        pending = collections.deque()
+        ranges = self.chunkRanges()
+        try:
+            while True:
+                while len(pending) < 2*nprocs:
+                    r = next(ranges, None)
+                    if r is None:
+                        break
+                    args = (self.fileName, r[0], r[1], sep, com, self.maxSplit)
+                    pending.append((r, pool.apply_async(parseRange, (args,))))
+                if len(pending) == 0:
+                    break
+                (r, result) = pending.popleft()
+                (data, nlines, ncols) = result.get()
+                rows = marshal.loads(data)
+                if len(rows) > 0:
+                    if self.ncols == 0:
+                        self.ncols = rowWidth(rows[0], sep, self.maxSplit)
+                    if ncols != self.ncols:
+                        self.checkRange(r)
+                self.currentLineNum += nlines
+                self.currentRowNum += len(rows)
+                yield rows
+        finally:
+            pool.terminate()
+            pool.join()
+
+    #--------------------------------------------------
+    # Slow path for a parallel-mode range containing rows
+    # of the wrong length. Rereads the range to issue warnings.
+    #
+    def checkRange(self, r):
+        fd = open(self.fileName, 'r')
+        fd.seek(r[0])
+        lines = fd.read(r[1] - r[0]).split(NL)
+        fd.close()
+        lastLine = lines.pop()
+        if lastLine:
+            lines.append(lastLine)
+        self.checkBatch(lines)
+
+    #--------------------------------------------------
+    # Column projection. cols is the list of columns the
+    # consumer of this table reads (None means all). Rows are
+    # then only split as far as the highest of these; the
+    # last item of a row holds the rest of the line, unsplit.
+    # Row widths in warnings are still those of the full line.
+    #
+    def pushProjection(self, cols):
+        if cols is None or len([c for c in cols if c < 0]) > 0:
+            self.maxSplit = -1
+        elif len(cols) == 0:
+            self.maxSplit = 0
+        else:
+            self.maxSplit = max(cols) + 1
+
+    #--------------------------------------------------
+    # Sort order, as declared by --sorted. (Rows read by
+    # --rows or --sample, or dropped by a filter, leave the
+    # rest in order.)
+    #
+    def sortOrder(self):
+        return self.options.sortedOn
+
+    #--------------------------------------------------
+    # Row filter (semi-join reduction). test is a function
+    # of a key, the tuple of a row's values in cols; a consumer
+    # that would discard every row whose key fails it (e.g., a
+    # join probing a hash table) can push it down, so that TRead
+    # drops those rows early. This is done in batch mode,
+    # before the line is fully split; a TRead in readline mode
+    # that has not started reading switches to batch mode (which
+    # generates the same rows). Filtering is only an
+    # optimization: a TRead that has started reading, the
+    # cache, --rows, --sample, csv format and parallel mode
+    # ignore it, and the consumer must still test every row.
+    # Line numbers in warnings may be off for filtered batches.
+    #
+    def pushFilter(self, cols, test):
+        if len(cols) > 0 and min(cols) >= 0 and self.fileDesc is None:
+            self.rowFilter = (cols, test)
+            if self.blockSize <= 0:
+                self.blockSize = DEFAULT_BLOCK_SIZE
+
+    #--------------------------------------------------
+    # Generates the lists of rows of the table, for all
+    # modes other than readline mode.
+    #
+    def batches(self):
+        if self.options.sample is not None:
+            return self.sampleBatches()
+        if self.rowRange is not None:
+            return self.rangeBatches()
+        if self.options.useCache and self.statFile() is not None:
+            cache = self.openCache()
+            if cache is None:
+                return self.writeCache(self.parsedBatches())
+            if self.maxSplit >= 0:
+                return self.cachedBatches(*cache)
+            cache[0].close()
+        return self.parsedBatches()
+
+    #--------------------------------------------------
+    def parsedBatches(self):
+        if self.isParallel():
+            for rows in self.parallelBatches():
+                yield rows
+            return
+        rows = self.nextBatch()
+        while rows is not None:
+            yield rows
+            rows = self.nextBatch()
+
+    #--------------------------------------------------
+    # Positions the input at the indexed row at or before
+    # row number row. Returns the number of that row.
+    #
+    def seekRow(self, row):
+        (offset, lnum, rownum) = self.index.seekInfo(row)
+        if self.mmap is not None:
+            self.mmapPos = offset
+        else:
+            self.fileDesc.seek(offset)
+            self.pending = ""
+        self.currentLineNum = lnum
+        self.currentRowNum = rownum
+        return rownum
+
+    #--------------------------------------------------
+    # Generates the lists of rows in the --rows range.
+    #
+    def rangeBatches(self):
+        (start, end) = self.rowRange
+        if end is not None and end <= start:
+            return
+        skip = start - self.seekRow(start)
+        rows = self.nextBatch()
+        while rows is not None:
+            if skip > 0:
+                n = min(skip, len(rows))
+                rows = rows[n:]
+                skip -= n
+            if end is not None and self.currentRowNum >= end:
+                rows = rows[:len(rows) - (self.currentRowNum - end)]
+                self.currentRowNum = end
+                yield rows
+                return
+            yield rows
+            rows = self.nextBatch()
+
+    #--------------------------------------------------
+    # Generates one list, of --sample rows chosen at random
+    # from the file, in file order. Rows in the same index
+    # interval are read in one pass; otherwise TRead seeks.
+    #
+    def sampleBatches(self):
+        nrows = self.index.nrows
+        rng = random.Random(self.options.seed)
+        targets = sorted(rng.sample(xrange(nrows), min(self.options.sample, nrows)))
+        fd = self.fileDesc
+        sep = self.separatorChar
+        com = self.commentChar
+        every = self.index.every
+        rows = []
+        cursor = None	# number of the next row to be read
+        for t in targets:
+            if cursor is None or t // every != cursor // every:
+                (offset, lnum, cursor) = self.index.seekInfo(t)
+                fd.seek(offset)
+            while True:
+                line = fd.readline()
+                if line == NL or line.startswith(com):
+                    continue
+                if cursor == t:
+                    r = line.split(sep, self.maxSplit)
+                    r[-1] = r[-1][:-1]
+                    rows.append(r)
+                    cursor += 1
+                    break
+                cursor += 1
+        self.ncols = len(rows) and rowWidth(rows[0], sep, self.maxSplit)
+        self.currentRowNum = len(rows)
+        yield rows
+
+    #--------------------------------------------------
+    # Column cache. The cache is identified by the input's
+    # absolute path, size and mtime, and by the format,
+    # separator and comment characters used to parse it.
+    #
+    def cacheKey(self):
+        st = self.statFile()
+        return (os.path.abspath(self.fileName), st.st_size, st.st_mtime,
+                self.options.format, self.separatorChar, self.commentChar)
+
+    #--------------------------------------------------
+    # Column cache. Opens a current cache file, and returns
+    # (the open file, its header), or None if there is none.
+    #
+    # The cache pays only for a column projection: it decodes
+    # the needed columns alone, and does not split the rest of
+    # each line. Building whole rows from it takes about as long
+    # as splitting the text (both allocate a list per row, and
+    # the strings split creates are cheap), so whole rows are
+    # read from the text.
+    #
+    # File layout (all marshalled):
+    #   header: (CACHE_MAGIC, CACHE_VERSION, key, nlines, nrows, ncols)
+    #   strings: list of the distinct values in the table
+    #   widths: row widths (array('I') bytes), or None if all
+    #       rows are ncols wide
+    #   linenums: line number of each row (array('I') bytes), or
+    #       None if all rows are ncols wide
+    #   one array('I') of string codes per column, in column order.
+    #       Column j holds one code for each row having more than
+    #       j columns.
+    #
+    def openCache(self):
+        cname = self.fileName + CACHE_SUFFIX
+        try:
+            fd = open(cname, 'rb')
+            header = marshal.load(fd)
+        except (IOError, EOFError, ValueError, TypeError):
+            return None
+        if type(header) is not types.TupleType or len(header) != 6 \
+        or header[:3] != (CACHE_MAGIC, CACHE_VERSION, self.cacheKey()):
+            fd.close()
+            return None
+        return (fd, header)
+
+    #--------------------------------------------------
+    # Column cache. Generates the row lists of an open cache
+    # file. With a column projection, a row has the items split
+    # would give it (see pushProjection), but the last item,
+    # when the row is wider, holds only the next column rather
+    # than the rest of the line (which no consumer reads).
+    #
+    def cachedBatches(self, fd, header):
+        (magic, version, key, nlines, nrows, ncols) = header
+        strings = marshal.load(fd)
+        widths = marshal.load(fd)
+        linenums = marshal.load(fd)
+        maxcols = ncols
+        if widths is not None:
+            widths = array.array('I', widths)
+            linenums = array.array('I', linenums)
+            maxcols = max(widths)
+        # with a column projection, decode only the needed columns
+        # (and the one after, in place of the rest of the line)
+        if self.maxSplit >= 0:
+            maxcols = min(maxcols, self.maxSplit + 1)
+        cols = []
+        for j in range(maxcols):
+            cols.append(array.array('I', marshal.load(fd)))
+        fd.close()
+        self.ncols = ncols
+        self.currentLineNum = nlines
+        get = strings.__getitem__
+        if widths is None:
+            for i in xrange(0, nrows, CACHE_BATCH_ROWS):
+                dcols = [decodeColumn(strings, c[i:i+CACHE_BATCH_ROWS]) for c in cols]
+                rows = map(list, itertools.izip(*dcols))
+                self.currentRowNum += len(rows)
+                yield rows
+            return
+        # ragged table: build rows one at a time, and repeat
+        # the column count warnings given when it was parsed
+        unit = {TSV:"line", CSV:"row"}[self.options.format]
+        pos = [0] * maxcols
+        rows = []
+        for i in xrange(nrows):
+            w = widths[i]
+            r = []
+            for j in range(min(w, maxcols)):
+                r.append(get(cols[j][pos[j]]))
+                pos[j] += 1
+            if w != ncols:
+                self.debug(\
+                  "WARNING: wrong number of columns (%d) in %s %d. Expected %d. \n" % \
+                  (w, unit, linenums[i], ncols))
+                self.debug(self.separatorChar.join(r) + NL)
+            rows.append(r)
+            if len(rows) == CACHE_BATCH_ROWS:
+                self.currentRowNum += len(rows)
+                yield rows
+                rows = []
+        self.currentRowNum += len(rows)
+        yield rows
+
+    #--------------------------------------------------
+    # Column cache. Passes through the row lists generated
+    # by batches while encoding them. If batches runs to
+    # completion, writes the cache file. The cache is written
+    # to a temporary name and renamed, so readers never see
+    # a partial file.
+    #
+    def writeCache(self, batches):
+        key = self.cacheKey()
+        maxSplit = self.maxSplit
+        self.maxSplit = -1	# the cache holds whole rows
+        codes = {}
+        widths = array.array('I')
+        linenums = array.array('I')
+        cols = []
+        ragged = False
+        for rows in batches:
+            lens = set(map(len, rows))
+            if len(lens) == 1 and not ragged:
+                # the usual case: encode a column at a time
+                w = lens.pop()
+                while len(cols) < w:
+                    cols.append(array.array('I'))
+                j = 0
+                for col in itertools.izip(*rows):
+                    for v in set(col).difference(codes):
+                        codes[v] = len(codes)
+                    cols[j].extend(map(codes.__getitem__, col))
+                    j += 1
+                widths.extend([w] * len(rows))
+                ragged = (w != self.ncols)
+            else:
+                for r in rows:
+                    w = len(r)
+                    widths.append(w)
+                    while len(cols) < w:
+                        cols.append(array.array('I'))
+                    for j in range(w):
+                        cols[j].append(codes.setdefault(r[j], len(codes)))
+                    ragged = ragged or w != self.ncols
+            yield rows
+        self.maxSplit = maxSplit
+        strings = [None] * len(codes)
+        for (v, c) in codes.iteritems():
+            strings[c] = v
+        if not ragged:
+            widths = None
+            linenums = None
+        else:
+            # line numbers are needed to repeat the warnings
+            linenums = self.cacheLineNums()
+            widths = widths.tostring()
+        header = (CACHE_MAGIC, CACHE_VERSION, key, self.currentLineNum,
+                  self.currentRowNum, self.ncols)
+        cname = self.fileName + CACHE_SUFFIX
+        tmpname = "%s.%d" % (cname, os.getpid())
+        try:
+            fd = open(tmpname, 'wb')
+            for x in [header, strings, widths, linenums]:
+                marshal.dump(x, fd)
+            for c in cols:
+                marshal.dump(c.tostring(), fd)
+            fd.close()
+            os.rename(tmpname, cname)
+        except (IOError, OSError), e:
+            self.debug("WARNING: could not write cache file %s: %s" % (cname, e))
+
+    #--------------------------------------------------
+    # Column cache. Returns the line numbers of the rows
+    # of the input file (as array('I') bytes). Only used for
+    # files with rows of the wrong width. (For CSV input,
+    # warnings give row numbers instead.)
+    #
+    def cacheLineNums(self):
+        linenums = array.array('I')
+        if self.options.format == CSV:
+            linenums.extend(xrange(1, self.currentRowNum + 1))
+            return linenums.tostring()
+        fd = open(self.fileName, 'r')
+        if self.compression is not None:
+            fd = compression.DecompressingReader(fd, self.compression)
+        lnum = 0
+        for line in iter(fd.readline, ""):
+            lnum += 1
+            if line == NL or line.startswith(self.commentChar):
+                continue
+            linenums.append(lnum)
+        fd.close()
+        return linenums.tostring()
+
     #--------------------------------------------------
     # If reading from a file, stat the file.
     # If reading from stdin or unnamed file descriptor,
-    # return None.
+    # return None. A named file that is not a regular file
+    # (a pipe, e.g. from <(...)) cannot seek, so is treated
+    # as stdin is: None.
     #
     def statFile( self ):
 	if self.fileName[0] != "<":
-	    return os.stat( self.fileName )
+	    st = os.stat( self.fileName )
+	    if stat.S_ISREG(st.st_mode):
+		return st
 	return None
 
     #--------------------------------------------------
@@ -168,6 +1069,22 @@ class TRead(TableTool):
     #
     def go(self):
         self.open()
+        self.lineFilter = None
+        if self.rowFilter is not None and self.options.format == TSV \
+        and not self.options.useCache and self.rowRange is None \
+        and self.options.sample is None:
+            self.lineFilter = lineFilter(self.separatorChar, *self.rowFilter)
+        if self.options.prefetch > 0:
+            for r in Prefetcher(self, self.options.prefetch, self.batches()):
+                yield r
+            self.close()
+            return
+        if self.blockSize > 0 or self.isParallel():
+            for rows in self.batches():
+                for r in rows:
+                    yield r
+            self.close()
+            return
 	r = self.nextRow()
         while r:
             yield r
@@ -6,17 +6,264 @@
 '''
         ts - table sort
 Sorts a table based on column(s) and sort direction(s).
+
+    -k COL[:MODS]
+        Sorts on column COL (numbered from 0). Repeat for a multilevel
+        sort: rows are ordered by the first key, then by the second
+        among rows with equal first keys, and so on. MODS are letters
+        (the ':' is optional):
+            r	reverse (descending) order
+            n	numeric: compares the number at the start of the
+        	value (e.g., "12", "-3.5kb"); a value not starting
+        	with one counts as 0
+            g	general numeric: compares the value as a float (e.g.,
+        	"1.5e-3"); values that are not numbers sort first
+            V	natural (version) order: runs of digits compare as
+        	numbers, so "chr2" < "chr10" and "1.9" < "1.10"
+        Without n, g or V, values compare as strings. The sort is
+        stable: rows with equal keys stay in input order. Each row's
+        keys are computed once, into one compound key, and the rows are
+        sorted in one pass.
+
+    --memory MB
+        Limits the memory used to hold rows (as estimated from their
+        sizes). If the input turns out to be larger, ts sorts it in
+        runs that fit, writes each sorted run to a temporary file, and
+        merges the runs as it outputs them. The output is the same as
+        that of the in-memory sort (which is stable: rows with equal
+        keys stay in input order). Temporary files are written in
+        TMPDIR (or --tmp-dir) and removed when ts finishes or exits.
+
+    -P N, --parallel N
+        Sorts in N worker processes. The input is cut into chunks
+        (each 1/(N+1) of the --memory budget, if given), which are
+        written to temporary files and sorted by the workers while
+        more input is read. The sorted runs are then merged by the
+        workers, each merging the rows in one range of keys (chosen
+        from the first chunk), and the merged ranges are output in
+        turn. The output is the same as that of the serial sort,
+        including the order of rows with equal keys.
+
+    --limit N
+        Outputs only the first N rows of the sorted table (the same
+        rows, in the same order, as a full sort would). Only the
+        best N rows seen so far are held in memory, in a heap, so
+        the time is O(n log N) rather than O(n log n), and --memory
+        and -P are not needed.
+
+    -g COLUMN(S), --group-by COLUMN(S)
+        With --limit, outputs the first N rows of each group of rows
+        with the same values in these columns (e.g., the best hit
+        for each gene, with --limit 1). The rows are output in
+        sorted order, as if the table were sorted and then all but
+        the first N rows of each group were dropped. Repeatable.
 '''
 #
 #----------------------------------------------------------------------
 #
+import os
+import heapq
+import atexit
+import shutil
+import tempfile
+import marshal
+import itertools
+
 from TableTool import TableTool
 from common import *
 
+# Estimated memory (bytes) used by each row held in memory,
+# beyond the lengths of its strings, and by each of its column
+# values.
+ROW_OVERHEAD = 200
+COLUMN_OVERHEAD = 45
+
+# The size of one row in this many is estimated (as that of
+# each of them).
+SIZE_SAMPLE_ROWS = 16
+
+# Rows written per marshal record to a run file.
+SPILL_BATCH_ROWS = 1000
+
+# Maximum number of runs merged at once. If there are more, they
+# are first merged, this many at a time, into longer runs.
+MAX_MERGE_RUNS = 64
+
+# Estimated size (bytes) of the chunks of input sorted by each
+# worker in a parallel sort without a memory budget.
+PARALLEL_CHUNK_SIZE = 64 * 1024 * 1024
+
+# Rows sampled from the first chunk of a parallel sort to choose
+# the splitters of its partitions.
+SPLITTER_SAMPLE_ROWS = 10000
+
+# The TSort being run by a parallel sort. Worker processes are
+# forked from the parent, and so inherit it (with its key
+# functions, which could not be pickled).
+PARALLEL_SORT = None
+
+# -k types
+NUMERIC_RE = re.compile(r'^\s*[-+]?(\d+\.?\d*|\.\d+)')
+DIGITS_RE = re.compile(r'\d+')
+
+# Maps each byte to its complement, for descendingString.
+COMPLEMENT = "".join([chr(255 - i) for i in range(256)])
+
+#----------------------------------------------------------------------
+# Sort key conversions (-k modifiers n, g and V).
+#
+# n: the number at the start of s, or 0.
+#
+def numericValue(s):
+    if type(s) is not types.StringType:
+	return s
+    try:
+	return int(s)
+    except ValueError:
+	pass
+    m = NUMERIC_RE.match(s)
+    if m is None:
+	return 0
+    return float(m.group(0))
+
+#
+# g: s as a float. Values that are not numbers (including nan)
+# come before all numbers.
+#
+def generalNumericValue(s):
+    try:
+	f = float(s)
+    except ValueError:
+	return (0, 0.0)
+    if f != f:
+	return (0, 0.0)
+    return (1, f)
+
+#
+# V: a string that compares as s does in natural order. Each
+# run of digits is replaced by its value without leading zeros,
+# preceded by its length as a digit (or by 9 and the length of
+# the length), so that longer numbers compare greater and runs of
+# digits still sort among the other characters as digits do.
+#
+def naturalValue(s):
+    return DIGITS_RE.sub(naturalDigits, str(s))
+
+def naturalDigits(m):
+    d = m.group(0).lstrip("0")
+    n = len(d)
+    if n < 9:
+	return chr(48 + n) + d
+    return "9" + chr(48 + len(str(n))) + str(n) + d
+
+#
+# The key of a reversed column in a compound key with ascending
+# columns: a string whose order is the reverse of s's. Bytes are
+# complemented; a NUL (which complements to 0xff) becomes
+# 0xff 0x00, and the key ends in 0xff 0xff, so that a string
+# sorts after any longer string it begins. (Values other than
+# strings, e.g. from a tf generator, are wrapped in Descending.)
+#
+def descendingString(s):
+    if type(s) is not types.StringType:
+	return Descending(s)
+    return s.translate(COMPLEMENT).replace("\xff", "\xff\x00") + "\xff\xff"
+
+class Descending:
+    def __init__(self, value):
+	self.value = value
+
+    def __lt__(self, other):
+	return other.value < self.value
+
+    def __eq__(self, other):
+	return self.value == other.value
+
+def descendingGeneral(v):
+    return (-v[0], -v[1])
+
+# the key function of each type, and how to reverse its keys
+KEY_TYPES = {
+    ""  : (None, "descendingString"),
+    "n" : ("numericValue", "-"),
+    "g" : ("generalNumericValue", "descendingGeneral"),
+    "V" : ("naturalValue", "descendingString"),
+    }
+
+#----------------------------------------------------------------------
+# The estimated memory used by a row held in memory.
+#
+def rowSize(row):
+    return ROW_OVERHEAD + COLUMN_OVERHEAD*len(row) + sum(map(len, row))
+
+#
+# The index of the first of the (sorted) rows whose key is
+# not less than k.
+#
+def lowerBound(rows, keyFunction, k):
+    lo = 0
+    hi = len(rows)
+    while lo < hi:
+	mid = (lo + hi) // 2
+	if keyFunction(rows[mid]) < k:
+	    lo = mid + 1
+	else:
+	    hi = mid
+    return lo
+
+#----------------------------------------------------------------------
+# Parallel sort worker. Sorts the rows of a chunk file, and
+# writes them to one run file per partition (the rows from
+# each splitter up to the next). Returns their names.
+#
+def sortChunkFile(fname):
+    ts = PARALLEL_SORT
+    rows = list(ts.spilledRows(fname))
+    os.remove(fname)
+    ts.sortRows(rows)
+    mergeKey = ts.keyFunction(True)
+    bounds = [lowerBound(rows, mergeKey, mergeKey(s)) for s in ts.splitters]
+    bounds = [0] + bounds + [len(rows)]
+    files = []
+    for i in range(len(bounds) - 1):
+	out = "%s.p%d" % (fname, i)
+	ts.writeRun(out, rows[bounds[i]:bounds[i+1]])
+	files.append(out)
+    return files
+
+#
+# Parallel sort worker. Merges run files, given in input order,
+# into one. Returns its name.
+#
+def mergeRunFiles(files):
+    ts = PARALLEL_SORT
+    if len(files) == 1:
+	return files[0]
+    out = files[0] + ".m"
+    ts.writeRun(out, ts.mergeRuns(map(ts.spilledRows, files)))
+    for f in files:
+	os.remove(f)
+    return out
+
+#
+# Parallel sort worker. Merges the runs of a partition into
+# one file (first into longer runs, if there are too many to
+# merge at once). Returns its name.
+#
+def mergePartitionFiles(files):
+    while len(files) >= MAX_MERGE_RUNS:
+	files = [mergeRunFiles(files[i:i+MAX_MERGE_RUNS]) for i in range(0, len(files), MAX_MERGE_RUNS)]
+    return mergeRunFiles(files)
+
 class TSort ( TableTool ) :
     USAGE=__doc__
     def __init__(self,argv):
 	self.rows = []
+	self.memoryLimit = 0
+	self.spillDir = None
+	self.spillCount = 0
+	self.splitters = []
+	self.groupColumns = []
 	TableTool.__init__(self,1,argv)
 
     #---------------------------------------------------------
@@ -24,42 +271,380 @@ class TSort ( TableTool ) :
 	TableTool.initArgParser(self)
 	self.parser.add_option("-k", dest="sortKeys", 
 	    action="append", default = [],
-	    metavar="COL[:r]",
+	    metavar="COL[:MODS]",
 	    help="Specifies column to sort on , with optional 'r' specifying " +\
-	         "to reverse the sort order. Repeatible, for specifying multilevel sort.")
+	         "to reverse the sort order, and 'n' (numeric), 'g' (general numeric) " +\
+	         "or 'V' (natural order) to compare other than as strings. " +\
+	         "Repeatible, for specifying multilevel sort.")
+
+	self.parser.add_option("--memory", dest="memory",
+	    type="float", default = 0, metavar="MB",
+	    help="Memory budget for the rows held in memory. If the input is larger, " +\
+	         "it is sorted in runs, which are written to temporary files and merged. " +\
+	         "(Default: 0, no limit)")
+
+	self.parser.add_option("--tmp-dir", dest="tmpDir",
+	    default = None, metavar="DIR",
+	    help="Directory for temporary run files. (Default: system temporary directory)")
+
+	self.parser.add_option("-P", "--parallel", dest="nprocs",
+	    type="int", default = 1, metavar="N",
+	    help="Sort chunks of the input in N worker processes, and merge them. (Default: 1)")
+
+	self.parser.add_option("--limit", dest="limit",
+	    type="int", default = 0, metavar="N",
+	    help="Output only the first N rows of the sort (or of each group, with -g). " +\
+	         "Only N rows (per group) are held in memory. (Default: 0, no limit)")
+
+	self.parser.add_option("-g", "--group-by", dest="groupBy",
+	    action="append", default = [], metavar="COLUMN(S)",
+	    help="With --limit, limits the rows of each group of rows with the same " +\
+	         "values in these columns. Repeatable.")
 
     #---------------------------------------------------------
     def processOptions(self):
 	TableTool.processOptions(self)
-	nsk = []
-	for skey in self.options.sortKeys:
-	    reverse=False
-	    if skey.endswith(":r"):
-	        reverse=True
-		skey = skey[:-2]
-	    elif skey.endswith("r"):
-	        reverse=True
-		skey = skey[:-1]
-	    col=int(skey)
-	    nsk.append( (col, reverse) )
-	self.options.sortKeys = nsk
+	self.options.sortKeys = self.parseSortKeys(self.options.sortKeys)
+	self.memoryLimit = int(self.options.memory * 1024 * 1024)
+	if self.options.limit < 0:
+	    self.parser.error("--limit must not be negative.")
+	self.groupColumns = self.parseIntList(self.options.groupBy)
+	if self.groupColumns and not self.options.limit:
+	    self.parser.error("-g requires --limit.")
 	#self.parser.error("...")
 
     #---------------------------------------------------------
-    def doSort(self, rows, column, reverse):
-	kfun = lambda row, c=column: row[c]
-        rows.sort(None,kfun,reverse)
+    def inputColumns(self, n, needed):
+        return self.unionColumns(needed, [c for (c,r,t) in self.options.sortKeys], self.groupColumns)
+
+    #---------------------------------------------------------
+    # Sort order. Rows are sorted on the keys, and as the sort
+    # is stable, rows with equal keys keep the input's order.
+    #
+    def sortOrder(self):
+	return self.options.sortKeys + self.inputOrder(self.t1)
+
+    #---------------------------------------------------------
+    # Returns the function that computes the compound key of a
+    # row: the tuple of its (converted) -k values, or the value
+    # itself for a single key. If invert, reversed keys are
+    # converted to keys of the opposite order (see KEY_TYPES);
+    # otherwise all are ascending. If concat (for string keys
+    # only), the key is instead one string: each value but the
+    # last has its NULs escaped (as NUL 0x01) and ends in two
+    # NULs, which compare below anything that could follow, so
+    # the string compares as the tuple would, and faster. (The
+    # descending form is already self-terminating.) The function
+    # is compiled from an expression, so that there is one call
+    # per row.
+    #
+    def keyFunction(self, invert, concat=False):
+	keys = self.options.sortKeys
+	parts = []
+	for (i, (col, rev, ktype)) in enumerate(keys):
+	    (conv, desc) = KEY_TYPES[ktype]
+	    e = "r[%d]" % col
+	    if conv is not None:
+		e = "%s(%s)" % (conv, e)
+	    if rev and invert:
+		if desc == "-":
+		    e = "-" + e
+		else:
+		    e = "%s(%s)" % (desc, e)
+	    elif concat and i < len(keys) - 1:
+		e = "%s.replace('\\0', '\\0\\1') + '\\0\\0'" % e
+	    parts.append(e)
+	if len(parts) == 1:
+	    return eval("lambda r: " + parts[0])
+	if concat:
+	    return eval("lambda r: " + " + ".join(parts))
+	return eval("lambda r: (%s,)" % ", ".join(parts))
+
+    #---------------------------------------------------------
+    # Sorts rows in place, in one stable pass on the compound
+    # key. If all the keys are reversed, the ascending key is
+    # sorted in reverse (which Python's sort keeps stable).
+    # Several string keys are combined into one string (see
+    # keyFunction), unless a value is not a string.
+    #
+    def sortRows(self, rows):
+	keys = self.options.sortKeys
+	if len(keys) == 0:
+	    return
+	reverse = len([k for k in keys if not k[1]]) == 0
+	concat = len(keys) > 1 and len([k for k in keys if k[2] not in ["", "V"]]) == 0
+	if concat:
+	    try:
+		rows.sort(key=self.keyFunction(not reverse, True), reverse=reverse)
+		return
+	    except (TypeError, AttributeError):
+		# (the list is left as it was)
+		pass
+	rows.sort(key=self.keyFunction(not reverse), reverse=reverse)
+
+    #---------------------------------------------------------
+    # External sort. Writes rows to a new run file in the
+    # temporary directory. Returns its name.
+    #
+    def spillRun(self, rows):
+	if self.spillDir is None:
+	    self.spillDir = tempfile.mkdtemp(prefix="ts", dir=self.options.tmpDir)
+	    atexit.register(shutil.rmtree, self.spillDir, True)
+	fname = os.path.join(self.spillDir, "run%d" % self.spillCount)
+	self.spillCount += 1
+	self.writeRun(fname, rows)
+	return fname
+
+    #---------------------------------------------------------
+    # External sort. Writes rows to the named file.
+    #
+    def writeRun(self, fname, rows):
+	fd = open(fname, 'wb')
+	batch = []
+	for row in rows:
+	    batch.append(row)
+	    if len(batch) == SPILL_BATCH_ROWS:
+		fd.write(marshal.dumps(batch))
+		batch = []
+	if batch:
+	    fd.write(marshal.dumps(batch))
+	fd.close()
+
+    #---------------------------------------------------------
+    # External sort. Generates the rows of a run file.
+    #
+    def spilledRows(self, fname):
+	fd = open(fname, 'rb')
+	try:
+	    while True:
+		try:
+		    rows = marshal.load(fd)
+		except EOFError:
+		    break
+		for row in rows:
+		    yield row
+	finally:
+	    fd.close()
+
+    #---------------------------------------------------------
+    # External sort. Merges sorted runs, given in input order,
+    # into one sorted sequence. Rows with equal keys come out
+    # in input order: first by run, then by position in the run.
+    #
+    def mergeRuns(self, runs):
+	mergeKey = self.keyFunction(True)
+	heap = []
+	for (n, run) in enumerate(runs):
+	    it = iter(run)
+	    row = next(it, None)
+	    if row is not None:
+		heap.append((mergeKey(row), n, row, it))
+	heapq.heapify(heap)
+	while heap:
+	    (key, n, row, it) = heap[0]
+	    yield row
+	    row = next(it, None)
+	    if row is None:
+		heapq.heappop(heap)
+	    else:
+		heapq.heapreplace(heap, (mergeKey(row), n, row, it))
+
+    #---------------------------------------------------------
+    # External sort. Called with the sorted runs written so far
+    # (file names) and the last run (sorted, in memory).
+    # Merges runs into longer ones until there are few enough
+    # to merge at once, then generates the merged rows.
+    #
+    def mergeSpilled(self, files, rows):
+	while len(files) >= MAX_MERGE_RUNS:
+	    merged = []
+	    for i in range(0, len(files), MAX_MERGE_RUNS):
+		group = files[i:i+MAX_MERGE_RUNS]
+		if len(group) == 1:
+		    merged.append(group[0])
+		    continue
+		merged.append(self.spillRun(self.mergeRuns(map(self.spilledRows, group))))
+		for f in group:
+		    os.remove(f)
+	    files = merged
+	for row in self.mergeRuns(map(self.spilledRows, files) + [rows]):
+	    yield row
+
+    #---------------------------------------------------------
+    def removeSpillDir(self):
+	if self.spillDir is not None:
+	    shutil.rmtree(self.spillDir, True)
+	    self.spillDir = None
+
+    #---------------------------------------------------------
+    # External sort. Reads the input in runs that fit the memory
+    # budget, sorting and writing out each run when it is full.
+    #
+    def externalSort(self):
+	try:
+	    files = []
+	    rows = []
+	    size = 0
+	    for row in self.t1:
+		rows.append(row)
+		if len(rows) % SIZE_SAMPLE_ROWS == 0:
+		    size += SIZE_SAMPLE_ROWS * rowSize(row)
+		    if size > self.memoryLimit:
+			if len(files) == 0:
+			    self.debug("ts: input exceeds the memory budget; sorting in runs.")
+			self.sortRows(rows)
+			files.append(self.spillRun(rows))
+			rows = []
+			size = 0
+	    self.sortRows(rows)
+	    if len(files) == 0:
+		for row in rows:
+		    yield row
+		return
+	    for row in self.mergeSpilled(files, rows):
+		yield row
+	finally:
+	    self.removeSpillDir()
+
+    #---------------------------------------------------------
+    # Parallel sort. Returns n-1 rows that split the key range
+    # into n partitions holding about equal numbers of the
+    # given rows (judging from a sample of them).
+    #
+    def chooseSplitters(self, rows, n):
+	sample = rows[::max(1, len(rows) // SPLITTER_SAMPLE_ROWS)]
+	self.sortRows(sample)
+	return [sample[len(sample) * i // n] for i in range(1, n)]
+
+    #---------------------------------------------------------
+    # Parallel sort. Reads the input in chunks, writing each one
+    # to a file for a worker to sort into a run. Each run is cut
+    # into N partitions, on the same splitter keys (chosen from
+    # the first chunk), so that the workers can then merge the
+    # partitions at the same time, and the merged partitions
+    # are output one after the other. As runs are in input order,
+    # and rows with equal keys fall in the same partition, these
+    # come out in input order.
+    #
+    def parallelSort(self):
+	global PARALLEL_SORT
+	import multiprocessing
+	nprocs = self.options.nprocs
+	if self.memoryLimit:
+	    chunkSize = self.memoryLimit // (nprocs + 1)
+	else:
+	    chunkSize = PARALLEL_CHUNK_SIZE
+	pool = None
+	try:
+	    pending = []
+	    rows = []
+	    size = 0
+	    for row in self.t1:
+		rows.append(row)
+		if len(rows) % SIZE_SAMPLE_ROWS == 0:
+		    size += SIZE_SAMPLE_ROWS * rowSize(row)
+		    if size > chunkSize:
+			if pool is None:
+			    self.debug("ts: sorting in %d processes." % nprocs)
+			    self.splitters = self.chooseSplitters(rows, nprocs)
+			    PARALLEL_SORT = self
+			    pool = multiprocessing.Pool(nprocs)
+			pending.append(pool.apply_async(sortChunkFile, (self.spillRun(rows),)))
+			rows = []
+			size = 0
+	    if pool is None:
+		self.sortRows(rows)
+		for row in rows:
+		    yield row
+		return
+	    if rows:
+		pending.append(pool.apply_async(sortChunkFile, (self.spillRun(rows),)))
+		rows = []
+	    runs = [result.get() for result in pending]
+	    for fname in pool.imap(mergePartitionFiles, zip(*runs), 1):
+		for row in self.spilledRows(fname):
+		    yield row
+		os.remove(fname)
+	finally:
+	    PARALLEL_SORT = None
+	    if pool is not None:
+		pool.terminate()
+		pool.join()
+	    self.removeSpillDir()
+
+    #---------------------------------------------------------
+    # Top-k sort. Returns the first n of the sorted rows, in
+    # order. heapq keeps the best n rows seen in a heap, and
+    # breaks ties between equal keys by input order, so the
+    # result is that of a full (stable) sort. As in sortRows,
+    # if all the keys are reversed, the largest ascending keys
+    # are taken instead.
+    #
+    def topRows(self, n):
+	keys = self.options.sortKeys
+	if len(keys) == 0:
+	    return list(itertools.islice(self.t1, n))
+	if len([k for k in keys if not k[1]]) == 0:
+	    return heapq.nlargest(n, self.t1, self.keyFunction(False))
+	return heapq.nsmallest(n, self.t1, self.keyFunction(True))
+
+    #---------------------------------------------------------
+    # Top-k sort, per group. Keeps each group's rows, as (key,
+    # position, row), until there are 2n, then sorts them and
+    # drops all but the first n, so the cost per row is O(log n).
+    # Sorting the rows kept on (key, position) then gives the
+    # order of the full sort.
+    #
+    def groupTopRows(self, n):
+	if len(self.options.sortKeys) == 0:
+	    key = lambda r: None
+	else:
+	    key = self.keyFunction(True)
+	groups = {}
+	pos = 0
+	for row in self.t1:
+	    gkey = self.makeKey(row, self.groupColumns)
+	    kept = groups.get(gkey)
+	    if kept is None:
+		kept = groups[gkey] = []
+	    kept.append((key(row), pos, row))
+	    pos += 1
+	    if len(kept) == 2*n:
+		kept.sort()
+		del kept[n:]
+	rows = []
+	for kept in groups.itervalues():
+	    if len(kept) > n:
+		kept.sort()
+		del kept[n:]
+	    rows.extend(kept)
+	rows.sort()
+	return [row for (k, pos, row) in rows]
 
     #---------------------------------------------------------
     def go(self):
+	if self.options.limit:
+	    if self.groupColumns:
+		rows = self.groupTopRows(self.options.limit)
+	    else:
+		rows = self.topRows(self.options.limit)
+	    for row in rows:
+		yield row
+	    return
+	if self.options.nprocs > 1 and len(self.options.sortKeys) > 0:
+	    for row in self.parallelSort():
+		yield row
+	    return
+	if self.memoryLimit and len(self.options.sortKeys) > 0:
+	    for row in self.externalSort():
+		yield row
+	    return
+
 	self.rows = []
         for row in self.t1:
 	    self.rows.append(row)
 
-	self.options.sortKeys.reverse()
-	for (col,rev) in self.options.sortKeys:
-	    self.doSort(self.rows, col, rev)
+	self.sortRows(self.rows)
 
 	for row in self.rows:
               yield row
-
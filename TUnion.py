@@ -12,6 +12,7 @@ are not required to have the same columns.)
 '''
 #----------------------------------------------------------------------
 from TDiffIntUnion import TDiffIntUnion
+from TableTool import TableTool
 from common import *
 
 class TUnion (TDiffIntUnion):
@@ -19,6 +20,33 @@ class TUnion (TDiffIntUnion):
     def __init__(self,argv):
         TDiffIntUnion.__init__(self,argv)
 
+    #---------------------------------------------------------
+    # Rows of both tables are output.
+    #
+    def inputColumns(self, n, needed):
+        if n == 1:
+            return self.unionColumns(needed, self.kcols1)
+        return self.unionColumns(needed, self.kcols2)
+
+    #---------------------------------------------------------
+    def processOptions(self):
+	TDiffIntUnion.processOptions(self)
+	if self.options.useIndex:
+	    self.parser.error("--index is not supported by tu.")
+	if self.options.sorted:
+	    self.parser.error("--sorted is not supported by tu.")
+
+    #---------------------------------------------------------
+    # Sort order. T2's rows follow T1's, so the order is not
+    # known, and there is no merge: T1's keys are needed after
+    # all of T1 has been output.
+    #
+    def sortOrder(self):
+	return []
+
+    def useSortOrder(self):
+	TableTool.useSortOrder(self)
+
     #---------------------------------------------------------
     def go(self):
 	keys = {}
@@ -4,10 +4,20 @@ TWrite
 from common import *
 from TableTool import TableTool
 import sys
+import compression
+
+# rows formatted at a time
+WRITE_BATCH_ROWS = 1000
+
+# default output buffer size
+DEFAULT_BUFFER_SIZE = 1024*1024
 
 class TWrite(TableTool):
     USAGE=__doc__
     def __init__(self, argv):
+        self.ofd = None
+        self.buffer = []
+        self.bufferedBytes = 0
         TableTool.__init__(self,1,argv)
 
     def initArgParser(self):
@@ -20,15 +30,81 @@ class TWrite(TableTool):
             metavar="MODE",
             help="Specifies output mode. w=write, a=append. Default=w.")
 
-    def go(self):
-        if self.options.output == "-":
-            self.ofd = sys.stdout
+        self.parser.add_option("-z","--compression", dest="compression", default=None,
+            metavar="FMT",
+            help="Output compression: gz, bz2, xz or none. By default, chosen " + \
+                 "from the output file name's extension (.gz, .bz2, .xz); stdout " + \
+                 "is not compressed. Compression runs on a background thread.")
+
+        self.parser.add_option("-B","--buffer-size", dest="bufferSize",
+            default=DEFAULT_BUFFER_SIZE, type="int",
+            metavar="BYTES",
+            help="Rows are formatted in batches and written out whenever " + \
+                 "BYTES bytes are pending. Default=%d." % DEFAULT_BUFFER_SIZE)
+
+    def processOptions(self):
+        TableTool.processOptions(self)
+        if self.options.mode not in ["w", "a"]:
+            self.parser.error("Output mode must be w or a.")
+
+    #---------------------------------------------------------
+    # Sort order. Rows are passed on in input order.
+    #
+    def sortOrder(self):
+        return self.inputOrder(self.t1)
+
+    #---------------------------------------------------------
+    # Formats a list of rows and adds them to the output buffer,
+    # writing the buffer out if it is full.
+    #
+    def writeRows(self, rows):
+        s = NL.join([TAB.join(map(str,row)) for row in rows]) + NL
+        self.buffer.append(s)
+        self.bufferedBytes += len(s)
+        if self.bufferedBytes >= self.options.bufferSize:
+            self.flush()
+
+    #---------------------------------------------------------
+    def flush(self):
+        if self.bufferedBytes > 0:
+            self.ofd.write("".join(self.buffer))
+            self.buffer = []
+            self.bufferedBytes = 0
+
+    #---------------------------------------------------------
+    # Writes out any buffered rows and closes the output
+    # (stdout is just flushed).
+    #
+    def close(self):
+        if self.ofd is None:
+            return
+        self.flush()
+        if self.ofd is sys.stdout:
+            self.ofd.flush()
         else:
-            self.ofd = open(self.options.output, 'w')
-        #
-        for row in self.t1:
-            self.ofd.write(TAB.join(map(str,row)))
-            self.ofd.write(NL)
-            yield row
+            self.ofd.close()
+        self.ofd = None
+
+    #---------------------------------------------------------
+    # Rows are passed on as soon as they arrive, and written
+    # a batch at a time. When the input ends, the consumer
+    # stops early or the input fails, every row passed on so
+    # far is written, and the output is flushed and closed.
+    #
+    def go(self):
+        self.ofd = compression.openOutput(self.options.output,
+                          self.options.mode, self.options.compression)
+        rows = []
+        try:
+            for row in self.t1:
+                rows.append(row)
+                if len(rows) == WRITE_BATCH_ROWS:
+                    self.writeRows(rows)
+                    rows = []
+                yield row
+        finally:
+            if len(rows) > 0:
+                self.writeRows(rows)
+            self.close()
 
 
@@ -78,6 +78,25 @@ class TXpand ( TableTool ) :
 
 	self.xpColumns.append( (col,self.prefix,self.separator,self.suffix) )
 
+    #---------------------------------------------------------
+    def inputColumns(self, n, needed):
+        return self.unionColumns(needed, [x[0] for x in self.xpColumns])
+
+    #---------------------------------------------------------
+    # Sort order. The rows expanded from an input row are output
+    # together, in input order, and differ only in the expanded
+    # columns, so the input's order holds up to its first key on
+    # an expanded column.
+    #
+    def sortOrder(self):
+	xcols = [x[0] for x in self.xpColumns]
+	order = []
+	for key in self.inputOrder(self.t1):
+	    if key[0] in xcols or key[0] < 0 or min(xcols + [0]) < 0:
+		break
+	    order.append(key)
+	return order
+
     #---------------------------------------------------------
     # Parses a string encoded list into an actual list.
     # 
@@ -41,9 +41,18 @@ import re
 import math
 from optparse import OptionParser
 import time
+import threading
+import Queue
 
 from common import *
 
+# rows per batch handed from a prefetch thread to its consumer
+PREFETCH_BATCH_ROWS = 1000
+
+# sort key: a column, and modifiers r (reverse) and one type
+# (n, g or V) (see ts -k)
+SORT_KEY_RE = re.compile(r'^(-?\d+):?([rngV]*)$')
+
 #------------------------------------------------------------
 # Superclass of all the command-line tools in this library.
 # (The one exception is fjoin, which was developed independently.)
@@ -75,6 +84,8 @@ class TableTool:
     #---------------------------------------------------------
     # All TableTools are iterators.
     def __iter__(self):
+        if self.startPrefetch():
+            return self.prefetchedGo()
         return self.go()
 
     #---------------------------------------------------------
@@ -90,6 +101,12 @@ class TableTool:
                 metavar="SRC",
                 help="Specifies second input source. Default='-' (read from stdin).")
 
+            self.parser.add_option("--prefetch", dest="prefetch", default=0,
+                type="int", metavar="DEPTH",
+                help="Read both inputs ahead on background threads, keeping up to " + \
+                     "DEPTH batches of %d rows queued for each. " % PREFETCH_BATCH_ROWS + \
+                     "(Default=0: no read-ahead.)")
+
     #---------------------------------------------------------
     def processOptions(self):
         if self.ninputs > 0:
@@ -105,6 +122,160 @@ class TableTool:
                 self.t2 = self.options.in2
 
 
+    #---------------------------------------------------------
+    # Read-ahead. For tools with two inputs, if --prefetch
+    # was given, replaces t1 and t2 with Prefetchers. Each
+    # starts reading when the tool first reads from it, so an
+    # input that is never read (e.g., tj --index's T2) never
+    # starts a thread, and a filter can still be pushed down
+    # into the input before then. Returns True if either
+    # input is prefetched.
+    #
+    def startPrefetch(self):
+        if self.ninputs < 2 or self.options.prefetch <= 0:
+            return False
+        if not isinstance(self.t1, Prefetcher):
+            self.t1 = Prefetcher(self.t1, self.options.prefetch)
+        if not isinstance(self.t2, Prefetcher):
+            self.t2 = Prefetcher(self.t2, self.options.prefetch)
+        return True
+
+    #---------------------------------------------------------
+    # Read-ahead. Generates the rows of go(), and stops and
+    # joins the input threads when it finishes, fails or is
+    # closed early (even if go() left an input half read).
+    #
+    def prefetchedGo(self):
+        try:
+            for row in self.go():
+                yield row
+        finally:
+            for t in [self.t1, self.t2]:
+                if isinstance(t, Prefetcher):
+                    t.stop()
+
+    #---------------------------------------------------------
+    # Column projection. needed is the list of this tool's output
+    # columns that its consumer reads, or None if it reads whole
+    # rows (or can't tell). Returns the list of columns of input
+    # n (1 or 2) that this tool reads in order to produce them, or
+    # None for whole rows. Subclasses that can tell override this.
+    #
+    def inputColumns(self, n, needed):
+        return None
+
+    #---------------------------------------------------------
+    # Column projection. Passes the column requirements of
+    # this tool down to its inputs (see inputColumns). Inputs
+    # that are TReads will split only as much of each line as
+    # is needed.
+    #
+    def pushProjection(self, needed):
+        inputs = [self.t1, self.t2][:self.ninputs]
+        for i in range(len(inputs)):
+            if isinstance(inputs[i], TableTool):
+                inputs[i].pushProjection(self.inputColumns(i+1, needed))
+
+    #---------------------------------------------------------
+    # If input t reads a named file directly (it is a TRead,
+    # possibly behind a Prefetcher), returns that TRead, else
+    # None. (For tools that can use the file itself, e.g., its
+    # size or an index of it.)
+    #
+    def fileReader(self, t):
+        from TRead import TRead
+        if isinstance(t, Prefetcher):
+            t = t.table
+        if isinstance(t, TRead) and type(t.options.filename) is types.StringType \
+        and t.options.filename != "-":
+            return t
+        return None
+
+    #---------------------------------------------------------
+    # Key indexes (--index). Returns the TRead of input T2. A
+    # key index is built by splitting the lines of a file on
+    # the separator, so T2 must read a named file in tsv format
+    # (quoted csv fields could hold the separator). Raises
+    # RuntimeError otherwise.
+    #
+    def keyIndexReader(self):
+        from TRead import TSV
+        reader = self.fileReader(self.t2)
+        if reader is None:
+            raise RuntimeError("--index requires T2 to be a named file.")
+        if reader.options.format != TSV:
+            raise RuntimeError("--index requires T2 to be in %s format, not %s." % \
+                (TSV, reader.options.format))
+        return reader
+
+    #---------------------------------------------------------
+    # Helper for inputColumns. Returns the union of the given
+    # lists of columns, or None if any of them is None.
+    #
+    def unionColumns(self, *lists):
+        cols = set()
+        for l in lists:
+            if l is None:
+                return None
+            cols.update(l)
+        return sorted(cols)
+
+    #---------------------------------------------------------
+    # Sort order. Returns the order of this tool's output rows,
+    # as a list of sort keys (col, reverse, type), as for ts -k
+    # (see parseSortKeys): the rows are sorted on the first key,
+    # rows with equal values of it on the second, and so on.
+    # The list is empty if the order is not known. Subclasses
+    # that can tell override this.
+    #
+    def sortOrder(self):
+        return []
+
+    #---------------------------------------------------------
+    # Sort order. Returns the sort order of input t, which may
+    # be a TableTool, a Prefetcher or any iterable of rows.
+    #
+    def inputOrder(self, t):
+        if isinstance(t, TableTool) or isinstance(t, Prefetcher):
+            return t.sortOrder()
+        return []
+
+    #---------------------------------------------------------
+    # Sort order. True if the rows of input t that have equal
+    # values in cols are known to be adjacent: its order begins
+    # with string keys (in either direction) on just those
+    # columns. (Numeric and natural keys do not ensure this,
+    # as different strings can have equal keys, e.g., "1" and
+    # "01".)
+    #
+    def isGroupedOn(self, t, cols):
+        order = self.inputOrder(t)[:len(cols)]
+        return len(cols) > 0 and len(order) == len(set(cols)) \
+            and set([c for (c,r,k) in order]) == set(cols) \
+            and len([k for (c,r,k) in order if k != ""]) == 0
+
+    #---------------------------------------------------------
+    # Sort order. True if input t is known to be sorted in
+    # ascending string order on cols, in that order (as ts
+    # sorts it with -k on each), as merge algorithms need.
+    #
+    def isSortedOn(self, t, cols):
+        return len(cols) > 0 and \
+            self.inputOrder(t)[:len(cols)] == [(c, False, "") for c in cols]
+
+    #---------------------------------------------------------
+    # Sort order. Lets each tool of a pipeline, inputs first,
+    # switch to a streaming or merge algorithm where the sort
+    # order of its inputs allows. Subclasses that can use it
+    # override this (and call it first). Called by buildPipeline, after
+    # pushProjection.
+    #
+    def useSortOrder(self):
+        inputs = [self.t1, self.t2][:self.ninputs]
+        for t in inputs:
+            if isinstance(t, TableTool):
+                t.useSortOrder()
+
     #---------------------------------------------------------
     # Prints exception info, then dies.
     #
@@ -156,3 +327,124 @@ class TableTool:
 	val=re.split("[, ]+", val)
 	return map(int, filter(None,val))
 
+    #---------------------------------------------------------
+    # Parses a list of sort keys, each a column number followed
+    # by modifiers: r (reverse), and n (numeric), g (general
+    # numeric) or V (natural order) (see ts -k). Returns the
+    # list of (col, reverse, type), type being "" (string),
+    # "n", "g" or "V".
+    #
+    def parseSortKeys(self, keys):
+	nsk = []
+	for skey in keys:
+	    m = SORT_KEY_RE.match(skey)
+	    if m is None:
+		self.parser.error("Bad sort key: %s" % skey)
+	    mods = m.group(2)
+	    ktype = "".join([c for c in mods if c != "r"])
+	    if len(ktype) > 1:
+		self.parser.error("Sort key %s: only one of n, g and V may be given." % skey)
+	    nsk.append( (int(m.group(1)), "r" in mods, ktype) )
+	return nsk
+
+
+#------------------------------------------------------------
+# Groups the rows generated by an iterable into lists of
+# up to n rows.
+#
+def rowBatches(table, n=PREFETCH_BATCH_ROWS):
+    batch = []
+    for row in table:
+        batch.append(row)
+        if len(batch) == n:
+            yield batch
+            batch = []
+    if len(batch) > 0:
+        yield batch
+
+#------------------------------------------------------------
+# Reads a table ahead on a background thread. The thread
+# puts lists of rows on a queue holding at most depth lists;
+# iterating over the Prefetcher generates the rows. If
+# source is not a generator of row lists, its rows are
+# grouped with rowBatches. Other attributes (e.g., fileSize)
+# are those of the table.
+#
+# The thread starts when the Prefetcher is first iterated (or
+# start is called). If the consumer stops early, the thread is
+# told to stop, closes its source and is joined (stop does the
+# same for a consumer that abandons the iteration). An
+# exception raised while reading the source is re-raised in
+# the consumer.
+#
+class Prefetcher:
+    def __init__(self, table, depth, batches=None):
+        self.table = table
+        if batches is None:
+            batches = rowBatches(table)
+        self.batches = batches
+        self.queue = Queue.Queue(depth)
+        self.stopped = False
+        self.thread = None
+
+    def __getattr__(self, name):
+        return getattr(self.table, name)
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.produce)
+            self.thread.setDaemon(True)
+            self.thread.start()
+
+    def stop(self):
+        self.stopped = True
+        if self.thread is not None:
+            self.thread.join()
+
+    # True once reading has begun (after which a filter pushed
+    # into the table would not apply to what was already read).
+    def started(self):
+        return self.thread is not None
+
+    def put(self, item):
+        while not self.stopped:
+            try:
+                self.queue.put(item, True, 0.1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    # (Waits in short steps, so the main thread stays interruptible.)
+    def get(self):
+        while True:
+            try:
+                return self.queue.get(True, 0.1)
+            except Queue.Empty:
+                pass
+
+    def produce(self):
+        try:
+            for rows in self.batches:
+                if not self.put((rows, None)):
+                    break
+            else:
+                self.put((None, None))
+        except:
+            self.put((None, sys.exc_info()))
+        if self.stopped and hasattr(self.batches, "close"):
+            self.batches.close()
+
+    def __iter__(self):
+        self.start()
+        try:
+            while True:
+                (rows, exc) = self.get()
+                if rows is None:
+                    if exc is not None:
+                        raise exc[0], exc[1], exc[2]
+                    break
+                for r in rows:
+                    yield r
+        finally:
+            self.stop()
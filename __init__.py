@@ -83,6 +83,10 @@ def buildPipeline(tokens):
         i = i + 1
 
     p=addSeg(p, pclass, pargs)
+    # all of the pipeline's output columns are needed
+    p.pushProjection(None)
+    # streaming and merge algorithms where the inputs are sorted
+    p.useSortOrder()
     #
     return p
 
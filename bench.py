@@ -0,0 +1,306 @@
+#------------------------------------------------------------
+#------------------------------------------------------------
+#
+# bench.py
+#
+'''
+        bench - throughput comparisons
+Times alternative code paths over the same input file and
+reports rows/sec and MB/sec for each.
+
+usage: python bench.py TEST FILE [FILE ...]
+
+TESTS:
+    read	TRead line-by-line vs. batch (block) mode.
+    mmap	TRead batch mode vs. memory-mapped mode.
+    parallel	TRead batch mode vs. parallel chunked parsing.
+    project	TRead full split vs. split limited to column 1.
+    cache	TRead batch mode vs. reading the column cache, for reads
+		of column 1 and of column 5 (projections).
+    prefetch	TRead batch mode vs. read-ahead on a background thread.
+    compress	TRead/TWrite on the uncompressed file vs. gz and bz2 copies.
+    csv		TRead tab-split batch mode vs. --format csv on a CSV copy.
+    index	TRead full scan vs. --rows and --sample using the line index.
+    join	TJoin of a sorted copy with itself: hash join vs. --sorted
+		vs. grace hash join (--memory 16) vs. -P 4 (ordered or not)
+		vs. compact storage of T2 (--compact).
+    semijoin	TJoin of the file with 2% of its rows, with and without
+		the key test pushed down into T1's reader.
+    keyindex	TJoin of 100 rows of the file with the file: loading it
+		vs. building and then reusing its key index (--index).
+    sort	TSort on 4 keys (-k 1 -k 3r -k 2 -k 0): one stable sort per
+		key, last to first, vs. the single-pass compound key.
+'''
+#----------------------------------------------------------------------
+import sys
+import os
+import time
+import tempfile
+import shutil
+
+from common import *
+from TRead import TRead
+from TWrite import TWrite
+from TJoin import TJoin
+from TSort import TSort
+
+#----------------------------------------------------------------------
+# Runs the operator built by fun() to completion count times,
+# and returns (best elapsed seconds, number of rows).
+#
+def timeit(fun, count=3):
+    best = None
+    nrows = 0
+    for i in range(count):
+        t = fun()
+        start = time.time()
+        nrows = 0
+        for r in t:
+            nrows += 1
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return (best, nrows)
+
+#----------------------------------------------------------------------
+def report(label, fname, elapsed, nrows, baseline=None):
+    mb = os.stat(fname).st_size / (1024.0*1024.0)
+    line = "%-28s %8.3fs %12.0f rows/s %8.1f MB/s" % \
+        (label, elapsed, nrows/elapsed, mb/elapsed)
+    if baseline is not None:
+        line += "  (x%.2f)" % (baseline/elapsed)
+    print line
+
+#----------------------------------------------------------------------
+def benchRead(fname):
+    (base, n) = timeit(lambda: TRead(["-f", fname]))
+    report("readline", fname, base, n)
+    for bs in [16*1024, 256*1024, 1024*1024]:
+        (t, n) = timeit(lambda: TRead(["-f", fname, "-b", str(bs)]))
+        report("batch -b %d" % bs, fname, t, n, base)
+
+#----------------------------------------------------------------------
+def benchMmap(fname):
+    (base, n) = timeit(lambda: TRead(["-f", fname, "-b", "65536"]))
+    report("batch -b 65536", fname, base, n)
+    (t, n) = timeit(lambda: TRead(["-f", fname, "-M"]))
+    report("mmap -M", fname, t, n, base)
+
+#----------------------------------------------------------------------
+def benchParallel(fname):
+    (base, n) = timeit(lambda: TRead(["-f", fname, "-b", "65536"]))
+    report("batch -b 65536", fname, base, n)
+    for np in [2, 4, 8]:
+        (t, n) = timeit(lambda: TRead(["-f", fname, "-P", str(np)]))
+        report("parallel -P %d" % np, fname, t, n, base)
+
+#----------------------------------------------------------------------
+def projected(args, cols):
+    t = TRead(args)
+    t.pushProjection(cols)
+    return t
+
+def benchProject(fname):
+    for args in [["-f", fname], ["-f", fname, "-b", "65536"]]:
+        label = " ".join(args[2:]) or "readline"
+        (base, n) = timeit(lambda: projected(args, None))
+        report(label, fname, base, n)
+        (t, n) = timeit(lambda: projected(args, [1]))
+        report(label + " cols=[1]", fname, t, n, base)
+
+#----------------------------------------------------------------------
+def benchCache(fname):
+    (base, n) = timeit(lambda: TRead(["-f", fname, "-b", "65536"]))
+    report("batch -b 65536", fname, base, n)
+    (t, n) = timeit(lambda: TRead(["-f", fname, "--cache"]), 1)
+    report("--cache (build)", fname, t, n, base)
+    for cols in [[1], [5]]:
+        (base, n) = timeit(lambda: projected(["-f", fname, "-b", "65536"], cols))
+        report("batch cols=%s" % cols, fname, base, n)
+        (t, n) = timeit(lambda: projected(["-f", fname, "--cache"], cols))
+        report("--cache (hit) cols=%s" % cols, fname, t, n, base)
+
+#----------------------------------------------------------------------
+def benchPrefetch(fname):
+    (base, n) = timeit(lambda: TRead(["-f", fname, "-b", "65536"]))
+    report("batch -b 65536", fname, base, n)
+    for depth in [1, 4]:
+        (t, n) = timeit(lambda: TRead(["-f", fname, "--prefetch", str(depth)]))
+        report("--prefetch %d" % depth, fname, t, n, base)
+
+#----------------------------------------------------------------------
+# Writes fname to each of the given output files with TWrite,
+# and reports the time taken relative to the first.
+#
+def benchWrites(fname, outputs):
+    rows = list(TRead(["-f", fname, "-b", "65536"]))
+    base = None
+    for o in outputs:
+        def writer():
+            tw = TWrite(["-o", o])
+            tw.t1 = rows
+            return tw
+        (t, n) = timeit(writer, 1)
+        report("write " + os.path.basename(o), fname, t, n, base)
+        if base is None:
+            base = t
+
+def benchCompress(fname):
+    tmpdir = tempfile.mkdtemp()
+    try:
+        base = os.path.join(tmpdir, os.path.basename(fname))
+        outputs = [base, base + ".gz", base + ".bz2"]
+        benchWrites(fname, outputs)
+        (t0, n) = timeit(lambda: TRead(["-f", base, "-b", "65536"]))
+        report("read (uncompressed)", base, t0, n)
+        for o in outputs[1:]:
+            (t, n) = timeit(lambda: TRead(["-f", o]))
+            report("read " + os.path.basename(o), base, t, n, t0)
+    finally:
+        shutil.rmtree(tmpdir)
+
+#----------------------------------------------------------------------
+def benchCsv(fname):
+    import csv
+    tmpdir = tempfile.mkdtemp()
+    try:
+        cname = os.path.join(tmpdir, os.path.basename(fname) + ".csv")
+        fd = open(cname, 'wb')
+        csv.writer(fd).writerows(TRead(["-f", fname, "-b", "65536"]))
+        fd.close()
+        (base, n) = timeit(lambda: TRead(["-f", fname, "-b", "65536"]))
+        report("tsv -b 65536", fname, base, n)
+        (t, n) = timeit(lambda: TRead(["-f", cname, "--format", "csv"]))
+        report("--format csv", cname, t, n, base)
+    finally:
+        shutil.rmtree(tmpdir)
+
+#----------------------------------------------------------------------
+def benchIndex(fname):
+    (base, n) = timeit(lambda: TRead(["-f", fname, "-b", "65536"]))
+    report("batch -b 65536", fname, base, n)
+    (t, n) = timeit(lambda: TRead(["-f", fname, "--index"]), 1)
+    report("--index (build)", fname, t, n, base)
+    mid = "%d:%d" % (n//2, n//2 + 1000)
+    (t, n) = timeit(lambda: TRead(["-f", fname, "--rows", mid]))
+    report("--rows " + mid, fname, t, n, base)
+    (t, n) = timeit(lambda: TRead(["-f", fname, "--sample", "1000", "--seed", "1"]))
+    report("--sample 1000", fname, t, n, base)
+
+#----------------------------------------------------------------------
+# Joins a copy of fname, sorted on column 0, with itself on
+# column 0, using each of the given sets of extra TJoin options.
+#
+def joinVariants(fname, variants):
+    tmpdir = tempfile.mkdtemp()
+    try:
+        sname = os.path.join(tmpdir, os.path.basename(fname))
+        rows = list(TRead(["-f", fname, "-b", "65536"]))
+        rows.sort(key=lambda r: r[0])
+        fd = open(sname, 'w')
+        for r in rows:
+            fd.write(TAB.join(r) + NL)
+        fd.close()
+        rows = None
+        base = None
+        for v in variants:
+            (t, n) = timeit(lambda: TJoin(["-1", sname, "-2", sname,
+                "--k1", "0", "--k2", "0"] + v), 1)
+            report(" ".join(v) or "hash", sname, t, n, base)
+            if base is None:
+                base = t
+    finally:
+        shutil.rmtree(tmpdir)
+
+def benchJoin(fname):
+    joinVariants(fname, [[], ["--sorted"], ["--memory", "16"],
+        ["-P", "4"], ["-P", "4", "--unordered"], ["--compact"]])
+
+#----------------------------------------------------------------------
+def benchSemijoin(fname):
+    tmpdir = tempfile.mkdtemp()
+    try:
+        sname = os.path.join(tmpdir, "sample.tsv")
+        fd = open(sname, 'w')
+        for (i, r) in enumerate(TRead(["-f", fname, "-b", "65536"])):
+            if i % 50 == 0:
+                fd.write(TAB.join(r) + NL)
+        fd.close()
+        base = None
+        for v in [["--no-semijoin"], [], ["--no-semijoin", "--memory", "1"], ["--memory", "1"]]:
+            (t, n) = timeit(lambda: TJoin(["-1", TRead(["-f", fname, "-b", "65536"]),
+                "-2", sname, "--k1", "0", "--k2", "0"] + v), 1)
+            report(" ".join(v) or "semijoin", fname, t, n, base)
+            if base is None:
+                base = t
+    finally:
+        shutil.rmtree(tmpdir)
+
+#----------------------------------------------------------------------
+def benchKeyIndex(fname):
+    tmpdir = tempfile.mkdtemp()
+    try:
+        iname = os.path.join(tmpdir, os.path.basename(fname))
+        shutil.copy(fname, iname)
+        sname = os.path.join(tmpdir, "sample.tsv")
+        fd = open(sname, 'w')
+        for (i, r) in enumerate(TRead(["-f", fname, "-b", "65536"])):
+            if i % 10000 == 0:
+                fd.write(TAB.join(r) + NL)
+        fd.close()
+        args = ["-1", sname, "-2", iname, "--k1", "0", "--k2", "0"]
+        (base, n) = timeit(lambda: TJoin(args + ["--inner", "2"]), 1)
+        report("load T2", iname, base, n)
+        (t, n) = timeit(lambda: TJoin(args + ["--index"]), 1)
+        report("--index (build)", iname, t, n, base)
+        (t, n) = timeit(lambda: TJoin(args + ["--index"]))
+        report("--index (reuse)", iname, t, n, base)
+    finally:
+        shutil.rmtree(tmpdir)
+
+#----------------------------------------------------------------------
+# The multi-pass sort: a stable sort of all the rows on each key,
+# from the last key to the first. (A generator, so that the
+# work is timed.)
+#
+def multiPassSort(fname, keys):
+    rows = list(TRead(["-f", fname]))
+    for (col, rev) in reversed(keys):
+        rows.sort(key=lambda r, c=col: r[c], reverse=rev)
+    for r in rows:
+        yield r
+
+def benchSort(fname):
+    keys = [(1, False), (3, True), (2, False), (0, False)]
+    (base, n) = timeit(lambda: multiPassSort(fname, keys))
+    report("multi-pass (4 sorts)", fname, base, n)
+    args = ["-1", fname]
+    for (col, rev) in keys:
+        args += ["-k", "%d%s" % (col, rev and "r" or "")]
+    (t, n) = timeit(lambda: TSort(args))
+    report("compound key (1 sort)", fname, t, n, base)
+
+#----------------------------------------------------------------------
+TESTS = {
+    'read' : benchRead,
+    'mmap' : benchMmap,
+    'parallel' : benchParallel,
+    'project' : benchProject,
+    'cache' : benchCache,
+    'prefetch' : benchPrefetch,
+    'compress' : benchCompress,
+    'csv' : benchCsv,
+    'index' : benchIndex,
+    'join' : benchJoin,
+    'semijoin' : benchSemijoin,
+    'keyindex' : benchKeyIndex,
+    'sort' : benchSort,
+    }
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3 or not TESTS.has_key(sys.argv[1]):
+        sys.stderr.write(__doc__)
+        sys.exit(-1)
+    for f in sys.argv[2:]:
+        print "==", sys.argv[1], f
+        TESTS[sys.argv[1]](f)
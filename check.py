@@ -0,0 +1,601 @@
+#------------------------------------------------------------
+#------------------------------------------------------------
+#
+# check.py
+#
+'''
+        check - consistency checks
+Runs the alternative code paths of the tools over small
+generated tables, including their edge cases, and compares
+the output of each with that of the existing path on the same
+input. Prints a line per comparison, and exits with status 1
+if any of them differ.
+
+usage: python check.py [TEST ...]	(Default: all of them.)
+
+TESTS:
+    mmap	TRead -M vs. line-by-line reading: empty files, files
+		without a final newline, lines longer than a block,
+		comments, projections and --rows.
+    cache	TRead --cache (building the cache, then reading it) vs.
+		reading the text: whole rows and projections, ragged
+		and empty tables, csv, and a file changed after its
+		cache was built.
+    order	Streaming and merge operators chosen from the sort order of
+		their inputs (ta, tj, ti, td) vs. the hash operators used
+		otherwise: through ts, tr --sorted, tf and compound and
+		reversed keys; the cases where they must not be chosen;
+		and the errors given for input out of its declared order.
+    pipe	TRead of a named pipe (as from <(...)) vs. of a file, in
+		each reading mode, and of gz input with -z gz.
+    join	TJoin --memory (grace hash join), -P and --compact vs.
+		the in-memory hash join, for inner and outer joins,
+		including an empty T1 or T2; and the order of the
+		output of -P (with --memory, which repartitions).
+    compact	tj --compact vs. the usual hash table, on compound keys,
+		with NULs in T1's key values; and the error given for
+		a NUL in T2.
+    index	tj, ti and td --index (building the key index, then
+		reusing it) vs. loading T2, with comments in T2 and an
+		empty T2; and the error given for a csv T2.
+    sort	TSort --memory (external merge sort, with more runs than
+		are merged at once) vs. the in-memory sort, on typed
+		and reversed keys with many equal keys, and on empty
+		and one-row inputs.
+    keys	TSort's single compound key vs. a stable sort on each key
+		in turn, last to first, on typed keys, and on reversed
+		string keys that are prefixes of one another or hold
+		NUL or 0xff bytes.
+    limit	TSort --limit N vs. the first N rows of the full sort, and
+		with -g, vs. the first N rows of each group of it; for
+		N from 1 to more than the number of rows, on ascending,
+		reversed and mixed keys.
+    psort	TSort -P vs. the serial sort, in one chunk and in many
+		(with --memory), on typed keys, on keys that are all
+		equal, and on empty and one-row inputs.
+    write	TWrite output vs. the rows it passes on: all rows, a
+		consumer that stops early, an input that fails, in
+		append mode and compressed.
+'''
+#----------------------------------------------------------------------
+import sys
+import os
+import random
+import tempfile
+import shutil
+import threading
+import gzip
+
+from common import *
+from TRead import TRead, CACHE_SUFFIX
+from TWrite import TWrite
+from TJoin import TJoin
+from TIntersection import TIntersection
+from TDifference import TDifference
+from TSort import TSort, numericValue, generalNumericValue, naturalValue
+from TAggregate import TAggregate
+from TFilter import TFilter
+from TUnion import TUnion
+
+# directory holding the generated tables
+tmpdir = None
+
+# number of comparisons that differed
+failures = 0
+
+#----------------------------------------------------------------------
+# Writes text to the file name in tmpdir, and returns its path.
+#
+def writeFile(name, text):
+    path = os.path.join(tmpdir, name)
+    fd = open(path, 'w')
+    fd.write(text)
+    fd.close()
+    return path
+
+#----------------------------------------------------------------------
+# Writes rows to the file name in tmpdir, as tab-separated
+# lines, and returns its path.
+#
+def writeTable(name, rows):
+    return writeFile(name, "".join([TAB.join(r) + NL for r in rows]))
+
+#----------------------------------------------------------------------
+# Makes the named pipe name in tmpdir, and returns its path.
+# A thread writes text to it, once, when it is opened.
+#
+def writePipe(name, text):
+    path = os.path.join(tmpdir, name)
+    if os.path.exists(path):
+        os.remove(path)
+    os.mkfifo(path)
+    def writer():
+        fd = open(path, 'w')
+        fd.write(text)
+        fd.close()
+    t = threading.Thread(target=writer)
+    t.setDaemon(True)
+    t.start()
+    return path
+
+#----------------------------------------------------------------------
+# Returns n random rows of ncols columns. Column 0 is a key
+# with about nkeys distinct values; the others are strings of
+# varying length.
+#
+def testRows(n, ncols=4, nkeys=50, seed=0):
+    rnd = random.Random(seed)
+    rows = []
+    for i in range(n):
+        r = ["k%d" % rnd.randrange(nkeys)]
+        for j in range(1, ncols):
+            r.append("v%d" % rnd.randrange(10 ** rnd.randrange(1, 8)))
+        rows.append(r)
+    return rows
+
+#----------------------------------------------------------------------
+# Returns n random rows whose columns suit the sort key types:
+# a key with many equal values (column 0), numbers with and
+# without suffixes (1), general numbers and non-numbers (2),
+# and version strings (3). Column 4 numbers the row.
+#
+def typedRows(n, seed=0):
+    rnd = random.Random(seed)
+    rows = []
+    for i in range(n):
+        x = rnd.randrange(-1000, 1000)
+        rows.append([
+            "k%d" % rnd.randrange(20),
+            rnd.choice([str(x), "%.2f" % (x / 7.0), "%dkb" % x, " %d" % x, "abc", ""]),
+            rnd.choice(["%ge-3" % x, "%g" % (x * 1e6), "nan", "inf", "-inf", "x", str(x)]),
+            rnd.choice(["chr%d" % (x % 30), "1.%d" % (x % 15), "v%d.0%d" % (x % 5, x % 12)]),
+            str(i)])
+    return rows
+
+#----------------------------------------------------------------------
+# Compares the rows generated by got with the rows generated
+# by want, and reports the result.
+#
+def compare(label, got, want):
+    global failures
+    got = list(got)
+    want = list(want)
+    if got == want:
+        print "ok   %s (%d rows)" % (label, len(want))
+        return
+    failures += 1
+    print "FAIL %s: %d rows, expected %d" % (label, len(got), len(want))
+    for i in range(min(len(got), len(want))):
+        if got[i] != want[i]:
+            print "     row %d: %s, expected %s" % (i, got[i], want[i])
+            break
+
+#----------------------------------------------------------------------
+# Reports whether condition ok, described by label, holds.
+#
+def verify(label, ok):
+    global failures
+    if ok:
+        print "ok   %s" % label
+    else:
+        failures += 1
+        print "FAIL %s" % label
+
+#----------------------------------------------------------------------
+def projected(args, cols):
+    t = TRead(args)
+    t.pushProjection(cols)
+    return t
+
+#----------------------------------------------------------------------
+def checkMmap():
+    lines = [TAB.join(r) + NL for r in testRows(2000)]
+    text = "".join(lines)
+    files = [
+        ("empty", writeFile("empty.tsv", "")),
+        ("table", writeFile("table.tsv", text)),
+        ("no final newline", writeFile("nonl.tsv", text[:-1])),
+        ("long line", writeFile("long.tsv", "a\tb\n" + "x" * 5000 + "\ty\nc\td\n")),
+        ("comments", writeFile("comments.tsv",
+            "#a\tb\n" + "".join(lines[:30]) + "#c\n" + "".join(lines[30:90]))),
+        ]
+    for (label, fname) in files:
+        want = list(TRead(["-f", fname]))
+        compare("mmap %s" % label, TRead(["-f", fname, "-M"]), want)
+        compare("mmap %s -b 64" % label, TRead(["-f", fname, "-M", "-b", "64"]), want)
+    fname = files[1][1]
+    compare("mmap cols=[1]", projected(["-f", fname, "-M", "-b", "1000"], [1]),
+        projected(["-f", fname], [1]))
+    compare("mmap --rows 500:700", TRead(["-f", fname, "-M", "-b", "1000", "--rows", "500:700"]),
+        list(TRead(["-f", fname]))[500:700])
+
+#----------------------------------------------------------------------
+# The columns of rows up to col (a projected read may give
+# different values beyond the needed columns).
+#
+def prefix(rows, col):
+    return [r[:col+1] for r in rows]
+
+def checkCache():
+    rows = testRows(3000)
+    ragged = [r[:1 + i % 4] for (i, r) in enumerate(rows[:200])]
+    tables = [
+        ("table", writeTable("table.tsv", rows), []),
+        ("ragged", writeTable("ragged.tsv", ragged), []),
+        ("empty", writeFile("empty.tsv", ""), []),
+        ("csv", writeFile("table.csv", '"a,b",c\n#x,y\n1,"2\n3"\n'), ["--format", "csv"]),
+        ]
+    for (label, fname, opts) in tables:
+        want = list(TRead(["-f", fname] + opts))
+        compare("cache %s (build)" % label, TRead(["-f", fname, "--cache"] + opts), want)
+        verify("cache %s built" % label, os.path.exists(fname + CACHE_SUFFIX))
+        compare("cache %s (hit)" % label, TRead(["-f", fname, "--cache"] + opts), want)
+        for col in [1, 2]:
+            compare("cache %s (hit) cols=[%d]" % (label, col),
+                prefix(projected(["-f", fname, "--cache"] + opts, [col]), col),
+                prefix(projected(["-f", fname] + opts, [col]), col))
+    fname = tables[0][1]
+    writeTable("table.tsv", rows[:1000])
+    compare("cache changed file", TRead(["-f", fname, "--cache"]), TRead(["-f", fname]))
+
+#----------------------------------------------------------------------
+def checkPipe():
+    text = "".join([TAB.join(r) + NL for r in testRows(2000)])
+    fname = writeFile("table.tsv", text)
+    want = list(TRead(["-f", fname]))
+    for opts in [[], ["-b", "1000"], ["-M"], ["-P", "2"], ["--cache"], ["--prefetch", "2"]]:
+        compare("pipe %s" % (" ".join(opts) or "readline"),
+            TRead(["-f", writePipe("pipe", text)] + opts), want)
+    compare("pipe short", TRead(["-f", writePipe("pipe", text[:20])]),
+        TRead(["-f", writeFile("short.tsv", text[:20])]))
+    buf = os.path.join(tmpdir, "table.tsv.gz")
+    fd = gzip.open(buf, 'wb')
+    fd.write(text)
+    fd.close()
+    compare("pipe -z gz", TRead(["-f", writePipe("pipe", open(buf, 'rb').read()), "-z", "gz"]), want)
+
+#----------------------------------------------------------------------
+# Generates the first n rows, then fails.
+#
+def failingRows(rows, n):
+    for r in rows[:n]:
+        yield r
+    raise RuntimeError("input failed")
+
+#----------------------------------------------------------------------
+# Runs a TWrite of input to fname, with options opts, and
+# returns the rows it passes on: the first n, or all of them.
+# Stops early (closing the generator) after n rows, and stops
+# quietly if the input fails.
+#
+def runWrite(fname, input, opts=[], n=None):
+    tw = TWrite(["-o", fname] + opts)
+    tw.t1 = input
+    it = iter(tw)
+    passed = []
+    try:
+        for r in it:
+            passed.append(r)
+            if len(passed) == n:
+                break
+    except RuntimeError:
+        pass
+    it.close()
+    return passed
+
+def checkWrite():
+    rows = testRows(2500)
+    fname = os.path.join(tmpdir, "out.tsv")
+    for n in [None, 1, 999, 1000, 1234]:
+        passed = runWrite(fname, rows, [], n)
+        compare("write, stop after %s" % (n or "all"), TRead(["-f", fname]), passed)
+    passed = runWrite(fname, failingRows(rows, 1500))
+    compare("write failed input", TRead(["-f", fname]), passed)
+    passed = runWrite(fname, rows, ["-m", "a"], 10)
+    compare("write -m a", TRead(["-f", fname]), rows[:1500] + passed)
+    gzname = os.path.join(tmpdir, "out.tsv.gz")
+    passed = runWrite(gzname, rows, [], 1234)
+    compare("write gz, stop after 1234", TRead(["-f", gzname]), passed)
+
+#----------------------------------------------------------------------
+# Joins files f1 and f2 on column 0, with options opts.
+#
+def runJoin(f1, f2, opts):
+    return TJoin(["-1", f1, "-2", f2, "--k1", "0", "--k2", "0"] + opts)
+
+# outer join options, and their labels
+OUTER_JOINS = [
+    ("inner", []),
+    ("left", ["--left-outer"]),
+    ("right", ["--right-outer"]),
+    ("full", ["--left-outer", "--right-outer"]),
+    ]
+
+def checkJoin():
+    t1 = writeTable("t1.tsv", testRows(2000, 3, 60, 1))
+    t2 = writeTable("t2.tsv", testRows(3000, 4, 50, 2))
+    empty = writeFile("empty.tsv", "")
+    variants = [["--memory", "0.02"], ["-P", "2"], ["-P", "2", "--memory", "0.02"],
+        ["-P", "2", "--unordered"], ["--compact"], ["--compact", "--memory", "0.02"]]
+    for (label, f1, f2) in [("", t1, t2), ("empty T1 ", empty, t2), ("empty T2 ", t1, empty)]:
+        for (olabel, outer) in OUTER_JOINS:
+            want = sorted(runJoin(f1, f2, ["--inner", "2"] + outer))
+            for v in variants + [v + ["--inner", "2"] for v in variants]:
+                compare("join %s%s %s" % (label, olabel, " ".join(v)),
+                    sorted(runJoin(f1, f2, outer + v)), want)
+    # -P keeps the order of T1's rows, then gives the unmatched
+    # rows of T2 (whose order is not specified)
+    for (olabel, outer) in OUTER_JOINS:
+        want = sortedTail(runJoin(t1, t2, ["--inner", "2"] + outer))
+        for v in [["-P", "2"], ["-P", "2", "--memory", "0.02"], ["-P", "3", "--memory", "0.01"]]:
+            compare("join order %s %s" % (olabel, " ".join(v)),
+                sortedTail(runJoin(t1, t2, ["--inner", "2"] + outer + v)), want)
+
+#----------------------------------------------------------------------
+# Sorts the rows of a join that has T1 columns of NULLs (the
+# unmatched rows of T2), from the first such row on.
+#
+def sortedTail(rows):
+    rows = list(rows)
+    i = 0
+    while i < len(rows) and rows[i][0] != "":
+        i += 1
+    return rows[:i] + sorted(rows[i:])
+
+#----------------------------------------------------------------------
+def checkCompact():
+    t1 = writeTable("t1.tsv", [["a\0b", "c", "1"], ["a", "b\0c", "2"], ["a", "b", "3"],
+        ["a\0", "b", "4"], ["\0a", "b", "5"], ["x", "y", "6"]])
+    t2 = writeTable("t2.tsv", [["a", "b", "7"], ["a", "b", "8"], ["a", "bc", "9"], ["ab", "c", "10"]])
+    for (olabel, outer) in OUTER_JOINS:
+        args = ["-1", t1, "-2", t2, "--k1", "0,1", "--k2", "0,1", "--inner", "2"] + outer
+        compare("compact NUL in T1 keys %s" % olabel, TJoin(args + ["--compact"]), TJoin(args))
+    verify("compact NUL in T2 rejected", runtimeError(lambda: list(TJoin(["-1", t2, "-2", t1,
+        "--k1", "0", "--k2", "0", "--inner", "2", "--compact"]))) is not None)
+
+#----------------------------------------------------------------------
+# ts -k arguments for sort keys (col, reverse, type).
+#
+def sortArgs(keys):
+    args = []
+    for (col, rev, ktype) in keys:
+        args += ["-k", "%d%s%s" % (col, rev and "r" or "", ktype)]
+    return args
+
+# sort keys tried on typedRows
+SORT_KEYS = [
+    [(0, False, "")],
+    [(0, True, "")],
+    [(0, False, ""), (1, True, ""), (2, False, "")],
+    [(1, False, "n")],
+    [(1, True, "n"), (0, False, "")],
+    [(2, False, "g")],
+    [(2, True, "g"), (3, False, "V")],
+    [(3, False, "V")],
+    [(3, True, "V"), (0, True, "")],
+    ]
+
+def checkSort():
+    table = writeTable("typed.tsv", typedRows(3000))
+    inputs = [("", table), ("empty ", writeFile("empty.tsv", "")),
+        ("one row ", writeTable("one.tsv", typedRows(1)))]
+    for (label, fname) in inputs:
+        for keys in SORT_KEYS:
+            args = ["-1", fname] + sortArgs(keys)
+            want = list(TSort(args))
+            for mb in ["0.005", "0.1"]:
+                compare("sort %s%s --memory %s" % (label, " ".join(args[2:]), mb),
+                    TSort(args + ["--memory", mb]), want)
+
+#----------------------------------------------------------------------
+# The rows sorted on keys (col, reverse, type) the multi-pass
+# way: one stable sort per key, from the last to the first.
+#
+KEY_VALUES = {
+    "" : lambda v: v,
+    "n" : numericValue,
+    "g" : generalNumericValue,
+    "V" : naturalValue,
+    }
+
+def multiPassSort(rows, keys):
+    rows = list(rows)
+    for (col, rev, ktype) in reversed(keys):
+        value = KEY_VALUES[ktype]
+        rows.sort(key=lambda r: value(r[col]), reverse=rev)
+    return rows
+
+def checkSortKeys():
+    rows = typedRows(3000)
+    table = writeTable("typed.tsv", rows)
+    for keys in SORT_KEYS:
+        args = ["-1", table] + sortArgs(keys)
+        compare("keys %s" % " ".join(args[2:]), TSort(args), multiPassSort(rows, keys))
+    values = ["", "a", "ab", "a\0", "a\0b", "a\xff", "a\xff\0", "a\xfe", "b", "\xff"]
+    rows = [[v, w, str(i)] for (i, (v, w)) in enumerate(
+        [(v, w) for v in values for w in values] * 2)]
+    random.Random(1).shuffle(rows)
+    table = writeTable("bytes.tsv", rows)
+    for keys in [[(0, True, "")], [(0, True, ""), (1, False, "")], [(0, False, ""), (1, True, "")],
+                 [(1, True, ""), (0, True, "")]]:
+        args = ["-1", table] + sortArgs(keys)
+        compare("keys bytes %s" % " ".join(args[2:]), TSort(args), multiPassSort(rows, keys))
+
+#----------------------------------------------------------------------
+# The first n rows of each group (rows with the same values in
+# cols) of rows, in order.
+#
+def groupHeads(rows, cols, n):
+    counts = {}
+    heads = []
+    for r in rows:
+        g = tuple([r[c] for c in cols])
+        counts[g] = counts.get(g, 0) + 1
+        if counts[g] <= n:
+            heads.append(r)
+    return heads
+
+def checkLimit():
+    table = writeTable("typed.tsv", typedRows(3000))
+    for keys in [SORT_KEYS[0], SORT_KEYS[1], SORT_KEYS[2], SORT_KEYS[4], SORT_KEYS[8]]:
+        args = ["-1", table] + sortArgs(keys)
+        full = list(TSort(args))
+        for n in [1, 7, 2999, 3000, 5000]:
+            compare("limit %s --limit %d" % (" ".join(args[2:]), n),
+                TSort(args + ["--limit", str(n)]), full[:n])
+        for (g, cols) in [("0", [0]), ("3", [3]), ("0,3", [0, 3])]:
+            for n in [1, 3, 200]:
+                compare("limit %s --limit %d -g %s" % (" ".join(args[2:]), n, g),
+                    TSort(args + ["--limit", str(n), "-g", g]), groupHeads(full, cols, n))
+    empty = writeFile("empty.tsv", "")
+    compare("limit empty", TSort(["-1", empty, "-k", "0", "--limit", "5"]), [])
+    compare("limit empty -g 0", TSort(["-1", empty, "-k", "0", "--limit", "5", "-g", "0"]), [])
+
+#----------------------------------------------------------------------
+# Prepares a pipeline as buildPipeline does, including the
+# choice of streaming and merge operators (useSortOrder).
+#
+def planned(t):
+    t.pushProjection(None)
+    t.useSortOrder()
+    return t
+
+def checkSortOrder():
+    rows = typedRows(3000)
+    table = writeTable("typed.tsv", rows)
+    stable = writeTable("sorted.tsv", sorted(rows, key=lambda r: r[0]))
+    # keys k0-k4 are only in T1, k20-k24 only in T2
+    t2rows = [["k%d" % (int(r[0][1:]) + 5)] + r[1:] for r in typedRows(1000, 5)]
+    table2 = writeTable("typed2.tsv", t2rows)
+    ts = lambda f, *keys: TSort(["-1", f] + list(keys))
+    # ta: the pipeline, whether it must stream, and its group-by columns
+    cases = [
+        ("ts -k 0", lambda: ts(table, "-k", "0"), True, "0"),
+        ("ts -k 3r -k 0", lambda: ts(table, "-k", "3r", "-k", "0"), True, "0,3"),
+        ("ts -k 0 -k 3", lambda: ts(table, "-k", "0", "-k", "3"), False, "3"),
+        ("tr --sorted 0", lambda: TRead(["-f", stable, "--sorted", "0"]), True, "0"),
+        ("ts -k 0 | tf r[3] r[0]", lambda: TFilter(["-1", ts(table, "-k", "0"), "r[3]", "r[0]"]), True, "1"),
+        ("ts -k 0 | tf r[0]+'x'", lambda: TFilter(["-1", ts(table, "-k", "0"), "r[0]+'x'"]), False, "0"),
+        ("ts -k 1n", lambda: ts(table, "-k", "1n"), False, "1"),
+        ]
+    for (label, input, stream, g) in cases:
+        t = planned(TAggregate(["-1", input(), "-g", g, "-a", "count"]))
+        verify("order %s | ta -g %s %s" % (label, g, stream and "streams" or "does not stream"),
+            t.options.streamMode == stream)
+        compare("order %s | ta -g %s" % (label, g), sorted(t),
+            sorted(TAggregate(["-1", input(), "-g", g, "-a", "count"])))
+    # two-input tools: merge when both inputs are sorted on the keys
+    for (olabel, outer) in OUTER_JOINS:
+        args = ["--k1", "0", "--k2", "0"] + outer
+        t = planned(TJoin(["-1", ts(table, "-k", "0"), "-2", ts(table2, "-k", "0")] + args))
+        verify("order tj %s merges" % olabel, t.useMerge)
+        compare("order tj %s" % olabel, sorted(t),
+            sorted(TJoin(["-1", ts(table, "-k", "0"), "-2", ts(table2, "-k", "0")] + args)))
+    t = planned(TJoin(["-1", ts(table, "-k", "0r"), "-2", ts(table2, "-k", "0"), "--k1", "0", "--k2", "0"]))
+    verify("order tj on a reversed input does not merge", not t.useMerge)
+    for (name, tool) in [("ti", TIntersection), ("td", TDifference)]:
+        for (k1, k2, keys) in [("0", "0", ["-k", "0"]), ("0,3", "0,3", ["-k", "0", "-k", "3"])]:
+            args = ["--k1", k1, "--k2", k2]
+            t = planned(tool(["-1", ts(table, *keys), "-2", ts(table2, *keys)] + args))
+            verify("order %s --k1 %s merges" % (name, k1), t.useMerge)
+            compare("order %s --k1 %s" % (name, k1), t,
+                tool(["-1", ts(table, *keys), "-2", ts(table2, *keys)] + args))
+    t = planned(TUnion(["-1", ts(table, "-k", "0"), "-2", ts(table2, "-k", "0"), "--k1", "0", "--k2", "0"]))
+    compare("order tu", t, TUnion(["-1", ts(table, "-k", "0"), "-2", ts(table2, "-k", "0"),
+        "--k1", "0", "--k2", "0"]))
+    # input that is not in the order declared for it
+    unsorted = lambda: TRead(["-f", table, "--sorted", "0"])
+    for (label, t) in [
+        ("ta after tr --sorted", lambda: planned(TAggregate(["-1", unsorted(), "-g", "0", "-a", "count"]))),
+        ("ta --stream", lambda: TAggregate(["-1", table, "-g", "0", "-a", "count", "--stream"])),
+        ("tj after tr --sorted", lambda: planned(TJoin(["-1", unsorted(), "-2", ts(table2, "-k", "0"),
+            "--k1", "0", "--k2", "0"]))),
+        ("td --sorted", lambda: TDifference(["-1", table, "-2", table2, "--k1", "0", "--k2", "0", "--sorted"])),
+        ]:
+        verify("order unsorted input to %s is an error" % label,
+            runtimeError(lambda: list(t())) is not None)
+
+#----------------------------------------------------------------------
+def checkParallelSort():
+    table = writeTable("typed.tsv", typedRows(3000))
+    inputs = [("", table, SORT_KEYS),
+        ("equal keys ", writeTable("equal.tsv", [["x", str(i)] for i in range(2000)]),
+            [[(0, False, "")], [(0, True, "")]]),
+        ("empty ", writeFile("empty.tsv", ""), SORT_KEYS[:3]),
+        ("one row ", writeTable("one.tsv", typedRows(1)), SORT_KEYS[:3])]
+    for (label, fname, keyLists) in inputs:
+        for keys in keyLists:
+            args = ["-1", fname] + sortArgs(keys)
+            want = list(TSort(args))
+            for opts in [["-P", "2"], ["-P", "3", "--memory", "0.2"], ["-P", "2", "--memory", "0.01"]]:
+                compare("psort %s%s %s" % (label, " ".join(args[2:]), " ".join(opts)),
+                    TSort(args + opts), want)
+
+#----------------------------------------------------------------------
+# Runs fun and returns the message of the RuntimeError it raises,
+# or None.
+#
+def runtimeError(fun):
+    try:
+        fun()
+    except RuntimeError, e:
+        return str(e)
+    return None
+
+def checkIndex():
+    # keys k0-k9 are only in T1, k60-k69 only in T2
+    rows = [r for r in testRows(3000, 3, 70, 3) if int(r[0][1:]) >= 10]
+    t1 = writeTable("t1.tsv", testRows(500, 3, 60, 1))
+    t2s = [
+        ("", writeTable("t2.tsv", rows)),
+        ("comments ", writeFile("t2c.tsv", "#k1\tx\n" + "".join([TAB.join(r) + NL for r in rows[:100]]) + "\n#k2\n")),
+        ("empty T2 ", writeFile("t2e.tsv", "")),
+        ]
+    for (label, t2) in t2s:
+        for (olabel, outer) in OUTER_JOINS:
+            want = sortedTail(runJoin(t1, t2, ["--inner", "2"] + outer))
+            for build in ["build", "reuse"]:
+                compare("index %stj %s (%s)" % (label, olabel, build),
+                    sortedTail(runJoin(t1, t2, outer + ["--index"])), want)
+        for (name, tool) in [("ti", TIntersection), ("td", TDifference)]:
+            args = ["-1", t1, "-2", t2, "--k1", "0", "--k2", "0"]
+            compare("index %s%s" % (label, name), tool(args + ["--index"]), tool(args))
+    cname = writeFile("t2.csv", '"k1,x",y\nk2,z\n')
+    csvT2 = lambda: TRead(["-f", cname, "--format", "csv"])
+    verify("index csv T2 rejected by tj", runtimeError(lambda:
+        list(TJoin(["-1", t1, "-2", csvT2(), "--k1", "0", "--k2", "0", "--index"]))) ==
+        "--index requires T2 to be in tsv format, not csv.")
+    verify("index csv T2 rejected by ti", runtimeError(lambda:
+        list(TIntersection(["-1", t1, "-2", csvT2(), "--k1", "0", "--k2", "0", "--index"]))) ==
+        "--index requires T2 to be in tsv format, not csv.")
+
+#----------------------------------------------------------------------
+TESTS = [
+    ('mmap', checkMmap),
+    ('cache', checkCache),
+    ('order', checkSortOrder),
+    ('pipe', checkPipe),
+    ('join', checkJoin),
+    ('compact', checkCompact),
+    ('index', checkIndex),
+    ('keys', checkSortKeys),
+    ('limit', checkLimit),
+    ('psort', checkParallelSort),
+    ('sort', checkSort),
+    ('write', checkWrite),
+    ]
+
+if __name__ == "__main__":
+    names = sys.argv[1:] or [name for (name, fun) in TESTS]
+    tests = dict(TESTS)
+    for name in names:
+        if not tests.has_key(name):
+            sys.stderr.write(__doc__)
+            sys.exit(-1)
+    tmpdir = tempfile.mkdtemp()
+    try:
+        for name in names:
+            tests[name]()
+    finally:
+        shutil.rmtree(tmpdir)
+    sys.exit(failures and 1 or 0)
@@ -0,0 +1,265 @@
+#------------------------------------------------------------
+#------------------------------------------------------------
+#
+# compression.py
+#
+# Support for compressed (.gz, .bz2, .xz) input and output.
+# Compressed input is recognized by its magic bytes; output
+# format is chosen explicitly or from the file name extension.
+# (De)compression runs on a background thread, so it overlaps
+# with parsing and operator work.
+#
+# xz requires the lzma module (standard in Python 3; for
+# Python 2, install backports.lzma).
+#
+#----------------------------------------------------------------------
+import sys
+import zlib
+import bz2
+import threading
+import Queue
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+from common import *
+from TableTool import Prefetcher
+
+GZ	= "gz"
+BZ2	= "bz2"
+XZ	= "xz"
+
+FORMATS = [GZ, BZ2, XZ]
+
+# magic bytes at the start of each kind of file
+MAGIC = [
+    ("\x1f\x8b", GZ),
+    ("BZh", BZ2),
+    ("\xfd7zXZ\x00", XZ),
+    ]
+MAGIC_LEN = 6
+
+EXTENSIONS = {
+    ".gz"  : GZ,
+    ".bz2" : BZ2,
+    ".xz"  : XZ,
+    }
+
+# size of raw reads/writes, and of the (de)compression queues
+BLOCK_SIZE = 256*1024
+QUEUE_DEPTH = 4
+
+#----------------------------------------------------------------------
+# Returns the format whose magic bytes begin prefix, or None.
+#
+def detectFormat(prefix):
+    for (magic, fmt) in MAGIC:
+        if prefix.startswith(magic):
+            return fmt
+    return None
+
+#----------------------------------------------------------------------
+# Returns the format implied by a file name's extension, or None.
+#
+def formatForName(fname):
+    for (ext, fmt) in EXTENSIONS.items():
+        if fname.endswith(ext):
+            return fmt
+    return None
+
+#----------------------------------------------------------------------
+def checkFormat(fmt):
+    if fmt not in FORMATS:
+        raise ValueError("Unknown compression format: %s" % fmt)
+    if fmt == XZ and lzma is None:
+        raise ImportError("xz compression requires the lzma module " + \
+            "(for Python 2: pip install backports.lzma)")
+
+#----------------------------------------------------------------------
+def newDecompressor(fmt):
+    checkFormat(fmt)
+    if fmt == GZ:
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    elif fmt == BZ2:
+        return bz2.BZ2Decompressor()
+    else:
+        return lzma.LZMADecompressor()
+
+#----------------------------------------------------------------------
+def newCompressor(fmt, level=6):
+    checkFormat(fmt)
+    if fmt == GZ:
+        return zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    elif fmt == BZ2:
+        return bz2.BZ2Compressor(max(level, 1))
+    else:
+        return lzma.LZMACompressor()
+
+#----------------------------------------------------------------------
+# Reads fd and generates its decompressed contents, as lists
+# of one string (the unit a Prefetcher queues). Handles files
+# made of several concatenated compressed streams.
+#
+def decompressedBlocks(fd, fmt, blockSize=BLOCK_SIZE):
+    d = newDecompressor(fmt)
+    raw = fd.read(blockSize)
+    while raw:
+        try:
+            out = d.decompress(raw)
+        except EOFError:
+            # bz2: previous stream ended; start another.
+            d = newDecompressor(fmt)
+            continue
+        if out:
+            yield [out]
+        raw = d.unused_data
+        if raw:
+            d = newDecompressor(fmt)
+        else:
+            raw = fd.read(blockSize)
+
+#----------------------------------------------------------------------
+# A read-only file object that decompresses another one
+# on a background thread. Supports read, readline and close.
+#
+class DecompressingReader:
+    def __init__(self, fd, fmt, depth=QUEUE_DEPTH):
+        self.fd = fd
+        self.prefetcher = Prefetcher(None, depth, decompressedBlocks(fd, fmt))
+        self.blocks = iter(self.prefetcher)
+        self.buf = ""
+        self.eof = False
+
+    # Appends the next decompressed block to the buffer.
+    # Returns False at end of input.
+    def fill(self):
+        if self.eof:
+            return False
+        block = next(self.blocks, None)
+        if block is None:
+            self.eof = True
+            return False
+        self.buf += block
+        return True
+
+    def read(self, n=-1):
+        while n < 0 or len(self.buf) < n:
+            if not self.fill():
+                break
+        if n < 0:
+            n = len(self.buf)
+        data = self.buf[:n]
+        self.buf = self.buf[n:]
+        return data
+
+    def readline(self):
+        i = self.buf.find(NL)
+        while i == -1:
+            start = len(self.buf)
+            if not self.fill():
+                i = len(self.buf) - 1
+                break
+            i = self.buf.find(NL, start)
+        line = self.buf[:i+1]
+        self.buf = self.buf[i+1:]
+        return line
+
+    def close(self):
+        self.blocks.close()
+        if self.fd is not sys.stdin:
+            self.fd.close()
+
+#----------------------------------------------------------------------
+# A write-only file object that compresses what is written
+# to it on a background thread, and writes the result to fd.
+# Writes are collected into blocks of blockSize bytes before
+# they are handed to the thread. close() must be called to
+# complete the file; it also closes fd (unless it is stdout).
+#
+class CompressingWriter:
+    def __init__(self, fd, fmt, level=6, depth=QUEUE_DEPTH, blockSize=BLOCK_SIZE):
+        self.fd = fd
+        self.compressor = newCompressor(fmt, level)
+        self.blockSize = blockSize
+        self.buf = []
+        self.size = 0
+        self.error = None
+        self.queue = Queue.Queue(depth)
+        self.thread = threading.Thread(target=self.consume)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def write(self, s):
+        self.buf.append(s)
+        self.size += len(s)
+        if self.size >= self.blockSize:
+            self.flush()
+
+    # Hands buffered data to the compression thread.
+    def flush(self):
+        if self.size > 0:
+            self.queue.put("".join(self.buf))
+            self.buf = []
+            self.size = 0
+        self.checkError()
+
+    def checkError(self):
+        if self.error is not None:
+            exc = self.error
+            self.error = None
+            raise exc[0], exc[1], exc[2]
+
+    def consume(self):
+        while True:
+            data = self.queue.get()
+            if data is None:
+                break
+            if self.error is not None:
+                continue	# drain the queue after a failure
+            try:
+                out = self.compressor.compress(data)
+                if out:
+                    self.fd.write(out)
+            except:
+                self.error = sys.exc_info()
+        if self.error is None:
+            try:
+                self.fd.write(self.compressor.flush())
+            except:
+                self.error = sys.exc_info()
+
+    def close(self):
+        if self.thread is None:
+            return
+        self.flush()
+        self.queue.put(None)
+        self.thread.join()
+        self.thread = None
+        if self.fd is sys.stdout:
+            self.fd.flush()
+        else:
+            self.fd.close()
+        self.checkError()
+
+#----------------------------------------------------------------------
+# Opens a file for output. If fmt is None, the format is
+# chosen from the file name's extension; use "none" for no
+# compression. fname "-" means stdout.
+#
+def openOutput(fname, mode='w', fmt=None):
+    if fmt is None and fname != "-":
+        fmt = formatForName(fname)
+    if fmt is not None and fmt != "none":
+        checkFormat(fmt)
+    if fname == "-":
+        fd = sys.stdout
+    else:
+        fd = open(fname, mode)
+    if fmt is None or fmt == "none":
+        return fd
+    return CompressingWriter(fd, fmt)
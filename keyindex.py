@@ -0,0 +1,288 @@
+#------------------------------------------------------------
+#------------------------------------------------------------
+#
+# keyindex.py
+#
+'''
+        keyindex - build key indexes
+Builds (or refreshes) the key index of each FILE on the given key
+columns. The index is a hash table, stored on disk next to the file
+(in FILE.kCOLS.deftkey, e.g. genes.txt.k0_2.deftkey), that maps each
+key to the byte offsets of the rows having it. tj, ti and td (--index)
+open it in place of loading their second input, and read only the
+rows whose keys they look up. An index is rebuilt automatically when
+the size or modification time of its file changes.
+
+usage: python keyindex.py -k COLUMNS [-s SEP] [-c CHAR] FILE [FILE ...]
+'''
+#----------------------------------------------------------------------
+import sys
+import os
+import array
+import marshal
+import mmap
+import zlib
+from optparse import OptionParser
+
+from common import *
+import compression
+
+KEY_INDEX_SUFFIX = ".deftkey"
+KEY_INDEX_MAGIC = "deft-key-index"
+KEY_INDEX_VERSION = 1
+
+# size of the reads made while building an index
+BUILD_BLOCK_SIZE = 1024*1024
+
+# key separator for hashing (keys that collide because a value
+# contains it are told apart by comparing the keys themselves)
+NUL = "\0"
+
+#----------------------------------------------------------------------
+# Hash of a key (tuple of strings) that is the same in every
+# process and Python version.
+#
+def keyHash(key):
+    return zlib.crc32(NUL.join(key)) & 0xffffffff
+
+#----------------------------------------------------------------------
+# The key index of one file on some columns. Keys hash into
+# nbuckets buckets; bucket b's row offsets are
+# offsets[buckets[b]:buckets[b+1]], in file order. Rows too
+# short to have a key, and comment and blank lines, are not
+# indexed.
+#
+class KeyIndex:
+    def __init__(self, fname, cols, separatorChar=TAB, commentChar=HASH):
+        self.fileName = fname
+        self.cols = list(cols)
+        self.separatorChar = separatorChar
+        self.commentChar = commentChar
+        self.nbuckets = 0
+        self.buckets = array.array('L')
+        self.offsets = array.array('L')
+        self.nrows = 0
+        self.ncols = 0
+        self.fileDesc = None
+        self.mmap = None
+
+    #---------------------------------------------------------
+    def indexName(self):
+        return "%s.k%s%s" % (self.fileName, "_".join(map(str, self.cols)),
+                             KEY_INDEX_SUFFIX)
+
+    #---------------------------------------------------------
+    def key(self):
+        st = os.stat(self.fileName)
+        return (os.path.abspath(self.fileName), st.st_size, st.st_mtime,
+                self.separatorChar, self.commentChar, tuple(self.cols))
+
+    #---------------------------------------------------------
+    # Loads the index file, if it is current. Returns True
+    # if it was loaded.
+    #
+    def load(self):
+        try:
+            fd = open(self.indexName(), 'rb')
+            header = marshal.load(fd)
+            if type(header) is not types.TupleType or len(header) != 7 \
+            or header[:3] != (KEY_INDEX_MAGIC, KEY_INDEX_VERSION, self.key()) \
+            or header[3] != self.buckets.itemsize:
+                fd.close()
+                return False
+            (magic, version, key, itemsize, self.nbuckets, self.nrows, self.ncols) = header
+            self.buckets = array.array('L')
+            self.buckets.fromfile(fd, self.nbuckets + 1)
+            self.offsets = array.array('L')
+            self.offsets.fromfile(fd, self.nrows)
+            fd.close()
+        except (IOError, EOFError, ValueError, TypeError):
+            return False
+        return True
+
+    #---------------------------------------------------------
+    # Generates (offset, row) for the indexed rows of the
+    # file, in order. An unterminated last line loses its last
+    # character, as it does in TRead.
+    #
+    def scanRows(self):
+        sep = self.separatorChar
+        com = self.commentChar
+        m = max(self.cols)
+        fd = open(self.fileName, 'rb')
+        if compression.detectFormat(fd.read(compression.MAGIC_LEN)) is not None:
+            fd.close()
+            raise RuntimeError("%s: cannot index a compressed file." % self.fileName)
+        fd.seek(0)
+        pos = 0
+        pending = ""
+        try:
+            while True:
+                block = fd.read(BUILD_BLOCK_SIZE)
+                if block:
+                    lines = (pending + block).split(NL)
+                    pending = lines.pop()
+                elif pending:
+                    lines = [pending[:-1]]
+                    pending = ""
+                else:
+                    break
+                for l in lines:
+                    if l and not l.startswith(com):
+                        r = l.split(sep)
+                        if len(r) > m:
+                            yield (pos, r)
+                    pos += len(l) + 1
+        finally:
+            fd.close()
+
+    #---------------------------------------------------------
+    # Scans the file and builds the index (a counting sort
+    # of the row offsets by bucket).
+    #
+    def build(self):
+        cols = self.cols
+        hashes = array.array('L')
+        offsets = array.array('L')
+        ncols = 0
+        for (pos, r) in self.scanRows():
+            hashes.append(keyHash(tuple([r[c] for c in cols])))
+            offsets.append(pos)
+            ncols = len(r)
+        n = len(offsets)
+        nb = max(1, 2*n)
+        counts = array.array('L', [0]) * (nb + 1)
+        for i in xrange(n):
+            hashes[i] = hashes[i] % nb
+            counts[hashes[i] + 1] += 1
+        for b in xrange(nb):
+            counts[b+1] += counts[b]
+        buckets = array.array('L', counts)
+        byBucket = array.array('L', [0]) * n
+        for i in xrange(n):
+            b = hashes[i]
+            byBucket[counts[b]] = offsets[i]
+            counts[b] += 1
+        self.nbuckets = nb
+        self.buckets = buckets
+        self.offsets = byBucket
+        self.nrows = n
+        self.ncols = ncols
+
+    #---------------------------------------------------------
+    # Writes the index file (to a temporary name, then renamed).
+    #
+    def save(self):
+        header = (KEY_INDEX_MAGIC, KEY_INDEX_VERSION, self.key(),
+                  self.buckets.itemsize, self.nbuckets, self.nrows, self.ncols)
+        iname = self.indexName()
+        tmpname = "%s.%d" % (iname, os.getpid())
+        fd = open(tmpname, 'wb')
+        marshal.dump(header, fd)
+        self.buckets.tofile(fd)
+        self.offsets.tofile(fd)
+        fd.close()
+        os.rename(tmpname, iname)
+
+    #---------------------------------------------------------
+    # Maps the file, for reading rows. (An empty file cannot
+    # be mapped, but has no rows to read.)
+    #
+    def open(self):
+        self.fileDesc = open(self.fileName, 'rb')
+        if os.fstat(self.fileDesc.fileno()).st_size > 0:
+            self.mmap = mmap.mmap(self.fileDesc.fileno(), 0, access=mmap.ACCESS_READ)
+
+    #---------------------------------------------------------
+    def close(self):
+        if self.mmap is not None:
+            self.mmap.close()
+            self.mmap = None
+        if self.fileDesc is not None:
+            self.fileDesc.close()
+            self.fileDesc = None
+
+    #---------------------------------------------------------
+    # Returns the row at byte offset pos.
+    #
+    def rowAt(self, pos):
+        mm = self.mmap
+        end = mm.find(NL, pos)
+        if end == -1:
+            end = len(mm) - 1
+        return mm[pos:end].split(self.separatorChar)
+
+    #---------------------------------------------------------
+    # Returns the list of (offset, row) for the rows having
+    # the given key (a tuple of strings), in file order.
+    #
+    def lookup(self, key):
+        b = keyHash(key) % self.nbuckets
+        start = self.buckets[b]
+        end = self.buckets[b+1]
+        if start == end:
+            return []
+        cols = self.cols
+        found = []
+        for pos in self.offsets[start:end]:
+            r = self.rowAt(pos)
+            if tuple([r[c] for c in cols]) == key:
+                found.append((pos, r))
+        return found
+
+    #---------------------------------------------------------
+    # False if no row has key; True if some row may have it
+    # (i.e., its bucket is not empty). Cheaper than lookup.
+    #
+    def mayContain(self, key):
+        b = keyHash(key) % self.nbuckets
+        return self.buckets[b] != self.buckets[b+1]
+
+    #---------------------------------------------------------
+    def has_key(self, key):
+        return self.mayContain(key) and len(self.lookup(key)) > 0
+
+    __contains__ = has_key
+
+#----------------------------------------------------------------------
+# Returns the key index of fname on cols, opened for lookups;
+# it is loaded if it is current, else built and saved. Failure
+# to save is not an error (e.g., a read-only directory); the
+# index is then simply not reused.
+#
+def getKeyIndex(fname, cols, separatorChar=TAB, commentChar=HASH, log=None):
+    index = KeyIndex(fname, cols, separatorChar, commentChar)
+    if not index.load():
+        index.build()
+        try:
+            index.save()
+        except (IOError, OSError), e:
+            if log is not None:
+                log("WARNING: could not write index file %s: %s" % (index.indexName(), e))
+    index.open()
+    return index
+
+#----------------------------------------------------------------------
+if __name__ == "__main__":
+    parser = OptionParser(__doc__)
+    parser.add_option("-k", dest="cols", action="append", default=[],
+        metavar="COLUMN(S)",
+        help="Key column(s). A comma separated list, or repeat the option.")
+    parser.add_option("-s", "--separator", dest="sep", default=TAB,
+        metavar="CHAR",
+        help="Column separator character (default=TAB).")
+    parser.add_option("-c", "--comment", dest="com1", default=HASH,
+        metavar="CHAR",
+        help="Comment character (default=HASH). Lines beginning with CHAR are not rows.")
+    (options, args) = parser.parse_args()
+    cols = map(int, filter(None, ",".join(options.cols).split(",")))
+    if len(cols) == 0:
+        parser.error("No key columns specified.")
+    if len(args) == 0:
+        parser.error("No files specified.")
+    for fname in args:
+        index = KeyIndex(fname, cols, options.sep, options.com1)
+        index.build()
+        index.save()
+        sys.stderr.write("%s: %d rows, %d buckets\n" % \
+            (index.indexName(), index.nrows, index.nbuckets))
@@ -0,0 +1,180 @@
+#------------------------------------------------------------
+#------------------------------------------------------------
+#
+# lineindex.py
+#
+'''
+        lineindex - build line-offset indexes
+Builds (or refreshes) the line-offset index of each FILE. The
+index records the byte offset of every Nth row of the file (comment
+and blank lines are not rows), and is stored next to it, in
+FILE.deftidx. TRead uses it to seek to a range of rows (--rows), to
+sample rows (--sample) and to split the file evenly between worker
+processes (-P). An index is rebuilt automatically when the size or
+modification time of its file changes.
+
+usage: python lineindex.py [-n N] [-c CHAR] FILE [FILE ...]
+'''
+#----------------------------------------------------------------------
+import sys
+import os
+import array
+import marshal
+from optparse import OptionParser
+
+from common import *
+
+INDEX_SUFFIX = ".deftidx"
+INDEX_MAGIC = "deft-line-index"
+INDEX_VERSION = 1
+
+# default number of rows between indexed offsets
+DEFAULT_EVERY = 1000
+
+# size of the reads made while building an index
+BUILD_BLOCK_SIZE = 1024*1024
+
+#----------------------------------------------------------------------
+# The line-offset index of one file. offsets[b] is the byte
+# offset of row b*every, and linenums[b] the number of lines
+# (of any kind) that precede it.
+#
+class LineIndex:
+    def __init__(self, fname, every=DEFAULT_EVERY, commentChar=HASH):
+        self.fileName = fname
+        self.every = every
+        self.commentChar = commentChar
+        self.offsets = array.array('L')
+        self.linenums = array.array('L')
+        self.nrows = 0
+        self.nlines = 0
+
+    #---------------------------------------------------------
+    def indexName(self):
+        return self.fileName + INDEX_SUFFIX
+
+    #---------------------------------------------------------
+    def key(self):
+        st = os.stat(self.fileName)
+        return (os.path.abspath(self.fileName), st.st_size, st.st_mtime,
+                self.commentChar)
+
+    #---------------------------------------------------------
+    # Loads the index file, if it is current. Returns True
+    # if it was loaded. (The stored row interval is used,
+    # whatever self.every is.)
+    #
+    def load(self):
+        try:
+            fd = open(self.indexName(), 'rb')
+            header = marshal.load(fd)
+            if type(header) is not types.TupleType or len(header) != 6 \
+            or header[:3] != (INDEX_MAGIC, INDEX_VERSION, self.key()):
+                fd.close()
+                return False
+            (magic, version, key, self.every, self.nrows, self.nlines) = header
+            self.offsets = array.array('L', marshal.load(fd))
+            self.linenums = array.array('L', marshal.load(fd))
+            fd.close()
+        except (IOError, EOFError, ValueError, TypeError):
+            return False
+        return True
+
+    #---------------------------------------------------------
+    # Scans the file and builds the index.
+    #
+    def build(self):
+        every = self.every
+        com = self.commentChar
+        offsets = array.array('L')
+        linenums = array.array('L')
+        pos = 0
+        lnum = 0
+        row = 0
+        pending = ""
+        fd = open(self.fileName, 'rb')
+        while True:
+            block = fd.read(BUILD_BLOCK_SIZE)
+            if block:
+                lines = (pending + block).split(NL)
+                pending = lines.pop()
+            elif pending:
+                lines = [pending]
+                pending = ""
+            else:
+                break
+            for l in lines:
+                if l and not l.startswith(com):
+                    if row % every == 0:
+                        offsets.append(pos)
+                        linenums.append(lnum)
+                    row += 1
+                pos += len(l) + 1
+                lnum += 1
+        fd.close()
+        self.offsets = offsets
+        self.linenums = linenums
+        self.nrows = row
+        self.nlines = lnum
+
+    #---------------------------------------------------------
+    # Writes the index file (to a temporary name, then renamed).
+    #
+    def save(self):
+        header = (INDEX_MAGIC, INDEX_VERSION, self.key(), self.every,
+                  self.nrows, self.nlines)
+        iname = self.indexName()
+        tmpname = "%s.%d" % (iname, os.getpid())
+        fd = open(tmpname, 'wb')
+        marshal.dump(header, fd)
+        marshal.dump(self.offsets.tostring(), fd)
+        marshal.dump(self.linenums.tostring(), fd)
+        fd.close()
+        os.rename(tmpname, iname)
+
+    #---------------------------------------------------------
+    # Returns (offset, linenum, rownum) for the indexed row
+    # at or before row number row (rows are numbered from 0).
+    #
+    def seekInfo(self, row):
+        b = min(row // self.every, len(self.offsets) - 1)
+        if b < 0:
+            return (0, 0, 0)
+        return (self.offsets[b], self.linenums[b], b * self.every)
+
+#----------------------------------------------------------------------
+# Returns the index of fname, loading it if it is current,
+# else building and saving it. Failure to save is not an
+# error (e.g., a read-only directory); the index is then
+# simply not reused.
+#
+def getIndex(fname, every=DEFAULT_EVERY, commentChar=HASH, log=None):
+    index = LineIndex(fname, every, commentChar)
+    if index.load():
+        return index
+    index.build()
+    try:
+        index.save()
+    except (IOError, OSError), e:
+        if log is not None:
+            log("WARNING: could not write index file %s: %s" % (index.indexName(), e))
+    return index
+
+#----------------------------------------------------------------------
+if __name__ == "__main__":
+    parser = OptionParser(__doc__)
+    parser.add_option("-n", dest="every", default=DEFAULT_EVERY, type="int",
+        metavar="N",
+        help="Index every Nth row (default=%d)." % DEFAULT_EVERY)
+    parser.add_option("-c", "--comment", dest="com1", default=HASH,
+        metavar="CHAR",
+        help="Comment character (default=HASH). Lines beginning with CHAR are not rows.")
+    (options, args) = parser.parse_args()
+    if len(args) == 0:
+        parser.error("No files specified.")
+    for fname in args:
+        index = LineIndex(fname, options.every, options.com1)
+        index.build()
+        index.save()
+        sys.stderr.write("%s: %d rows, %d offsets\n" % \
+            (index.indexName(), index.nrows, len(index.offsets)))